@@ -0,0 +1,191 @@
+"""
+Batch detail view
+Everything the batch screen shows over one connection: the batch row and
+the selected sections (operations, consumed materials, mix production,
+stock movements linked by batch number) in one batch of set-based queries
+read with nextset; recipe and spice requirements come from the compiled
+recipe cache.
+"""
+import json
+from typing import Iterable, Optional
+
+from fastapi import HTTPException
+
+from fast_json import RowEncoder
+from material_requirements import check_requirements
+from models import Batch
+from recipe_cache import get_compiled_recipe
+
+BATCH_ENCODER = RowEncoder(
+    Batch,
+    ("id", "batch_number", "recipe_id", "recipe_name", "status", "current_step",
+     "started_at", "completed_at", "initial_weight", "final_weight", "trim_waste",
+     "trim_returned", "operator_notes")
+)
+
+BATCH_QUERY = """
+    SELECT b.id, b.batch_number, b.recipe_id, r.name as recipe_name,
+           b.status, b.current_step, b.started_at, b.completed_at,
+           b.initial_weight, b.final_weight, b.trim_waste,
+           b.trim_returned, b.operator_notes
+    FROM batches b
+    LEFT JOIN recipes r ON b.recipe_id = r.id
+    WHERE b.id = ?
+"""
+
+OPERATIONS_QUERY = """
+    SELECT bo.id, bo.batch_id, bo.step_id, bo.operation_type, bo.status,
+           bo.started_at, bo.completed_at, bo.weight_before, bo.weight_after,
+           bo.parameters, bo.notes, rs.step_name, rs.step_order
+    FROM batch_operations bo
+    JOIN recipe_steps rs ON bo.step_id = rs.id
+    WHERE bo.batch_id = ?
+    ORDER BY rs.step_order, bo.started_at
+"""
+
+MATERIALS_QUERY = """
+    SELECT bm.id, bm.nomenclature_id, n.name, n.unit, bm.material_type,
+           bm.quantity_used, bm.notes, bm.created_at
+    FROM batch_materials bm
+    JOIN nomenclature n ON bm.nomenclature_id = n.id
+    WHERE bm.batch_id = ?
+    ORDER BY bm.created_at, bm.id
+"""
+
+MIX_QUERY = """
+    SELECT mp.id, mp.mix_nomenclature_id, n.name, mp.produced_quantity, mp.used_quantity,
+           mp.leftover_quantity, mp.warehouse_mix_used, mp.created_at
+    FROM batch_mix_production mp
+    JOIN nomenclature n ON mp.mix_nomenclature_id = n.id
+    WHERE mp.batch_id = ?
+"""
+
+MOVEMENTS_QUERY = """
+    SELECT sm.id, sm.nomenclature_id, n.name, n.unit, sm.operation_type, sm.quantity,
+           sm.balance_after, sm.source_operation_type, sm.operation_date, sm.metadata
+    FROM stock_movements sm
+    JOIN nomenclature n ON sm.nomenclature_id = n.id
+    WHERE sm.source_operation_id = (SELECT batch_number FROM batches WHERE id = ?)
+    ORDER BY sm.operation_date, sm.id
+"""
+
+def parse_json(value: Optional[str]):
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
+
+def to_float(value) -> Optional[float]:
+    return float(value) if value is not None else None
+
+def iso(value) -> Optional[str]:
+    return value.isoformat() if value else None
+
+def operation_dict(row) -> dict:
+    return {
+        'id': row.id,
+        'batch_id': row.batch_id,
+        'step_id': row.step_id,
+        'operation_type': row.operation_type,
+        'status': row.status,
+        'started_at': iso(row.started_at),
+        'completed_at': iso(row.completed_at),
+        'weight_before': float(row.weight_before) if row.weight_before else None,
+        'weight_after': float(row.weight_after) if row.weight_after else None,
+        'parameters': parse_json(row.parameters),
+        'notes': row.notes,
+        'step_name': row.step_name,
+        'step_order': row.step_order
+    }
+
+def material_dict(row) -> dict:
+    return {
+        'id': row.id,
+        'nomenclature_id': row.nomenclature_id,
+        'name': row.name,
+        'unit': row.unit,
+        'material_type': row.material_type,
+        'quantity_used': float(row.quantity_used),
+        'notes': row.notes,
+        'created_at': iso(row.created_at)
+    }
+
+def mix_dict(row) -> dict:
+    return {
+        'id': row.id,
+        'mix_nomenclature_id': row.mix_nomenclature_id,
+        'mix_name': row.name,
+        'produced_quantity': float(row.produced_quantity),
+        'used_quantity': float(row.used_quantity),
+        'leftover_quantity': float(row.leftover_quantity),
+        'warehouse_mix_used': float(row.warehouse_mix_used),
+        'created_at': iso(row.created_at)
+    }
+
+def movement_dict(row) -> dict:
+    return {
+        'id': row.id,
+        'nomenclature_id': row.nomenclature_id,
+        'name': row.name,
+        'unit': row.unit,
+        'operation_type': row.operation_type,
+        'quantity': float(row.quantity),
+        'balance_after': to_float(row.balance_after),
+        'source_operation_type': row.source_operation_type,
+        'operation_date': iso(row.operation_date),
+        'metadata': parse_json(row.metadata)
+    }
+
+# Sections read in the query batch: (name, query, row -> dict)
+QUERY_SECTIONS = (
+    ('operations', OPERATIONS_QUERY, operation_dict),
+    ('materials', MATERIALS_QUERY, material_dict),
+    ('mix_production', MIX_QUERY, mix_dict),
+    ('movements', MOVEMENTS_QUERY, movement_dict),
+)
+SECTIONS = ('batch', 'recipe', 'spice_requirements') + tuple(name for name, _, _ in QUERY_SECTIONS)
+
+def parse_sections(fields: Optional[str]) -> tuple:
+    """Comma separated section names; all sections when not given"""
+    if not fields:
+        return SECTIONS
+    requested = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in requested if name not in SECTIONS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Невідомі поля: {', '.join(unknown)}. Доступні: {', '.join(SECTIONS)}"
+        )
+    return tuple(requested)
+
+def load_batch_full(cursor, batch_id: int, sections: Iterable[str] = SECTIONS) -> dict:
+    sections = set(sections)
+    queries = [(name, query, encode) for name, query, encode in QUERY_SECTIONS if name in sections]
+
+    cursor.execute(
+        ";\n".join([BATCH_QUERY] + [query for _, query, _ in queries]),
+        [batch_id] * (len(queries) + 1)
+    )
+    row = cursor.fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    batch = BATCH_ENCODER.encode(row)
+
+    result = {'id': batch_id}
+    if 'batch' in sections:
+        result['batch'] = batch
+    for name, _, encode in queries:
+        cursor.nextset()
+        result[name] = [encode(row) for row in cursor.fetchall()]
+
+    if 'recipe' in sections or 'spice_requirements' in sections:
+        recipe = get_compiled_recipe(batch['recipe_id'], cursor)
+        if 'recipe' in sections:
+            result['recipe'] = recipe.as_dict()
+        if 'spice_requirements' in sections:
+            result['spice_requirements'] = check_requirements(
+                cursor, [(recipe.id, batch['initial_weight'])], kinds=('spice',)
+            )
+    return result
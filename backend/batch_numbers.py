@@ -0,0 +1,40 @@
+"""
+Batch number allocation
+One counter row per prefix (product code and day, e.g. BAST-13112025):
+the next number is a single atomic UPDATE ... OUTPUT instead of counting
+existing batches. The counter row stays locked until the caller's
+transaction ends, so a rolled back batch does not leave a gap.
+"""
+
+# Tables whose batch_number values seed a new counter
+NUMBERED_TABLES = ("batches", "packaging_batches")
+
+def next_number(cursor, prefix: str, table: str) -> int:
+    """Next number for the prefix within the caller's transaction"""
+    cursor.execute("""
+        UPDATE batch_number_counters
+        SET last_value = last_value + 1
+        OUTPUT INSERTED.last_value
+        WHERE prefix = ?
+    """, prefix)
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+
+    # First number of the prefix: continue after numbers issued before the counter
+    if table not in NUMBERED_TABLES:
+        raise ValueError(f"Unknown numbered table: {table}")
+    cursor.execute(f"""
+        MERGE batch_number_counters WITH (HOLDLOCK) AS c
+        USING (
+            SELECT ? AS prefix,
+                   (SELECT COUNT(*) FROM {table} WHERE batch_number LIKE ?) AS issued
+        ) AS s
+        ON c.prefix = s.prefix
+        WHEN MATCHED THEN
+            UPDATE SET last_value = c.last_value + 1
+        WHEN NOT MATCHED THEN
+            INSERT (prefix, last_value) VALUES (s.prefix, s.issued + 1)
+        OUTPUT INSERTED.last_value;
+    """, prefix, f"{prefix}-%")
+    return cursor.fetchone()[0]
@@ -1,10 +1,19 @@
 """
 Batch operations for stock movements
-Implements all-or-nothing transactional batch processing
+Implements all-or-nothing transactional batch processing and
+savepoint-based partial success (all_or_nothing=False)
 """
 import json
-from typing import List, Tuple
-from fastapi import HTTPException
+from typing import Iterator, List, Tuple
+
+from database import chunked, placeholders
+
+# Lines posted under one savepoint in partial-success mode
+SAVEPOINT_CHUNK_SIZE = 100
+
+class BatchItemError(Exception):
+    """Line rejected by validation (nothing was written for it)"""
+    pass
 
 def round_quantity(quantity: float, precision: int) -> float:
     """Round quantity based on precision"""
@@ -12,15 +21,88 @@ def round_quantity(quantity: float, precision: int) -> float:
         return float(int(round(quantity)))
     return round(quantity, precision)
 
-def process_batch_receipt(conn, batch_operation, get_nomenclature_precision_func, get_current_balance_locked_func, update_balance_func) -> Tuple[List[dict], List[dict]]:
+def item_idempotency_key(batch_operation, idx: int) -> str:
+    """Idempotency key of a single batch line"""
+    return f"{batch_operation.idempotency_key}-item-{idx}"
+
+def error_result(item, message: str) -> dict:
+    return {
+        "nomenclature_id": item.nomenclature_id,
+        "status": "error",
+        "message": message,
+        "balance_after": None
+    }
+
+def post_batch_item(conn, batch_operation, idx, item, operation_type, get_nomenclature_precision_func, get_current_balance_locked_func, update_balance_func) -> dict:
     """
-    Process batch receipt operation
-    Returns: (successful_results, failed_results)
+    Post one batch line (movement + balance)
+    Raises BatchItemError for validation failures, other exceptions for DB errors
     """
     cursor = conn.cursor()
-    successful = []
-    failed = []
-    
+
+    # Get precision
+    precision = get_nomenclature_precision_func(conn, item.nomenclature_id)
+    quantity = round_quantity(item.quantity, precision)
+
+    if quantity <= 0:
+        raise BatchItemError("Кількість має бути більше нуля")
+
+    # Get current balance WITH LOCK (prevents race conditions!)
+    current_balance = get_current_balance_locked_func(conn, item.nomenclature_id)
+
+    if operation_type == 'withdrawal':
+        # Check if withdrawal is possible
+        if current_balance < quantity:
+            cursor.execute(
+                "SELECT name, unit FROM nomenclature WHERE id = ?",
+                (item.nomenclature_id,)
+            )
+            nom_row = cursor.fetchone()
+            raise BatchItemError(
+                f"Недостатньо товару. Доступно: {current_balance} {nom_row[1]}, запитано: {quantity} {nom_row[1]}"
+            )
+        new_balance = round_quantity(current_balance - quantity, precision)
+    else:
+        new_balance = round_quantity(current_balance + quantity, precision)
+
+    # Insert movement
+    metadata = item.metadata or {}
+    metadata['batch_key'] = batch_operation.idempotency_key
+    metadata['batch_index'] = idx
+    metadata_json = json.dumps(metadata)
+
+    cursor.execute(
+        """INSERT INTO stock_movements
+           (nomenclature_id, operation_type, quantity, balance_after, price_per_unit,
+            source_operation_type, source_operation_id, idempotency_key, metadata)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (item.nomenclature_id, operation_type, quantity, new_balance, item.price_per_unit,
+         batch_operation.source_operation_type, batch_operation.source_operation_id,
+         item_idempotency_key(batch_operation, idx), metadata_json)
+    )
+
+    # Update balance (priced receipts move the average cost)
+    received = quantity if operation_type == 'receipt' else 0
+    update_balance_func(conn, item.nomenclature_id, new_balance, received, item.price_per_unit)
+
+    return {
+        "nomenclature_id": item.nomenclature_id,
+        "status": "success",
+        "message": "Операція виконана успішно",
+        "balance_after": new_balance
+    }
+
+def iter_batch(conn, batch_operation, operation_type, get_nomenclature_precision_func, get_current_balance_locked_func, update_balance_func,
+               commit_chunks: bool = False) -> Iterator[Tuple[int, dict]]:
+    """
+    Process batch receipt/withdrawal operation, yielding (line_index, result)
+    as lines are posted. With all_or_nothing=True the first failure raises
+    and the caller rolls back everything yielded so far.
+    commit_chunks: partial mode commits each chunk before yielding its results.
+    """
+    cursor = conn.cursor()
+    funcs = (get_nomenclature_precision_func, get_current_balance_locked_func, update_balance_func)
+
     # Check idempotency for entire batch
     cursor.execute(
         "SELECT id FROM stock_movements WHERE idempotency_key = ?",
@@ -28,214 +110,126 @@ def process_batch_receipt(conn, batch_operation, get_nomenclature_precision_func
     )
     if cursor.fetchone():
         # Batch already processed
-        for item in batch_operation.operations:
-            successful.append({
+        for idx, item in enumerate(batch_operation.operations):
+            yield idx, {
                 "nomenclature_id": item.nomenclature_id,
                 "status": "already_processed",
                 "message": "Операція вже оброблена"
-            })
-        return successful, failed
-    
-    # Process each operation
+            }
+        return
+
+    if not batch_operation.all_or_nothing:
+        yield from iter_batch_partial(conn, batch_operation, operation_type, *funcs, commit_chunks=commit_chunks)
+        return
+
     for idx, item in enumerate(batch_operation.operations):
         try:
-            # Get precision
-            precision = get_nomenclature_precision_func(conn, item.nomenclature_id)
-            quantity = round_quantity(item.quantity, precision)
-            
-            if quantity <= 0:
-                failed.append({
-                    "nomenclature_id": item.nomenclature_id,
-                    "status": "error",
-                    "message": "Кількість має бути більше нуля",
-                    "balance_after": None
-                })
-                if batch_operation.all_or_nothing:
-                    raise Exception(f"Validation error for item {idx}: quantity must be positive")
-                continue
-            
-            # Get current balance WITH LOCK
-            current_balance = get_current_balance_locked_func(conn, item.nomenclature_id)
-            new_balance = round_quantity(current_balance + quantity, precision)
-            
-            # Create unique idempotency key for this item
-            item_key = f"{batch_operation.idempotency_key}-item-{idx}"
-            
-            # Insert movement
-            metadata = item.metadata or {}
-            metadata['batch_key'] = batch_operation.idempotency_key
-            metadata['batch_index'] = idx
-            metadata_json = json.dumps(metadata)
-            
-            cursor.execute(
-                """INSERT INTO stock_movements 
-                   (nomenclature_id, operation_type, quantity, balance_after, price_per_unit,
-                    source_operation_type, source_operation_id, idempotency_key, metadata)
-                   VALUES (?, 'receipt', ?, ?, ?, ?, ?, ?, ?)""",
-                (item.nomenclature_id, quantity, new_balance, item.price_per_unit,
-                 batch_operation.source_operation_type, batch_operation.source_operation_id,
-                 item_key, metadata_json)
-            )
-            
-            # Update balance
-            update_balance_func(conn, item.nomenclature_id, new_balance)
-            
-            successful.append({
-                "nomenclature_id": item.nomenclature_id,
-                "status": "success",
-                "message": "Операція виконана успішно",
-                "balance_after": new_balance
-            })
-            
+            result = post_batch_item(conn, batch_operation, idx, item, operation_type, *funcs)
         except Exception as e:
-            error_msg = str(e)
-            failed.append({
-                "nomenclature_id": item.nomenclature_id,
-                "status": "error",
-                "message": error_msg,
-                "balance_after": None
-            })
-            
-            if batch_operation.all_or_nothing:
-                # Rollback entire batch
-                raise Exception(f"Batch failed at item {idx}: {error_msg}")
-    
-    # If we're here and all_or_nothing=True, all operations succeeded
-    # Create master record for the batch
-    if batch_operation.all_or_nothing and not failed:
+            # Rollback entire batch
+            raise Exception(f"Batch failed at item {idx}: {e}")
+        yield idx, result
+
+    # All operations succeeded - create master record for the batch
+    cursor.execute(
+        """INSERT INTO stock_movements
+           (nomenclature_id, operation_type, quantity, balance_after,
+            source_operation_type, source_operation_id, idempotency_key, metadata)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        (batch_operation.operations[0].nomenclature_id, f"batch_{operation_type}", 0, 0,
+         batch_operation.source_operation_type, batch_operation.source_operation_id,
+         batch_operation.idempotency_key, json.dumps({"batch_size": len(batch_operation.operations)}))
+    )
+
+def iter_batch_partial(conn, batch_operation, operation_type, get_nomenclature_precision_func, get_current_balance_locked_func, update_balance_func,
+                       commit_chunks: bool = False) -> Iterator[Tuple[int, dict]]:
+    """
+    Partial-success mode: lines are posted in chunks under a savepoint.
+    A DB error rolls back only its chunk, which is then replayed line by line
+    under per-line savepoints, so only the failing lines are dropped.
+    Lines are idempotent by their own key, so a retry posts only what failed.
+    Results are yielded once their chunk is settled.
+    """
+    cursor = conn.cursor()
+    funcs = (get_nomenclature_precision_func, get_current_balance_locked_func, update_balance_func)
+    operations = batch_operation.operations
+
+    # Lines already posted by a previous attempt
+    processed_keys = set()
+    for keys in chunked([item_idempotency_key(batch_operation, idx) for idx in range(len(operations))]):
         cursor.execute(
-            """INSERT INTO stock_movements 
-               (nomenclature_id, operation_type, quantity, balance_after, 
-                source_operation_type, source_operation_id, idempotency_key, metadata)
-               VALUES (?, 'batch_receipt', ?, ?, ?, ?, ?, ?)""",
-            (batch_operation.operations[0].nomenclature_id, 0, 0,
-             batch_operation.source_operation_type, batch_operation.source_operation_id,
-             batch_operation.idempotency_key, json.dumps({"batch_size": len(batch_operation.operations)}))
+            f"SELECT idempotency_key FROM stock_movements WHERE idempotency_key IN ({placeholders(len(keys))})",
+            keys
         )
-    
+        processed_keys.update(row[0] for row in cursor.fetchall())
+
+    def post_line(idx, item):
+        if item_idempotency_key(batch_operation, idx) in processed_keys:
+            return {
+                "nomenclature_id": item.nomenclature_id,
+                "status": "already_processed",
+                "message": "Операція вже оброблена"
+            }
+        try:
+            return post_batch_item(conn, batch_operation, idx, item, operation_type, *funcs)
+        except BatchItemError as e:
+            return error_result(item, str(e))
+
+    for chunk_start in range(0, len(operations), SAVEPOINT_CHUNK_SIZE):
+        chunk = list(enumerate(operations[chunk_start:chunk_start + SAVEPOINT_CHUNK_SIZE], start=chunk_start))
+        chunk_savepoint = f"batch_chunk_{chunk_start}"
+
+        cursor.execute(f"SAVE TRANSACTION {chunk_savepoint}")
+        try:
+            chunk_results = [(idx, post_line(idx, item)) for idx, item in chunk]
+        except Exception:
+            cursor.execute(f"ROLLBACK TRANSACTION {chunk_savepoint}")
+
+            # Replay the chunk line by line to isolate the failing lines
+            chunk_results = []
+            for idx, item in chunk:
+                line_savepoint = f"batch_line_{idx}"
+                cursor.execute(f"SAVE TRANSACTION {line_savepoint}")
+                try:
+                    chunk_results.append((idx, post_line(idx, item)))
+                except Exception as e:
+                    cursor.execute(f"ROLLBACK TRANSACTION {line_savepoint}")
+                    chunk_results.append((idx, error_result(item, str(e))))
+
+        if commit_chunks:
+            conn.commit()
+        yield from chunk_results
+
+def process_batch(conn, batch_operation, operation_type, get_nomenclature_precision_func, get_current_balance_locked_func, update_balance_func) -> Tuple[List[dict], List[dict]]:
+    """
+    Process batch receipt/withdrawal operation
+    Returns: (successful_results, failed_results)
+    """
+    successful = []
+    failed = []
+    for _, result in iter_batch(conn, batch_operation, operation_type,
+                                get_nomenclature_precision_func, get_current_balance_locked_func,
+                                update_balance_func):
+        (failed if result["status"] == "error" else successful).append(result)
     return successful, failed
 
+def process_batch_receipt(conn, batch_operation, get_nomenclature_precision_func, get_current_balance_locked_func, update_balance_func) -> Tuple[List[dict], List[dict]]:
+    """
+    Process batch receipt operation
+    Returns: (successful_results, failed_results)
+    """
+    return process_batch(
+        conn, batch_operation, 'receipt',
+        get_nomenclature_precision_func, get_current_balance_locked_func, update_balance_func
+    )
+
 
 def process_batch_withdrawal(conn, batch_operation, get_nomenclature_precision_func, get_current_balance_locked_func, update_balance_func) -> Tuple[List[dict], List[dict]]:
     """
     Process batch withdrawal operation
     Returns: (successful_results, failed_results)
     """
-    cursor = conn.cursor()
-    successful = []
-    failed = []
-    
-    # Check idempotency for entire batch
-    cursor.execute(
-        "SELECT id FROM stock_movements WHERE idempotency_key = ?",
-        (batch_operation.idempotency_key,)
+    return process_batch(
+        conn, batch_operation, 'withdrawal',
+        get_nomenclature_precision_func, get_current_balance_locked_func, update_balance_func
     )
-    if cursor.fetchone():
-        # Batch already processed
-        for item in batch_operation.operations:
-            successful.append({
-                "nomenclature_id": item.nomenclature_id,
-                "status": "already_processed",
-                "message": "Операція вже оброблена"
-            })
-        return successful, failed
-    
-    # Process each operation
-    for idx, item in enumerate(batch_operation.operations):
-        try:
-            # Get precision
-            precision = get_nomenclature_precision_func(conn, item.nomenclature_id)
-            quantity = round_quantity(item.quantity, precision)
-            
-            if quantity <= 0:
-                failed.append({
-                    "nomenclature_id": item.nomenclature_id,
-                    "status": "error",
-                    "message": "Кількість має бути більше нуля",
-                    "balance_after": None
-                })
-                if batch_operation.all_or_nothing:
-                    raise Exception(f"Validation error for item {idx}: quantity must be positive")
-                continue
-            
-            # Get current balance WITH LOCK (prevents race conditions!)
-            current_balance = get_current_balance_locked_func(conn, item.nomenclature_id)
-            
-            # Check if withdrawal is possible
-            if current_balance < quantity:
-                cursor.execute(
-                    "SELECT name, unit FROM nomenclature WHERE id = ?",
-                    (item.nomenclature_id,)
-                )
-                nom_row = cursor.fetchone()
-                error_msg = f"Недостатньо товару. Доступно: {current_balance} {nom_row[1]}, запитано: {quantity} {nom_row[1]}"
-                
-                failed.append({
-                    "nomenclature_id": item.nomenclature_id,
-                    "status": "error",
-                    "message": error_msg,
-                    "balance_after": None
-                })
-                
-                if batch_operation.all_or_nothing:
-                    raise Exception(f"Insufficient stock for item {idx}: {error_msg}")
-                continue
-            
-            new_balance = round_quantity(current_balance - quantity, precision)
-            
-            # Create unique idempotency key for this item
-            item_key = f"{batch_operation.idempotency_key}-item-{idx}"
-            
-            # Insert movement
-            metadata = item.metadata or {}
-            metadata['batch_key'] = batch_operation.idempotency_key
-            metadata['batch_index'] = idx
-            metadata_json = json.dumps(metadata)
-            
-            cursor.execute(
-                """INSERT INTO stock_movements 
-                   (nomenclature_id, operation_type, quantity, balance_after, price_per_unit,
-                    source_operation_type, source_operation_id, idempotency_key, metadata)
-                   VALUES (?, 'withdrawal', ?, ?, ?, ?, ?, ?, ?)""",
-                (item.nomenclature_id, quantity, new_balance, item.price_per_unit,
-                 batch_operation.source_operation_type, batch_operation.source_operation_id,
-                 item_key, metadata_json)
-            )
-            
-            # Update balance
-            update_balance_func(conn, item.nomenclature_id, new_balance)
-            
-            successful.append({
-                "nomenclature_id": item.nomenclature_id,
-                "status": "success",
-                "message": "Операція виконана успішно",
-                "balance_after": new_balance
-            })
-            
-        except Exception as e:
-            error_msg = str(e)
-            failed.append({
-                "nomenclature_id": item.nomenclature_id,
-                "status": "error",
-                "message": error_msg,
-                "balance_after": None
-            })
-            
-            if batch_operation.all_or_nothing:
-                # Rollback entire batch
-                raise Exception(f"Batch failed at item {idx}: {error_msg}")
-    
-    # If we're here and all_or_nothing=True, all operations succeeded
-    # Create master record for the batch
-    if batch_operation.all_or_nothing and not failed:
-        cursor.execute(
-            """INSERT INTO stock_movements 
-               (nomenclature_id, operation_type, quantity, balance_after,
-                source_operation_type, source_operation_id, idempotency_key, metadata)
-               VALUES (?, 'batch_withdrawal', ?, ?, ?, ?, ?, ?)""",
-            (batch_operation.operations[0].nomenclature_id, 0, 0,
-             batch_operation.source_operation_type, batch_operation.source_operation_id,
-             batch_operation.idempotency_key, json.dumps({"batch_size": len(batch_operation.operations)}))
-        )
-    
-    return successful, failed
@@ -0,0 +1,151 @@
+"""
+Cold start bundle for clients (/api/bootstrap)
+Reference data (nomenclature, recipes with steps/spices/ingredients,
+packaging recipes with materials) is serialized once per data version and
+kept in memory; current balances are read on every request over the same
+connection, together with a delta-sync token.
+"""
+import json
+import threading
+from typing import Optional
+
+from fastapi.encoders import jsonable_encoder
+
+from database import get_db_connection
+from recipe_cache import recipe_catalog
+from versioning import NOMENCLATURE, RECIPES, PACKAGING_RECIPES, etag_for
+
+REFERENCE_FAMILIES = (NOMENCLATURE, RECIPES, PACKAGING_RECIPES)
+
+_reference = {"version": None, "body": None}
+_lock = threading.Lock()
+
+def to_json(content) -> bytes:
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def load_nomenclature(cursor) -> list:
+    cursor.execute(
+        "SELECT id, name, category, unit, precision_digits, created_at, updated_at FROM nomenclature ORDER BY category, name"
+    )
+    return [
+        {
+            "id": row[0],
+            "name": row[1],
+            "category": row[2],
+            "unit": row[3],
+            "precision_digits": row[4],
+            "created_at": row[5],
+            "updated_at": row[6]
+        }
+        for row in cursor.fetchall()
+    ]
+
+def load_recipes(cursor) -> list:
+    """Recipes with steps, spices and ingredients (compiled recipe cache)"""
+    return [recipe.as_dict() for recipe in recipe_catalog(cursor).recipes.values()]
+
+def load_packaging_recipes(cursor) -> list:
+    """Active packaging recipes with material norms"""
+    cursor.execute("""
+        SELECT
+            pr.id, pr.source_product_id, pr.target_product_id,
+            pr.packaging_type, pr.target_weight_grams, pr.is_active, pr.notes,
+            n1.name as source_name, n2.name as target_name
+        FROM packaging_recipes pr
+        JOIN nomenclature n1 ON pr.source_product_id = n1.id
+        JOIN nomenclature n2 ON pr.target_product_id = n2.id
+        WHERE pr.is_active = 1
+        ORDER BY n1.name, pr.packaging_type, pr.target_weight_grams
+    """)
+    recipes = [
+        {
+            "id": row.id,
+            "source_product_id": row.source_product_id,
+            "source_product_name": row.source_name,
+            "target_product_id": row.target_product_id,
+            "target_product_name": row.target_name,
+            "packaging_type": row.packaging_type,
+            "target_weight_grams": row.target_weight_grams,
+            "is_active": bool(row.is_active),
+            "materials": [],
+            "notes": row.notes
+        }
+        for row in cursor.fetchall()
+    ]
+    by_id = {recipe["id"]: recipe for recipe in recipes}
+
+    cursor.execute("""
+        SELECT
+            prm.recipe_id, prm.material_id, prm.quantity_per_unit, prm.rounding_precision,
+            prm.material_type, n.name as material_name
+        FROM packaging_recipe_materials prm
+        JOIN nomenclature n ON prm.material_id = n.id
+    """)
+    for row in cursor.fetchall():
+        if row.recipe_id in by_id:
+            by_id[row.recipe_id]["materials"].append({
+                "material_id": row.material_id,
+                "material_name": row.material_name,
+                "quantity_per_unit": float(row.quantity_per_unit),
+                "rounding_precision": float(row.rounding_precision) if row.rounding_precision else None,
+                "material_type": row.material_type
+            })
+
+    return recipes
+
+def load_balances(cursor) -> tuple:
+    """(delta-sync token for /api/stock/balances/changes, balances)"""
+    cursor.execute("SELECT CAST(MIN_ACTIVE_ROWVERSION() AS BIGINT)")
+    token = cursor.fetchone()[0]
+    cursor.execute("""
+        SELECT
+            n.id, n.name, n.category, n.unit,
+            COALESCE(sb.quantity, 0) as quantity,
+            COALESCE(sb.last_updated, n.created_at) as last_updated
+        FROM nomenclature n
+        LEFT JOIN stock_balances sb ON n.id = sb.nomenclature_id
+        ORDER BY n.category, n.name
+    """)
+    balances = [
+        {
+            "nomenclature_id": row[0],
+            "nomenclature_name": row[1],
+            "category": row[2],
+            "unit": row[3],
+            "quantity": float(row[4]),
+            "last_updated": row[5]
+        }
+        for row in cursor.fetchall()
+    ]
+    return str(token), balances
+
+def reference_body(cursor, version: str) -> bytes:
+    """Serialized reference data for the version, rebuilt only when the version changed"""
+    with _lock:
+        if _reference["version"] != version:
+            _reference["body"] = to_json({
+                "nomenclature": load_nomenclature(cursor),
+                "recipes": load_recipes(cursor),
+                "packaging_recipes": load_packaging_recipes(cursor)
+            })
+            _reference["version"] = version
+        return _reference["body"]
+
+def build_bootstrap(reference_version: Optional[str] = None) -> bytes:
+    """
+    JSON bundle: reference_version, balances_token, reference, balances
+    reference is null when the client already holds reference_version
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        version = etag_for(*REFERENCE_FAMILIES)
+        reference = b"null" if reference_version == version else reference_body(cursor, version)
+        token, balances = load_balances(cursor)
+
+    return b"".join((
+        b'{"reference_version":', to_json(version),
+        b',"balances_token":', to_json(token),
+        b',"reference":', reference,
+        b',"balances":', to_json(balances),
+        b"}"
+    ))
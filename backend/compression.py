@@ -0,0 +1,166 @@
+"""
+Response compression for all routes
+Negotiated br|gzip for text-like responses of at least COMPRESSION_MIN_BYTES.
+Smaller bodies (typical posting responses) go out as is: compressing them
+costs more than it saves. NDJSON streams are compressed record by record;
+Server-Sent Events and responses that already carry Content-Encoding
+(the CODEC_PATHS of payload_codecs) are passed through.
+Bytes before/after compression are counted per route.
+"""
+import os
+import threading
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from payload_codecs import Compressor, media_type, negotiate_encoding
+from streaming import NDJSON_MEDIA_TYPE
+
+MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+
+COMPRESSIBLE_MEDIA_TYPES = (
+    "application/json",
+    NDJSON_MEDIA_TYPE,
+    "application/msgpack",
+    "application/javascript",
+    "application/xml",
+)
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+def compressible(content_type: str) -> bool:
+    value = media_type(content_type)
+    if value == "text/event-stream":
+        return False
+    return value.startswith("text/") or value in COMPRESSIBLE_MEDIA_TYPES
+
+def route_name(scope) -> str:
+    """Endpoint function name once routed, the raw path otherwise"""
+    endpoint = scope.get("endpoint")
+    return getattr(endpoint, "__name__", None) or scope["path"]
+
+def record(route: str, encoding, bytes_in: int, bytes_out: int):
+    with _stats_lock:
+        entry = _stats.setdefault(route, {
+            "responses": 0, "compressed": 0, "bytes_in": 0, "bytes_out": 0, "encodings": {}
+        })
+        entry["responses"] += 1
+        if encoding:
+            entry["compressed"] += 1
+            entry["bytes_in"] += bytes_in
+            entry["bytes_out"] += bytes_out
+            entry["encodings"][encoding] = entry["encodings"].get(encoding, 0) + 1
+
+def compression_stats() -> list:
+    with _stats_lock:
+        items = [(route, dict(entry, encodings=dict(entry["encodings"]))) for route, entry in _stats.items()]
+    result = []
+    for route, entry in items:
+        saved = entry["bytes_in"] - entry["bytes_out"]
+        result.append({
+            "route": route,
+            **entry,
+            "bytes_saved": saved,
+            "ratio": round(entry["bytes_out"] / entry["bytes_in"], 4) if entry["bytes_in"] else None
+        })
+    return sorted(result, key=lambda item: item["bytes_saved"], reverse=True)
+
+class CompressingSender:
+    """
+    ASGI send wrapper
+    The start message is held until the body reaches min_bytes (or ends
+    below it), unless Content-Length already decides.
+    """
+
+    def __init__(self, send, scope, encoding, min_bytes: int):
+        self._send = send
+        self.scope = scope
+        self.encoding = encoding
+        self.min_bytes = min_bytes
+        self.start = None
+        self.buffer = b""
+        self.passthrough = False
+        self.compressor = None
+        self.streaming = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            await self.on_start(message)
+        elif message["type"] == "http.response.body" and not self.passthrough:
+            await self.on_body(message)
+        else:
+            await self._send(message)
+
+    async def on_start(self, message):
+        headers = MutableHeaders(raw=message["headers"])
+        if (
+            message["status"] in (204, 304)
+            or "content-encoding" in headers
+            or not compressible(headers.get("content-type"))
+        ):
+            self.passthrough = True
+            await self._send(message)
+            return
+
+        headers.add_vary_header("Accept-Encoding")
+        message = {**message, "headers": headers.raw}
+        length = headers.get("content-length")
+        if self.encoding is None or (length is not None and int(length) < self.min_bytes):
+            self.passthrough = True
+            record(route_name(self.scope), None, 0, 0)
+            await self._send(message)
+            return
+
+        self.start = message
+        self.streaming = media_type(headers.get("content-type")) == NDJSON_MEDIA_TYPE
+        if self.streaming:
+            await self.begin()
+
+    async def begin(self):
+        headers = MutableHeaders(raw=self.start["headers"])
+        if "content-length" in headers:
+            del headers["content-length"]
+        headers["content-encoding"] = self.encoding
+        self.compressor = Compressor(self.encoding)
+        await self._send({**self.start, "headers": headers.raw})
+
+    async def on_body(self, message):
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.compressor is None:
+            self.buffer += body
+            if more_body and len(self.buffer) < self.min_bytes:
+                return
+            body, self.buffer = self.buffer, b""
+            if not more_body and len(body) < self.min_bytes:
+                self.passthrough = True
+                record(route_name(self.scope), None, 0, 0)
+                await self._send(self.start)
+                await self._send({**message, "body": body})
+                return
+            await self.begin()
+
+        out = self.compressor.compress(body, flush=self.streaming, finish=not more_body)
+        self.bytes_in += len(body)
+        self.bytes_out += len(out)
+        if not more_body:
+            record(route_name(self.scope), self.encoding, self.bytes_in, self.bytes_out)
+        await self._send({**message, "body": out})
+
+class CompressionMiddleware:
+    def __init__(self, app, min_bytes: int = MIN_BYTES, preferred: tuple = ("br", "gzip")):
+        self.app = app
+        self.min_bytes = min_bytes
+        self.preferred = preferred
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding"), self.preferred)
+        sender = CompressingSender(send, scope, encoding, self.min_bytes)
+        await self.app(scope, receive, sender.send)
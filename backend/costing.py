@@ -0,0 +1,109 @@
+"""
+Batch cost rollup
+Materials taken for a production batch are valued at the item's current
+average cost when their movements are posted and added to
+batch_cost_lines (per nomenclature) and batch_costs (batch total), so
+costed batch lists read stored totals instead of scanning movements.
+complete_batch stores the cost per kg of finished product.
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from database import chunked, placeholders
+
+# Four parameters per row in the cost line MERGE (2100 parameters per statement at most)
+COST_ROWS = 500
+
+def unit_costs(cursor, nomenclature_ids: Iterable[int]) -> Dict[int, Optional[float]]:
+    """
+    Current moving average cost per unit stored on the balance (valuation);
+    None when the item has no priced receipt
+    """
+    ids = sorted(set(nomenclature_ids))
+    costs = {nomenclature_id: None for nomenclature_id in ids}
+    for chunk in chunked(ids):
+        cursor.execute(f"""
+            SELECT nomenclature_id, avg_cost
+            FROM stock_balances
+            WHERE nomenclature_id IN ({placeholders(len(chunk))})
+        """, chunk)
+        for row in cursor.fetchall():
+            costs[row[0]] = float(row[1]) if row[1] is not None else None
+    return costs
+
+def add_batch_costs(cursor, batch_id: int, lines: List[Tuple[int, float, Optional[float]]]):
+    """
+    Add (nomenclature_id, quantity, unit_cost) lines to the batch cost
+    Negative quantities return material (mix leftover); lines without a
+    unit cost are counted in uncosted_items.
+    """
+    totals = {}
+    for nomenclature_id, quantity, unit_cost in lines:
+        line = totals.setdefault(nomenclature_id, [0.0, 0.0, 0])
+        line[0] += quantity
+        if unit_cost is None:
+            line[2] += 1
+        else:
+            line[1] += quantity * unit_cost
+    if not totals:
+        return
+
+    rows = [(batch_id, nomenclature_id, quantity, cost) for nomenclature_id, (quantity, cost, _) in totals.items()]
+    for chunk in chunked(rows, COST_ROWS):
+        cursor.execute(f"""
+            MERGE batch_cost_lines WITH (HOLDLOCK) AS l
+            USING (VALUES {', '.join(['(?, ?, ?, ?)'] * len(chunk))})
+                AS d(batch_id, nomenclature_id, quantity, cost)
+            ON l.batch_id = d.batch_id AND l.nomenclature_id = d.nomenclature_id
+            WHEN MATCHED THEN
+                UPDATE SET quantity = l.quantity + d.quantity, cost = l.cost + d.cost
+            WHEN NOT MATCHED THEN
+                INSERT (batch_id, nomenclature_id, quantity, cost)
+                VALUES (d.batch_id, d.nomenclature_id, d.quantity, d.cost);
+        """, [value for row in chunk for value in row])
+
+    cursor.execute("""
+        MERGE batch_costs WITH (HOLDLOCK) AS c
+        USING (SELECT ? AS batch_id, ? AS material_cost, ? AS uncosted_items) AS d
+        ON c.batch_id = d.batch_id
+        WHEN MATCHED THEN
+            UPDATE SET material_cost = c.material_cost + d.material_cost,
+                       uncosted_items = c.uncosted_items + d.uncosted_items,
+                       updated_at = GETUTCDATE()
+        WHEN NOT MATCHED THEN
+            INSERT (batch_id, material_cost, uncosted_items, updated_at)
+            VALUES (d.batch_id, d.material_cost, d.uncosted_items, GETUTCDATE());
+    """, batch_id, sum(cost for _, cost, _ in totals.values()),
+        sum(uncosted for _, _, uncosted in totals.values()))
+
+def complete_batch_cost(cursor, batch_id: int, final_weight: float) -> Tuple[Optional[float], int]:
+    """
+    Store the final weight and cost per kg of finished product
+    Returns (cost per kg, uncosted items); the cost is None for a batch
+    without a cost row (started before costing).
+    """
+    cursor.execute("""
+        MERGE batch_costs WITH (HOLDLOCK) AS c
+        USING (SELECT ? AS batch_id, ? AS final_weight) AS d
+        ON c.batch_id = d.batch_id
+        WHEN MATCHED THEN
+            UPDATE SET final_weight = d.final_weight,
+                       cost_per_kg = c.material_cost / NULLIF(d.final_weight, 0),
+                       updated_at = GETUTCDATE()
+        WHEN NOT MATCHED THEN
+            INSERT (batch_id, material_cost, uncosted_items, final_weight, cost_per_kg, updated_at)
+            VALUES (d.batch_id, 0, 0, d.final_weight, NULL, GETUTCDATE())
+        OUTPUT INSERTED.cost_per_kg, INSERTED.uncosted_items;
+    """, batch_id, final_weight)
+    row = cursor.fetchone()
+    if not row:
+        return None, 0
+    return (float(row[0]) if row[0] is not None else None), row[1] or 0
+
+def cost_dict(row) -> dict:
+    """batch_costs columns selected as material_cost, uncosted_items, cost_per_kg, cost_updated_at"""
+    return {
+        'material_cost': round(float(row.material_cost), 2) if row.material_cost is not None else None,
+        'uncosted_items': row.uncosted_items or 0,
+        'cost_per_kg': round(float(row.cost_per_kg), 4) if row.cost_per_kg is not None else None,
+        'cost_updated_at': row.cost_updated_at.isoformat() if row.cost_updated_at else None
+    }
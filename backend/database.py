@@ -40,6 +40,18 @@ def get_db_connection():
         if conn:
             conn.close()
 
+# MS SQL accepts at most 2100 parameters per statement
+MAX_IN_PARAMS = 1000
+
+def chunked(items: list, size: int = MAX_IN_PARAMS):
+    """Split items into chunks that fit into one IN (...) list"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def placeholders(count: int) -> str:
+    """Parameter placeholders for an IN (...) list"""
+    return ', '.join('?' * count)
+
 def get_db_cursor(conn):
     """Get cursor from connection"""
     return conn.cursor()
@@ -124,6 +136,12 @@ def init_database():
         CREATE INDEX IX_stock_movements_date ON stock_movements(operation_date DESC)
         """)
         
+        # Index on source_operation_id for movements of one batch
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='IX_stock_movements_source' AND object_id = OBJECT_ID('stock_movements'))
+        CREATE INDEX IX_stock_movements_source ON stock_movements(source_operation_id)
+        """)
+        
         # Create stock_balances table
         cursor.execute("""
         IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='stock_balances' AND xtype='U')
@@ -135,6 +153,112 @@ def init_database():
         )
         """)
         
+        # Change sequence for delta sync (bumped by SQL Server on every row update)
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.columns 
+                      WHERE object_id = OBJECT_ID('stock_balances') 
+                      AND name = 'row_version')
+        BEGIN
+            ALTER TABLE stock_balances ADD row_version ROWVERSION
+        END
+        
+        IF NOT EXISTS (SELECT * FROM sys.columns 
+                      WHERE object_id = OBJECT_ID('nomenclature') 
+                      AND name = 'row_version')
+        BEGIN
+            ALTER TABLE nomenclature ADD row_version ROWVERSION
+        END
+        """)
+        
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='IX_stock_balances_row_version' AND object_id = OBJECT_ID('stock_balances'))
+        CREATE INDEX IX_stock_balances_row_version ON stock_balances(row_version)
+        """)
+        
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='IX_nomenclature_row_version' AND object_id = OBJECT_ID('nomenclature'))
+        CREATE INDEX IX_nomenclature_row_version ON nomenclature(row_version)
+        """)
+        
+        # Moving average cost and value on hand (see valuation.py)
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.columns 
+                      WHERE object_id = OBJECT_ID('stock_balances') 
+                      AND name = 'avg_cost')
+        BEGIN
+            ALTER TABLE stock_balances ADD avg_cost DECIMAL(18, 6) NULL
+        END
+        
+        IF NOT EXISTS (SELECT * FROM sys.columns 
+                      WHERE object_id = OBJECT_ID('stock_balances') 
+                      AND name = 'stock_value')
+        BEGIN
+            ALTER TABLE stock_balances ADD stock_value DECIMAL(18, 4) NOT NULL DEFAULT 0
+        END
+        """)
+        
+        # Valuation state after every balance change (no keys: written by OUTPUT INTO)
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='stock_cost_history' AND xtype='U')
+        CREATE TABLE stock_cost_history (
+            nomenclature_id INT NOT NULL,
+            quantity DECIMAL(18, 6) NOT NULL,
+            avg_cost DECIMAL(18, 6) NULL,
+            stock_value DECIMAL(18, 4) NOT NULL,
+            changed_at DATETIME2 NOT NULL
+        )
+        """)
+        
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='CIX_stock_cost_history' AND object_id = OBJECT_ID('stock_cost_history'))
+        CREATE CLUSTERED INDEX CIX_stock_cost_history ON stock_cost_history(nomenclature_id, changed_at)
+        """)
+        
+        # One-time backfill: average of priced receipts for balances without a cost yet,
+        # and a starting history row for items that have none
+        cursor.execute("""
+        UPDATE sb
+        SET avg_cost = r.avg_cost,
+            stock_value = CASE WHEN sb.quantity > 0 THEN sb.quantity * r.avg_cost ELSE 0 END
+        FROM stock_balances sb
+        JOIN (
+            SELECT nomenclature_id, SUM(quantity * price_per_unit) / SUM(quantity) AS avg_cost
+            FROM stock_movements
+            WHERE operation_type = 'receipt' AND price_per_unit IS NOT NULL AND quantity > 0
+            GROUP BY nomenclature_id
+        ) r ON r.nomenclature_id = sb.nomenclature_id
+        WHERE sb.avg_cost IS NULL
+        """)
+        
+        cursor.execute("""
+        INSERT INTO stock_cost_history (nomenclature_id, quantity, avg_cost, stock_value, changed_at)
+        SELECT sb.nomenclature_id, sb.quantity, sb.avg_cost, sb.stock_value, SYSUTCDATETIME()
+        FROM stock_balances sb
+        WHERE NOT EXISTS (SELECT 1 FROM stock_cost_history h WHERE h.nomenclature_id = sb.nomenclature_id)
+        """)
+        
+        # Create idempotency_responses table (original responses replayed on retries)
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='idempotency_responses' AND xtype='U')
+        CREATE TABLE idempotency_responses (
+            idempotency_key NVARCHAR(255) NOT NULL PRIMARY KEY,
+            endpoint NVARCHAR(100) NOT NULL,
+            request_fingerprint CHAR(64) NOT NULL,
+            status_code INT NOT NULL DEFAULT 200,
+            response_body VARBINARY(MAX) NOT NULL,
+            created_at DATETIME2 DEFAULT GETUTCDATE()
+        )
+        """)
+        
+        # Create batch_number_counters table (next batch number per prefix and day)
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='batch_number_counters' AND xtype='U')
+        CREATE TABLE batch_number_counters (
+            prefix NVARCHAR(100) NOT NULL PRIMARY KEY,
+            last_value INT NOT NULL
+        )
+        """)
+        
         # Create inventory_sessions table
         cursor.execute("""
         IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='inventory_sessions' AND xtype='U')
@@ -150,6 +274,51 @@ def init_database():
         )
         """)
         
+        # Ledger watermark captured when the inventory snapshot is taken
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.columns 
+                      WHERE object_id = OBJECT_ID('inventory_sessions') 
+                      AND name = 'snapshot_movement_id')
+        BEGIN
+            ALTER TABLE inventory_sessions ADD snapshot_movement_id INT
+        END
+        """)
+        
+        # Create inventory_snapshot_items table (frozen system quantities at session start)
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='inventory_snapshot_items' AND xtype='U')
+        CREATE TABLE inventory_snapshot_items (
+            session_id INT NOT NULL,
+            nomenclature_id INT NOT NULL,
+            system_quantity DECIMAL(18, 6) NOT NULL,
+            CONSTRAINT PK_inventory_snapshot_items PRIMARY KEY (session_id, nomenclature_id),
+            FOREIGN KEY (session_id) REFERENCES inventory_sessions(id) ON DELETE CASCADE,
+            FOREIGN KEY (nomenclature_id) REFERENCES nomenclature(id)
+        )
+        """)
+        
+        # Create inventory_count_lines table (scanner count lines appended during the session)
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='inventory_count_lines' AND xtype='U')
+        CREATE TABLE inventory_count_lines (
+            id INT IDENTITY(1,1) PRIMARY KEY,
+            session_id INT NOT NULL,
+            nomenclature_id INT NOT NULL,
+            quantity DECIMAL(18, 6) NOT NULL,
+            line_key NVARCHAR(255) NOT NULL,
+            device_id NVARCHAR(100),
+            created_at DATETIME2 DEFAULT GETUTCDATE(),
+            FOREIGN KEY (session_id) REFERENCES inventory_sessions(id) ON DELETE CASCADE,
+            FOREIGN KEY (nomenclature_id) REFERENCES nomenclature(id),
+            CONSTRAINT UQ_inventory_count_line UNIQUE(session_id, line_key)
+        )
+        """)
+        
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='IX_inventory_count_lines_item' AND object_id = OBJECT_ID('inventory_count_lines'))
+        CREATE INDEX IX_inventory_count_lines_item ON inventory_count_lines(session_id, nomenclature_id) INCLUDE (quantity)
+        """)
+        
         # Create inventory_items table
         cursor.execute("""
         IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='inventory_items' AND xtype='U')
@@ -255,6 +424,21 @@ def init_database():
         )
         """)
         
+        # Client key of batch creation (offline sync can refer to the batch by it)
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.columns 
+                      WHERE object_id = OBJECT_ID('batches') 
+                      AND name = 'idempotency_key')
+        BEGIN
+            ALTER TABLE batches ADD idempotency_key NVARCHAR(255)
+        END
+        """)
+        
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='UX_batches_idempotency_key' AND object_id = OBJECT_ID('batches'))
+        CREATE UNIQUE INDEX UX_batches_idempotency_key ON batches(idempotency_key) WHERE idempotency_key IS NOT NULL
+        """)
+        
         # Create batch_operations table
         cursor.execute("""
         IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='batch_operations' AND xtype='U')
@@ -315,6 +499,121 @@ def init_database():
         )
         """)
         
+        # Create batch cost tables (maintained as materials are posted to a batch)
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='batch_costs' AND xtype='U')
+        CREATE TABLE batch_costs (
+            batch_id INT PRIMARY KEY,
+            material_cost DECIMAL(18, 4) NOT NULL DEFAULT 0,
+            uncosted_items INT NOT NULL DEFAULT 0,
+            final_weight DECIMAL(18, 6),
+            cost_per_kg DECIMAL(18, 4),
+            updated_at DATETIME2 DEFAULT GETUTCDATE(),
+            FOREIGN KEY (batch_id) REFERENCES batches(id) ON DELETE CASCADE
+        )
+        """)
+        
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='batch_cost_lines' AND xtype='U')
+        CREATE TABLE batch_cost_lines (
+            batch_id INT NOT NULL,
+            nomenclature_id INT NOT NULL,
+            quantity DECIMAL(18, 6) NOT NULL DEFAULT 0,
+            cost DECIMAL(18, 4) NOT NULL DEFAULT 0,
+            PRIMARY KEY (batch_id, nomenclature_id),
+            FOREIGN KEY (batch_id) REFERENCES batches(id) ON DELETE CASCADE,
+            FOREIGN KEY (nomenclature_id) REFERENCES nomenclature(id)
+        )
+        """)
+        
+        # Yield statistics per recipe and day/month bucket (maintained at batch completion)
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='yield_stats' AND xtype='U')
+        BEGIN
+            CREATE TABLE yield_stats (
+                recipe_id INT NOT NULL,
+                period_type CHAR(1) NOT NULL,
+                period_start DATE NOT NULL,
+                batch_count INT NOT NULL,
+                input_weight FLOAT NOT NULL,
+                output_weight FLOAT NOT NULL,
+                mean_yield FLOAT NOT NULL,
+                m2_yield FLOAT NOT NULL,
+                min_yield FLOAT NOT NULL,
+                max_yield FLOAT NOT NULL,
+                below_range INT NOT NULL DEFAULT 0,
+                above_range INT NOT NULL DEFAULT 0,
+                updated_at DATETIME2 DEFAULT GETUTCDATE(),
+                PRIMARY KEY (recipe_id, period_type, period_start),
+                FOREIGN KEY (recipe_id) REFERENCES recipes(id) ON DELETE CASCADE
+            );
+            
+            CREATE TABLE yield_histogram (
+                recipe_id INT NOT NULL,
+                period_type CHAR(1) NOT NULL,
+                period_start DATE NOT NULL,
+                bucket SMALLINT NOT NULL,
+                batch_count INT NOT NULL,
+                PRIMARY KEY (recipe_id, period_type, period_start, bucket),
+                FOREIGN KEY (recipe_id) REFERENCES recipes(id) ON DELETE CASCADE
+            );
+            
+            -- One-time backfill from the batches completed so far
+            -- (histogram buckets match yield_stats.yield_bucket)
+            WITH y AS (
+                SELECT b.recipe_id, b.completed_at,
+                       CAST(b.initial_weight AS FLOAT) AS input_weight,
+                       CAST(b.final_weight AS FLOAT) AS output_weight,
+                       CAST(b.final_weight AS FLOAT) * 100.0 / CAST(b.initial_weight AS FLOAT) AS yield_percent,
+                       r.expected_yield_min, r.expected_yield_max
+                FROM batches b
+                JOIN recipes r ON b.recipe_id = r.id
+                WHERE b.status = 'completed' AND b.completed_at IS NOT NULL
+                  AND b.initial_weight > 0 AND b.final_weight IS NOT NULL
+            ),
+            p AS (
+                SELECT y.*, v.period_type, v.period_start
+                FROM y
+                CROSS APPLY (VALUES ('D', CAST(y.completed_at AS DATE)),
+                                    ('M', DATEFROMPARTS(YEAR(y.completed_at), MONTH(y.completed_at), 1)))
+                    AS v(period_type, period_start)
+            )
+            INSERT INTO yield_stats (recipe_id, period_type, period_start, batch_count, input_weight, output_weight,
+                                     mean_yield, m2_yield, min_yield, max_yield, below_range, above_range)
+            SELECT recipe_id, period_type, period_start, COUNT(*), SUM(input_weight), SUM(output_weight),
+                   AVG(yield_percent), COALESCE(VARP(yield_percent) * COUNT(*), 0),
+                   MIN(yield_percent), MAX(yield_percent),
+                   SUM(CASE WHEN yield_percent < expected_yield_min THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN yield_percent > expected_yield_max THEN 1 ELSE 0 END)
+            FROM p
+            GROUP BY recipe_id, period_type, period_start;
+            
+            INSERT INTO yield_histogram (recipe_id, period_type, period_start, bucket, batch_count)
+            SELECT b.recipe_id, v.period_type, v.period_start, h.bucket, COUNT(*)
+            FROM batches b
+            CROSS APPLY (VALUES ('D', CAST(b.completed_at AS DATE)),
+                                ('M', DATEFROMPARTS(YEAR(b.completed_at), MONTH(b.completed_at), 1)))
+                AS v(period_type, period_start)
+            CROSS APPLY (SELECT CAST(FLOOR(CAST(b.final_weight AS FLOAT) * 100.0
+                                           / CAST(b.initial_weight AS FLOAT) / 0.5) AS INT) AS raw) r
+            CROSS APPLY (SELECT CASE WHEN r.raw < 0 THEN 0 WHEN r.raw > 399 THEN 399 ELSE r.raw END AS bucket) h
+            WHERE b.status = 'completed' AND b.completed_at IS NOT NULL
+              AND b.initial_weight > 0 AND b.final_weight IS NOT NULL
+            GROUP BY b.recipe_id, v.period_type, v.period_start, h.bucket;
+        END
+        """)
+        
+        # Open batches and recent batches for analytics
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='IX_batches_status' AND object_id = OBJECT_ID('batches'))
+        CREATE INDEX IX_batches_status ON batches(status, started_at) INCLUDE (recipe_id)
+        """)
+        
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='IX_batches_started_at' AND object_id = OBJECT_ID('batches'))
+        CREATE INDEX IX_batches_started_at ON batches(started_at DESC)
+        """)
+        
         # ========== PACKAGING MODULE TABLES ==========
         
         # Create packaging_recipes table (нормы расхода материалов для фасовки)
@@ -380,6 +679,20 @@ def init_database():
         )
         """)
         
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.columns 
+                      WHERE object_id = OBJECT_ID('packaging_batches') 
+                      AND name = 'idempotency_key')
+        BEGIN
+            ALTER TABLE packaging_batches ADD idempotency_key NVARCHAR(255)
+        END
+        """)
+        
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='UX_packaging_batches_idempotency_key' AND object_id = OBJECT_ID('packaging_batches'))
+        CREATE UNIQUE INDEX UX_packaging_batches_idempotency_key ON packaging_batches(idempotency_key) WHERE idempotency_key IS NOT NULL
+        """)
+        
         # Create packaging_operations table (операции фасовки в рамках партии)
         cursor.execute("""
         IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='packaging_operations' AND xtype='U')
@@ -414,6 +727,26 @@ def init_database():
             FOREIGN KEY (movement_id) REFERENCES stock_movements(id)
         )
         """)
-        
+
+        # Change sequence of the recipe catalogs (ETags and the compiled recipe cache, see versioning)
+        for table in ("recipes", "recipe_steps", "recipe_spices", "recipe_ingredients",
+                      "packaging_recipes", "packaging_recipe_materials"):
+            cursor.execute(f"""
+            IF NOT EXISTS (SELECT * FROM sys.columns
+                          WHERE object_id = OBJECT_ID('{table}')
+                          AND name = 'row_version')
+            BEGIN
+                ALTER TABLE {table} ADD row_version ROWVERSION
+            END
+            """)
+
         conn.commit()
+
+        # Inventory snapshots are read under SNAPSHOT isolation; ALTER DATABASE needs autocommit
+        conn.autocommit = True
+        cursor.execute("""
+        IF (SELECT snapshot_isolation_state FROM sys.databases WHERE name = DB_NAME()) = 0
+            ALTER DATABASE CURRENT SET ALLOW_SNAPSHOT_ISOLATION ON
+        """)
+        conn.autocommit = False
         print("Database schema initialized successfully")
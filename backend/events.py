@@ -0,0 +1,124 @@
+"""
+In-process event bus for server push (Server-Sent Events)
+Posting code publishes balance deltas and batch state changes right after
+commit; GET /api/events fans them out to subscribed clients.
+Single-process by design: every subscriber lives in this server process.
+"""
+import asyncio
+import json
+import threading
+from typing import Iterable, Optional, Set
+
+# Event types (also SSE topics)
+BALANCE = "balance"
+BATCH = "batch"
+PACKAGING_BATCH = "packaging_batch"
+TOPICS = (BALANCE, BATCH, PACKAGING_BATCH)
+
+SUBSCRIBER_QUEUE_SIZE = 1000
+KEEPALIVE_SECONDS = 15
+
+class Subscription:
+    """One connected client with its filters"""
+
+    def __init__(self, loop, topics: Set[str], nomenclature_ids: Optional[Set[int]] = None,
+                 batch_id: Optional[int] = None, packaging_batch_id: Optional[int] = None):
+        self.loop = loop
+        self.topics = topics
+        self.nomenclature_ids = nomenclature_ids
+        self.batch_id = batch_id
+        self.packaging_batch_id = packaging_batch_id
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def matches(self, event: dict) -> bool:
+        event_type = event["type"]
+        if event_type not in self.topics:
+            return False
+        if event_type == BALANCE and self.nomenclature_ids is not None:
+            return event["nomenclature_id"] in self.nomenclature_ids
+        if event_type == BATCH and self.batch_id is not None:
+            return event["batch_id"] == self.batch_id
+        if event_type == PACKAGING_BATCH and self.packaging_batch_id is not None:
+            return event["batch_id"] == self.packaging_batch_id
+        return True
+
+    def offer(self, event: dict):
+        """Runs on the subscriber's loop; a slow client gets a resync instead of blocking posting"""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+_subscribers = set()
+_lock = threading.Lock()
+
+def subscribe(topics: Iterable[str], **filters) -> Subscription:
+    """Register a subscriber (must be called from the event loop)"""
+    subscription = Subscription(asyncio.get_running_loop(), set(topics), **filters)
+    with _lock:
+        _subscribers.add(subscription)
+    return subscription
+
+def unsubscribe(subscription: Subscription):
+    with _lock:
+        _subscribers.discard(subscription)
+
+def publish(event: dict):
+    """Fan out an event; safe to call from worker threads and from the loop"""
+    with _lock:
+        subscribers = list(_subscribers)
+    for subscription in subscribers:
+        if not subscription.matches(event):
+            continue
+        try:
+            subscription.loop.call_soon_threadsafe(subscription.offer, event)
+        except RuntimeError:
+            # Loop already closed
+            unsubscribe(subscription)
+
+def publish_balances(changes: Iterable[tuple]):
+    """
+    Publish balance changes after commit
+    changes: (nomenclature_id, quantity_after, delta); unknown values may be None
+    """
+    if not _subscribers:
+        return
+    for nomenclature_id, quantity, delta in changes:
+        publish({
+            "type": BALANCE,
+            "nomenclature_id": nomenclature_id,
+            "quantity": quantity,
+            "delta": delta
+        })
+
+def publish_batch_state(batch_id: int, status: str, **details):
+    """Publish production batch state change after commit"""
+    if _subscribers:
+        publish({"type": BATCH, "batch_id": batch_id, "status": status, **details})
+
+def publish_packaging_batch_state(batch_id: int, status: str, **details):
+    """Publish packaging batch state change after commit"""
+    if _subscribers:
+        publish({"type": PACKAGING_BATCH, "batch_id": batch_id, "status": status, **details})
+
+async def event_stream(subscription: Subscription):
+    """SSE byte stream for one subscriber"""
+    try:
+        yield b"retry: 3000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+
+            if subscription.overflowed:
+                # Events were dropped - client must reload its state
+                subscription.overflowed = False
+                yield b"event: resync\ndata: {}\n\n"
+
+            data = json.dumps(event, ensure_ascii=False, default=str)
+            yield f"event: {event['type']}\ndata: {data}\n\n".encode("utf-8")
+    finally:
+        unsubscribe(subscription)
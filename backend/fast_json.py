@@ -0,0 +1,103 @@
+"""
+Fast JSON path for list endpoints
+Rows are turned into plain dicts by an encoder compiled once per response
+model and column list, then serialized straight to bytes (orjson when
+installed). The output matches what FastAPI renders for the pydantic
+models: same field order, floats and ints by field annotation, ISO datetimes.
+"""
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Callable, Iterable, Optional, Union, get_args, get_origin
+
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_MEDIA_TYPE = "application/json"
+
+# Response headers that belong to the body and must not be copied
+BODY_HEADERS = ("content-length", "content-type")
+
+def _default(value):
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+def _to_float(value):
+    return None if value is None else float(value)
+
+def _to_int(value):
+    return None if value is None else int(value)
+
+# Field type -> converter applied to the column value (DECIMAL columns come back as Decimal)
+CONVERTERS = {float: "_to_float", int: "_to_int"}
+
+def _field_type(annotation):
+    """X for an X or Optional[X] annotation"""
+    if get_origin(annotation) is Union:
+        args = [arg for arg in get_args(annotation) if arg is not type(None)]
+        return args[0] if len(args) == 1 else None
+    return annotation
+
+class RowEncoder:
+    """
+    Compiled row -> dict conversion for a response model
+    columns: model field names in SELECT column order; model fields not
+    selected are emitted with their defaults.
+    """
+
+    def __init__(self, model, columns: tuple):
+        fields = model.model_fields
+        unknown = [name for name in columns if name not in fields]
+        if unknown:
+            raise ValueError(f"{model.__name__}: unknown fields {unknown}")
+        missing = [name for name, field in fields.items() if name not in columns and field.is_required()]
+        if missing:
+            raise ValueError(f"{model.__name__}: required fields not selected {missing}")
+
+        self.model = model
+        self.columns = columns
+        namespace = {"_to_float": _to_float, "_to_int": _to_int}
+        items = []
+        for name, field in fields.items():
+            if name in columns:
+                value = f"row[{columns.index(name)}]"
+                converter = CONVERTERS.get(_field_type(field.annotation))
+                if converter:
+                    value = f"{converter}({value})"
+            else:
+                namespace[f"_default_{name}"] = field.get_default(call_default_factory=True)
+                value = f"_default_{name}"
+            items.append(f"{name!r}: {value}")
+
+        source = "def encode(row):\n    return {" + ", ".join(items) + "}\n"
+        exec(compile(source, f"<RowEncoder {model.__name__}>", "exec"), namespace)
+        self.encode: Callable = namespace["encode"]
+
+    def encode_rows(self, rows: Iterable) -> list:
+        encode = self.encode
+        return [encode(row) for row in rows]
+
+    def dumps(self, rows: Iterable) -> bytes:
+        return dumps(self.encode_rows(rows))
+
+def json_response(body: bytes, response: Optional[Response] = None) -> Response:
+    """
+    Pre-serialized JSON body as a response (bypasses response_model)
+    Headers already set on the injected response (ETag etc.) are kept
+    """
+    headers = None
+    if response is not None:
+        headers = {name: value for name, value in response.headers.items() if name not in BODY_HEADERS}
+    return Response(content=body, media_type=JSON_MEDIA_TYPE, headers=headers)
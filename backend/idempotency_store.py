@@ -0,0 +1,123 @@
+"""
+Idempotent response replay
+A posting endpoint stores the serialized response together with a request
+fingerprint in the same transaction as the posting itself. A retry with
+the same key gets the original bytes back from memory or from one primary
+key lookup; the same key with a different request gets 409.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+
+from database import chunked, placeholders
+
+JSON_MEDIA_TYPE = "application/json"
+
+# Most recent stored responses kept in process memory
+CACHE_SIZE = 2048
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+def request_fingerprint(endpoint: str, payload) -> str:
+    """Hash of the endpoint and the canonical JSON of the request model"""
+    canonical = json.dumps(
+        jsonable_encoder(payload), sort_keys=True, ensure_ascii=False,
+        separators=(",", ":"), default=str
+    )
+    return hashlib.sha256(f"{endpoint}\n{canonical}".encode("utf-8")).hexdigest()
+
+def serialize_response(content) -> bytes:
+    """Same bytes FastAPI's JSONResponse would render"""
+    return json.dumps(
+        jsonable_encoder(content), ensure_ascii=False, allow_nan=False,
+        indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+def replay_entry(idempotency_key: str, fingerprint: str, entry: tuple) -> Response:
+    """Stored (fingerprint, status, body) as a response; 409 for a different request"""
+    stored_fingerprint, status_code, body = entry
+    if stored_fingerprint != fingerprint:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Конфлікт ідемпотентності: ключ {idempotency_key} вже використано з іншими параметрами"
+        )
+    return Response(content=body, status_code=status_code, media_type=JSON_MEDIA_TYPE)
+
+def _remember(idempotency_key: str, entry: tuple):
+    with _lock:
+        _cache[idempotency_key] = entry
+        _cache.move_to_end(idempotency_key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def lookup_response(conn, idempotency_key: str, fingerprint: str) -> Optional[Response]:
+    """
+    Stored response for the key, or None if the key was not used yet
+    Raises 409 if the key was used with a different request
+    """
+    with _lock:
+        entry = _cache.get(idempotency_key)
+    if entry is not None:
+        return replay_entry(idempotency_key, fingerprint, entry)
+
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT request_fingerprint, status_code, response_body FROM idempotency_responses WHERE idempotency_key = ?",
+        (idempotency_key,)
+    )
+    row = cursor.fetchone()
+    if not row:
+        return None
+
+    entry = (row[0], row[1], bytes(row[2]))
+    _remember(idempotency_key, entry)
+    return replay_entry(idempotency_key, fingerprint, entry)
+
+def lookup_entries(conn, idempotency_keys) -> Dict[str, tuple]:
+    """
+    Stored (fingerprint, status, body) entries of many keys: memory first,
+    the rest with one IN query per chunk; keys not used yet are left out
+    """
+    entries = {}
+    with _lock:
+        for key in idempotency_keys:
+            if key in _cache:
+                entries[key] = _cache[key]
+    missing = sorted(set(idempotency_keys) - set(entries))
+
+    cursor = conn.cursor()
+    for chunk in chunked(missing):
+        cursor.execute(
+            f"""SELECT idempotency_key, request_fingerprint, status_code, response_body
+                FROM idempotency_responses WHERE idempotency_key IN ({placeholders(len(chunk))})""",
+            chunk
+        )
+        for row in cursor.fetchall():
+            entries[row[0]] = (row[1], row[2], bytes(row[3]))
+            _remember(row[0], entries[row[0]])
+    return entries
+
+def store_response(conn, idempotency_key: str, endpoint: str, fingerprint: str, content, status_code: int = 200) -> Response:
+    """
+    Save the response in the caller's transaction and return it
+    Call remember_response() once the transaction is committed
+    """
+    body = serialize_response(content)
+    cursor = conn.cursor()
+    cursor.execute(
+        """INSERT INTO idempotency_responses
+           (idempotency_key, endpoint, request_fingerprint, status_code, response_body)
+           VALUES (?, ?, ?, ?, ?)""",
+        (idempotency_key, endpoint, fingerprint, status_code, body)
+    )
+    return Response(content=body, status_code=status_code, media_type=JSON_MEDIA_TYPE)
+
+def remember_response(idempotency_key: str, fingerprint: str, response: Response):
+    """Cache a committed response for in-memory replay"""
+    _remember(idempotency_key, (fingerprint, response.status_code, response.body))
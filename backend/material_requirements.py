@@ -0,0 +1,103 @@
+"""
+Material requirements engine
+Required ingredients, spices, salt, water, sugar and casings for one or
+more (recipe, initial weight) pairs, computed from the per-100 kg norms
+of the compiled recipes (recipe_cache) and compared with current
+balances in one joined query.
+"""
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from database import chunked, placeholders
+from recipe_cache import recipe_catalog
+
+def load_norms(cursor, recipe_ids: Iterable[int]) -> Dict[int, List[dict]]:
+    """
+    Norms per recipe from the compiled recipe cache:
+    {recipe_id: [{nomenclature_id, kind, per_100kg}]}
+    Casings carry capacity_kg (kg per unit) instead of per_100kg.
+    Ingredients come first, largest norm first (the main raw material).
+    """
+    catalog = recipe_catalog(cursor)
+    return {recipe_id: catalog.get(recipe_id).norms for recipe_id in set(recipe_ids)}
+
+def compute_requirements(norms: Dict[int, List[dict]], plan: Iterable[Tuple[int, float]],
+                         kinds: Optional[tuple] = None) -> Dict[int, dict]:
+    """Required quantities summed per nomenclature over the plan"""
+    required = {}
+    for recipe_id, initial_weight in plan:
+        for norm in norms.get(recipe_id, []):
+            if kinds and norm['kind'] not in kinds:
+                continue
+            if 'capacity_kg' in norm:
+                quantity = float(math.ceil(initial_weight / norm['capacity_kg']))
+            else:
+                quantity = initial_weight * norm['per_100kg'] / 100.0
+            line = required.setdefault(norm['nomenclature_id'], {'kinds': [], 'required': 0.0})
+            if norm['kind'] not in line['kinds']:
+                line['kinds'].append(norm['kind'])
+            line['required'] += quantity
+    return required
+
+def compare_with_balances(cursor, required: Dict[int, dict]) -> List[dict]:
+    """
+    Requirement lines with name, unit, available balance and shortage
+    (one nomenclature/stock_balances join per chunk of ids)
+    """
+    ids = list(required)
+    found = {}
+    for chunk in chunked(ids):
+        cursor.execute(f"""
+            SELECT n.id, n.name, n.unit, COALESCE(sb.quantity, 0) as quantity
+            FROM nomenclature n
+            LEFT JOIN stock_balances sb ON n.id = sb.nomenclature_id
+            WHERE n.id IN ({placeholders(len(chunk))})
+        """, chunk)
+        for row in cursor.fetchall():
+            found[row[0]] = row
+
+    lines = []
+    for nomenclature_id in ids:
+        row = found.get(nomenclature_id)
+        available = float(row[3]) if row else 0.0
+        quantity = round(required[nomenclature_id]['required'], 6)
+        lines.append({
+            'nomenclature_id': nomenclature_id,
+            'name': row[1] if row else None,
+            'unit': row[2] if row else '',
+            'kinds': required[nomenclature_id]['kinds'],
+            'required': quantity,
+            'available': available,
+            'shortage': round(max(quantity - available, 0.0), 6)
+        })
+    return lines
+
+def check_requirements(cursor, plan: Iterable[Tuple[int, float]], kinds: Optional[tuple] = None) -> List[dict]:
+    """Requirement lines for (recipe_id, initial_weight) pairs"""
+    plan = list(plan)
+    norms = load_norms(cursor, [recipe_id for recipe_id, _ in plan])
+    return compare_with_balances(cursor, compute_requirements(norms, plan, kinds))
+
+def check_quantities(cursor, quantities: Dict[int, float], kind: str) -> List[dict]:
+    """Requirement lines for quantities given directly (operator-entered amounts of the step kind)"""
+    required = {}
+    for nomenclature_id, quantity in quantities.items():
+        line = required.setdefault(nomenclature_id, {'kinds': [kind], 'required': 0.0})
+        line['required'] += quantity
+    return compare_with_balances(cursor, required)
+
+def shortages(lines: List[dict]) -> List[dict]:
+    return [line for line in lines if line['shortage'] > 0]
+
+def ensure_available(lines: List[dict], message: str = "Недостатньо матеріалів на складі"):
+    """Raise 400 listing every line that is short"""
+    short = shortages(lines)
+    if short:
+        details = "; ".join(
+            f"{line['name'] or line['nomenclature_id']}: потрібно {line['required']:.2f} {line['unit']}, "
+            f"доступно {line['available']:.2f} {line['unit']}"
+            for line in short
+        )
+        raise HTTPException(status_code=400, detail=f"{message}: {details}")
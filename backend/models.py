@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field
 from typing import Optional, List, Literal
-from datetime import datetime
+from datetime import date, datetime
 from decimal import Decimal
 
 class NomenclatureBase(BaseModel):
@@ -50,10 +50,18 @@ class StockBalance(BaseModel):
     quantity: float
     last_updated: datetime
 
+class StockBalanceChanges(BaseModel):
+    token: str  # pass back as ?since= on the next poll
+    full: bool  # True when the whole list was returned
+    items: List[StockBalance]
+
 class InventorySessionCreate(BaseModel):
     session_type: Literal["full", "partial"]
     idempotency_key: str
     metadata: Optional[dict] = None
+    # Scope of a partial inventory (ignored for full sessions)
+    nomenclature_ids: Optional[List[int]] = None
+    category: Optional[str] = None
 
 class InventoryItemCreate(BaseModel):
     nomenclature_id: int
@@ -70,11 +78,29 @@ class InventorySession(BaseModel):
 
 class InventoryComplete(BaseModel):
     session_id: int
-    items: List[InventoryItemCreate]
+    # Optional when the session was counted with scanner lines
+    items: List[InventoryItemCreate] = []
     idempotency_key: str
 
+class InventoryCountLine(BaseModel):
+    nomenclature_id: int
+    quantity: float
+    line_key: str  # unique per scan within the session
+
+class InventoryCountLines(BaseModel):
+    lines: List[InventoryCountLine]
+    device_id: Optional[str] = None
+
 class SyncOperation(BaseModel):
-    operation_type: Literal["receipt", "withdrawal", "inventory"]
+    operation_type: Literal[
+        "receipt", "withdrawal",
+        "inventory", "inventory_lines",
+        "batch_create", "batch_operation", "batch_mix", "batch_salting",
+        "batch_sugar", "batch_massage", "batch_stuff", "batch_complete",
+        "packaging_create", "packaging_operation", "packaging_complete"
+    ]
+    # Steps refer to a batch by batch_id or by batch_ref
+    # (idempotency key of the batch creation, possibly in the same sync)
     data: dict
     idempotency_key: str
     timestamp: datetime
@@ -137,6 +163,7 @@ class BatchCreate(BaseModel):
     trim_waste: Optional[float] = 0
     trim_returned: bool = False
     operator_notes: Optional[str] = None
+    idempotency_key: Optional[str] = None
 
 class BatchOperationCreate(BaseModel):
     step_id: int
@@ -169,6 +196,22 @@ class Batch(BaseModel):
     trim_returned: Optional[bool] = None
     operator_notes: Optional[str] = None
 
+class ProductionPlanItem(BaseModel):
+    recipe_id: int
+    initial_weight: float
+
+class FeasibilityCheck(BaseModel):
+    items: List[ProductionPlanItem]
+
+class PlannedBatches(BaseModel):
+    recipe_id: int
+    initial_weight: float  # per batch
+    batches: int = 1
+    planned_date: Optional[date] = None  # defaults to today
+
+class ProductionPlan(BaseModel):
+    items: List[PlannedBatches]
+
 class BatchComplete(BaseModel):
     final_weight: float
     notes: Optional[str] = None
@@ -2,12 +2,17 @@
 Packaging module API endpoints
 Модуль фасовки весовой готовой продукции
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
 from typing import List, Optional
 from datetime import datetime
 import json
 
-from database import get_db_connection
+from database import get_db_connection, chunked, placeholders
+from versioning import NOMENCLATURE, PACKAGING_RECIPES, check_not_modified
+from events import publish_balances, publish_packaging_batch_state
+from fast_json import RowEncoder, json_response
+from batch_numbers import next_number
+from valuation import post_balances
 from models import (
     PackagingRecipe, PackagingRecipeMaterial,
     PackagingBatchCreate, PackagingBatch, PackagingBatchComplete,
@@ -16,14 +21,31 @@ from models import (
 
 router = APIRouter(prefix="/api/packaging", tags=["packaging"])
 
+# Column order of the get_packaging_batches query
+PACKAGING_BATCH_ENCODER = RowEncoder(
+    PackagingBatch,
+    ("id", "batch_number", "recipe_id", "source_product_id", "target_product_id",
+     "status", "planned_quantity", "source_weight_taken",
+     "actual_packed_quantity", "actual_source_used", "waste_quantity",
+     "started_at", "completed_at", "operator_notes",
+     "source_product_name", "target_product_name",
+     "packaging_type", "target_weight_grams")
+)
+
 
 @router.get("/recipes", response_model=List[PackagingRecipe])
 async def get_packaging_recipes(
+    request: Request,
+    response: Response,
     source_product_id: Optional[int] = None,
     packaging_type: Optional[str] = None,
     active_only: bool = True
 ):
     """Получить список рецептов фасовки с нормами расхода материалов"""
+    not_modified = check_not_modified(request, response, PACKAGING_RECIPES, NOMENCLATURE)
+    if not_modified:
+        return not_modified
+    
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
@@ -53,33 +75,33 @@ async def get_packaging_recipes(
         query += " ORDER BY n1.name, pr.packaging_type, pr.target_weight_grams"
         
         cursor.execute(query, *params)
+        rows = cursor.fetchall()
         
-        recipes = []
-        for row in cursor.fetchall():
-            recipe_id = row.id
-            
-            # Получаем материалы для рецепта
-            cursor.execute("""
+        # Материалы всех рецептов одним запросом
+        materials_by_recipe = {}
+        for recipe_ids in chunked([row.id for row in rows]):
+            cursor.execute(f"""
                 SELECT 
-                    prm.material_id, prm.quantity_per_unit, prm.rounding_precision,
+                    prm.recipe_id, prm.material_id, prm.quantity_per_unit, prm.rounding_precision,
                     prm.material_type, n.name as material_name
                 FROM packaging_recipe_materials prm
                 JOIN nomenclature n ON prm.material_id = n.id
-                WHERE prm.recipe_id = ?
-            """, recipe_id)
+                WHERE prm.recipe_id IN ({placeholders(len(recipe_ids))})
+            """, *recipe_ids)
             
-            materials = []
             for mat_row in cursor.fetchall():
-                materials.append(PackagingRecipeMaterial(
+                materials_by_recipe.setdefault(mat_row.recipe_id, []).append(PackagingRecipeMaterial(
                     material_id=mat_row.material_id,
                     material_name=mat_row.material_name,
                     quantity_per_unit=float(mat_row.quantity_per_unit),
                     rounding_precision=float(mat_row.rounding_precision) if mat_row.rounding_precision else None,
                     material_type=mat_row.material_type
                 ))
-            
+        
+        recipes = []
+        for row in rows:
             recipes.append(PackagingRecipe(
-                id=recipe_id,
+                id=row.id,
                 source_product_id=row.source_product_id,
                 source_product_name=row.source_name,
                 target_product_id=row.target_product_id,
@@ -87,7 +109,7 @@ async def get_packaging_recipes(
                 packaging_type=row.packaging_type,
                 target_weight_grams=row.target_weight_grams,
                 is_active=bool(row.is_active),
-                materials=materials,
+                materials=materials_by_recipe.get(row.id, []),
                 notes=row.notes
             ))
         
@@ -102,7 +124,7 @@ async def create_packaging_batch(batch_data: PackagingBatchCreate):
         
         # Проверяем idempotency
         cursor.execute("""
-            SELECT id FROM packaging_batches WHERE batch_number = ?
+            SELECT id FROM packaging_batches WHERE idempotency_key = ?
         """, batch_data.idempotency_key)
         
         existing = cursor.fetchone()
@@ -142,31 +164,26 @@ async def create_packaging_batch(batch_data: PackagingBatchCreate):
         # Генерируем номер партии фасовки
         today = datetime.now().strftime("%d%m%Y")
         
-        # Получаем счетчик партий на сегодня для данного продукта
-        cursor.execute("""
-            SELECT COUNT(*) 
-            FROM packaging_batches 
-            WHERE batch_number LIKE ?
-        """, f"PKG-{recipe.source_product_id}-{today}-%")
-        
-        count = cursor.fetchone()[0]
-        batch_number = f"PKG-{recipe.source_product_id}-{today}-{count + 1:03d}"
+        # Следующий номер партии на сегодня для данного продукта
+        prefix = f"PKG-{recipe.source_product_id}-{today}"
+        batch_number = f"{prefix}-{next_number(cursor, prefix, 'packaging_batches'):03d}"
         
         # Создаем партию фасовки
         cursor.execute("""
             INSERT INTO packaging_batches (
                 batch_number, recipe_id, source_product_id, target_product_id,
                 status, planned_quantity, source_weight_taken,
-                operator_notes, started_at
+                operator_notes, started_at, idempotency_key
             )
-            VALUES (?, ?, ?, ?, 'in_progress', ?, ?, ?, GETUTCDATE())
+            VALUES (?, ?, ?, ?, 'in_progress', ?, ?, ?, GETUTCDATE(), ?)
         """, batch_number, batch_data.recipe_id, recipe.source_product_id,
             recipe.target_product_id, batch_data.planned_quantity,
-            batch_data.source_weight_taken, batch_data.notes)
+            batch_data.source_weight_taken, batch_data.notes, batch_data.idempotency_key)
         
         batch_id = int(cursor.execute("SELECT @@IDENTITY").fetchone()[0])
         
         conn.commit()
+        publish_packaging_batch_state(batch_id, 'in_progress', batch_number=batch_number)
         
         return await get_packaging_batch(batch_id)
 
@@ -212,31 +229,7 @@ async def get_packaging_batches(
             query = f"SELECT TOP {limit} * FROM ({query}) AS subquery ORDER BY started_at DESC"
         
         cursor.execute(query, *params)
-        
-        batches = []
-        for row in cursor.fetchall():
-            batches.append(PackagingBatch(
-                id=row.id,
-                batch_number=row.batch_number,
-                recipe_id=row.recipe_id,
-                source_product_id=row.source_product_id,
-                source_product_name=row.source_name,
-                target_product_id=row.target_product_id,
-                target_product_name=row.target_name,
-                packaging_type=row.packaging_type,
-                target_weight_grams=row.target_weight_grams,
-                status=row.status,
-                planned_quantity=row.planned_quantity,
-                source_weight_taken=float(row.source_weight_taken),
-                actual_packed_quantity=row.actual_packed_quantity,
-                actual_source_used=float(row.actual_source_used),
-                waste_quantity=float(row.waste_quantity),
-                started_at=row.started_at,
-                completed_at=row.completed_at,
-                operator_notes=row.operator_notes
-            ))
-        
-        return batches
+        return json_response(PACKAGING_BATCH_ENCODER.dumps(cursor.fetchall()))
 
 
 @router.get("/batches/{batch_id}", response_model=PackagingBatch)
@@ -347,6 +340,7 @@ async def record_packaging_operation(batch_id: int, operation_data: PackagingOpe
         operation_id = int(cursor.execute("SELECT @@IDENTITY").fetchone()[0])
         
         # Списываем материалы
+        balance_changes = []
         for material in operation_data.materials_used:
             material_id = material['material_id']
             quantity = material['quantity']
@@ -377,12 +371,9 @@ async def record_packaging_operation(batch_id: int, operation_data: PackagingOpe
             
             movement_id = int(cursor.execute("SELECT @@IDENTITY").fetchone()[0])
             
-            # Обновляем баланс
-            cursor.execute("""
-                UPDATE stock_balances
-                SET quantity = ?, last_updated = GETUTCDATE()
-                WHERE nomenclature_id = ?
-            """, new_balance, material_id)
+            # Обновляем баланс (стоимость по средней цене)
+            post_balances(cursor, [(material_id, new_balance, None)], absolute=True)
+            balance_changes.append((material_id, new_balance, -quantity))
             
             # Записываем расход материала
             cursor.execute("""
@@ -404,6 +395,11 @@ async def record_packaging_operation(batch_id: int, operation_data: PackagingOpe
             operation_data.waste_quantity, batch_id)
         
         conn.commit()
+        publish_balances(balance_changes)
+        publish_packaging_batch_state(
+            batch_id, batch.status, batch_number=batch.batch_number,
+            packed_quantity_added=operation_data.packed_quantity
+        )
         
         return {
             "message": "Операція записана успішно",
@@ -443,6 +439,7 @@ async def complete_packaging_batch(batch_id: int, completion: PackagingBatchComp
             completion.final_waste, completion.notes, batch_id)
         
         # Списываем весовой продукт (если еще не списан)
+        balance_changes = []
         source_withdrawal_key = f"packaging-source-{batch_id}-{completion.idempotency_key}"
         
         cursor.execute("""
@@ -475,12 +472,9 @@ async def complete_packaging_batch(batch_id: int, completion: PackagingBatchComp
                     'packed_quantity': completion.final_packed_quantity
                 }))
             
-            # Обновляем баланс
-            cursor.execute("""
-                UPDATE stock_balances
-                SET quantity = ?, last_updated = GETUTCDATE()
-                WHERE nomenclature_id = ?
-            """, new_balance, batch.source_product_id)
+            # Обновляем баланс (стоимость по средней цене)
+            post_balances(cursor, [(batch.source_product_id, new_balance, None)], absolute=True)
+            balance_changes.append((batch.source_product_id, new_balance, -completion.final_source_used))
         
         # Оприходуем фасованную продукцию
         receipt_key = f"packaging-receipt-{batch_id}-{completion.idempotency_key}"
@@ -516,19 +510,16 @@ async def complete_packaging_batch(batch_id: int, completion: PackagingBatchComp
                     'source_used': completion.final_source_used
                 }))
             
-            # Обновляем/создаем баланс
-            cursor.execute("""
-                IF EXISTS (SELECT 1 FROM stock_balances WHERE nomenclature_id = ?)
-                    UPDATE stock_balances
-                    SET quantity = ?, last_updated = GETUTCDATE()
-                    WHERE nomenclature_id = ?
-                ELSE
-                    INSERT INTO stock_balances (nomenclature_id, quantity, last_updated)
-                    VALUES (?, ?, GETUTCDATE())
-            """, batch.target_product_id, new_target_balance, batch.target_product_id,
-                batch.target_product_id, new_target_balance)
+            # Обновляем/создаем баланс (стоимость по средней цене)
+            post_balances(cursor, [(batch.target_product_id, new_target_balance, None)], absolute=True)
+            balance_changes.append((batch.target_product_id, new_target_balance, completion.final_packed_quantity))
         
         conn.commit()
+        publish_balances(balance_changes)
+        publish_packaging_batch_state(
+            batch_id, 'completed', batch_number=batch.batch_number,
+            packed_quantity=completion.final_packed_quantity
+        )
         
         return {
             "message": "Партію фасовки завершено",
@@ -0,0 +1,333 @@
+"""
+Negotiated payload codecs for sync, bulk, delta-sync and bootstrap endpoints
+Requests: Content-Encoding gzip|zstd is decompressed chunk by chunk before
+FastAPI parses the JSON body. Content-Type application/msgpack is not
+streamed: the body is unpacked once complete and re-serialized as JSON for
+FastAPI, so it is held about three times over (MAX_DECODED_BODY allows for that).
+Responses: Accept application/msgpack re-encodes JSON (NDJSON line by line),
+Accept-Encoding zstd|gzip compresses the stream (other bodies only from
+compression.MIN_BYTES on).
+msgpack, zstandard and brotli are optional: without them those codecs are not offered.
+"""
+import json
+import zlib
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from streaming import NDJSON_MEDIA_TYPE
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, "application/x-msgpack")
+
+# Routes with negotiated payloads
+CODEC_PATHS = (
+    "/api/sync/operations",
+    "/api/stock/receipt/bulk",
+    "/api/stock/withdrawal/bulk",
+    "/api/stock/balances/changes",
+    "/api/bootstrap",
+)
+
+# Upper bound of a decoded request body (guards against compression bombs
+# and bounds the copies a msgpack body goes through)
+MAX_DECODED_BODY = 16 * 1024 * 1024
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+BROTLI_QUALITY = 4
+
+class RequestDecodeError(Exception):
+    """Request body could not be decoded"""
+    pass
+
+def media_type(content_type: Optional[str]) -> str:
+    return (content_type or "").split(";")[0].strip().lower()
+
+def accepted_tokens(header_value: Optional[str]) -> set:
+    """Tokens of an Accept / Accept-Encoding header, except those with q=0"""
+    tokens = set()
+    for part in (header_value or "").split(","):
+        token, _, params = part.partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = params.replace(" ", "")
+        if q.startswith("q=") and q[2:] in ("0", "0.0", "0.00", "0.000"):
+            continue
+        tokens.add(token)
+    return tokens
+
+def request_encodings() -> tuple:
+    encodings = ("identity", "gzip", "x-gzip", "deflate")
+    return encodings + ("zstd",) if zstandard else encodings
+
+def negotiate_encoding(accept_encoding: Optional[str], preferred: tuple = ("zstd", "gzip")) -> Optional[str]:
+    """Best response encoding supported by both sides"""
+    tokens = accepted_tokens(accept_encoding)
+    for encoding in preferred:
+        if (encoding == "zstd" and zstandard is None) or (encoding == "br" and brotli is None):
+            continue
+        if encoding in tokens or "*" in tokens:
+            return encoding
+    return None
+
+class Decompressor:
+    def __init__(self, encoding: str):
+        if encoding in ("gzip", "x-gzip"):
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self._obj = zlib.decompressobj()
+        else:
+            self._obj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._obj.decompress(data) if data else b""
+
+    def flush(self) -> bytes:
+        return self._obj.flush() if hasattr(self._obj, "flush") else b""
+
+class Compressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._sync_flush = zlib.Z_SYNC_FLUSH
+        elif encoding == "br":
+            self._obj = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self._sync_flush = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+
+    def compress(self, data: bytes, flush: bool = False, finish: bool = False) -> bytes:
+        if self.encoding == "br":
+            out = self._obj.process(data) if data else b""
+            if finish:
+                out += self._obj.finish()
+            elif flush:
+                out += self._obj.flush()
+            return out
+
+        out = self._obj.compress(data) if data else b""
+        if finish:
+            out += self._obj.flush()
+        elif flush:
+            # Streamed records must reach the client without waiting for more data
+            out += self._obj.flush(self._sync_flush)
+        return out
+
+class RequestBodyDecoder:
+    """
+    ASGI receive wrapper: decompresses each chunk as it arrives.
+    A msgpack body is buffered in the unpacker and handed to the app as one
+    JSON message once complete.
+    """
+
+    def __init__(self, receive, encoding: str, msgpack_body: bool):
+        self.receive = receive
+        self.decompressor = Decompressor(encoding) if encoding != "identity" else None
+        self.unpacker = msgpack.Unpacker(raw=False, timestamp=3, max_buffer_size=MAX_DECODED_BODY) if msgpack_body else None
+        self.decoded_size = 0
+        self.done = False
+
+    async def __call__(self):
+        if self.done:
+            return await self.receive()
+
+        while True:
+            message = await self.receive()
+            if message["type"] != "http.request":
+                return message
+
+            more_body = message.get("more_body", False)
+            data = message.get("body", b"")
+            if self.decompressor:
+                try:
+                    data = self.decompressor.decompress(data)
+                    if not more_body:
+                        data += self.decompressor.flush()
+                except Exception:
+                    raise RequestDecodeError("Пошкоджене стиснення тіла запиту")
+
+            self.decoded_size += len(data)
+            if self.decoded_size > MAX_DECODED_BODY:
+                raise RequestDecodeError("Тіло запиту завелике")
+
+            if self.unpacker is None:
+                self.done = not more_body
+                return {"type": "http.request", "body": data, "more_body": more_body}
+
+            self.unpacker.feed(data)
+            if more_body:
+                continue
+
+            self.done = True
+            try:
+                payload = self.unpacker.unpack()
+            except Exception:
+                raise RequestDecodeError("Невірне тіло msgpack")
+            # Release the raw buffer before the JSON copy is made
+            self.unpacker = None
+            body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+            return {"type": "http.request", "body": body, "more_body": False}
+
+class ResponseEncoder:
+    """
+    ASGI send wrapper: msgpack transcoding and streamed compression
+    NDJSON streams are compressed as they go; other bodies are buffered and
+    compressed only from min_bytes on, like CompressionMiddleware does.
+    """
+
+    def __init__(self, send, msgpack_response: bool, encoding: Optional[str], min_bytes: int):
+        self._send = send
+        self.msgpack_response = msgpack_response
+        self.encoding = encoding
+        self.min_bytes = min_bytes
+        self.to_msgpack = False
+        self.streaming = False
+        self.compressor = None
+        self.buffer = b""
+        self.start = None
+        self.pending = b""
+        self.started = False
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            headers = MutableHeaders(raw=message["headers"])
+            response_media_type = media_type(headers.get("content-type"))
+            self.streaming = response_media_type == NDJSON_MEDIA_TYPE
+            self.to_msgpack = self.msgpack_response and response_media_type in (JSON_MEDIA_TYPE, NDJSON_MEDIA_TYPE)
+            compress = bool(self.encoding) and "content-encoding" not in headers and message["status"] not in (204, 304)
+
+            if self.to_msgpack or compress:
+                if "content-length" in headers:
+                    del headers["content-length"]
+                if self.to_msgpack:
+                    headers["content-type"] = MSGPACK_MEDIA_TYPE
+            headers.add_vary_header("Accept")
+            headers.add_vary_header("Accept-Encoding")
+            message = {**message, "headers": headers.raw}
+
+            if compress and not self.streaming:
+                # Held until the body size is known
+                self.start = message
+            else:
+                await self.begin(message, compress)
+            return
+
+        if message["type"] == "http.response.body":
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if self.to_msgpack:
+                body = self.transcode(body, more_body)
+            if self.start is not None:
+                self.pending += body
+                if more_body:
+                    return
+                body, self.pending = self.pending, b""
+                start, self.start = self.start, None
+                await self.begin(start, len(body) >= self.min_bytes, len(body))
+            if self.compressor:
+                body = self.compressor.compress(body, flush=self.streaming, finish=not more_body)
+            await self._send({**message, "body": body})
+            return
+
+        await self._send(message)
+
+    async def begin(self, message, compress: bool, length: Optional[int] = None):
+        """Sends the start message, with Content-Encoding when compressing"""
+        headers = MutableHeaders(raw=message["headers"])
+        if compress:
+            self.compressor = Compressor(self.encoding)
+            headers["content-encoding"] = self.encoding
+        elif length is not None:
+            headers["content-length"] = str(length)
+        self.started = True
+        await self._send({**message, "headers": headers.raw})
+
+    def transcode(self, body: bytes, more_body: bool) -> bytes:
+        """JSON -> one msgpack object; NDJSON -> one msgpack object per line"""
+        self.buffer += body
+        if not self.streaming:
+            if more_body:
+                return b""
+            data, self.buffer = self.buffer, b""
+            return msgpack.packb(json.loads(data), use_bin_type=True) if data else b""
+
+        if more_body:
+            lines, _, self.buffer = self.buffer.rpartition(b"\n")
+        else:
+            lines, self.buffer = self.buffer, b""
+        return b"".join(
+            msgpack.packb(json.loads(line), use_bin_type=True)
+            for line in lines.split(b"\n") if line.strip()
+        )
+
+async def send_error(send, status_code: int, detail: str):
+    body = json.dumps({"detail": detail}, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [
+            (b"content-type", JSON_MEDIA_TYPE.encode()),
+            (b"content-length", str(len(body)).encode())
+        ]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+class PayloadCodecMiddleware:
+    """Content negotiation for the routes in CODEC_PATHS"""
+
+    def __init__(self, app, min_bytes: int, paths: tuple = CODEC_PATHS):
+        self.app = app
+        self.min_bytes = min_bytes
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        content_encoding = headers.get("content-encoding", "identity").strip().lower()
+        msgpack_body = media_type(headers.get("content-type")) in MSGPACK_MEDIA_TYPES
+
+        if content_encoding not in request_encodings() or (msgpack_body and msgpack is None):
+            await send_error(send, 415, "Непідтримуваний формат тіла запиту")
+            return
+
+        if msgpack_body or content_encoding != "identity":
+            request_headers = MutableHeaders(scope=scope)
+            if msgpack_body:
+                request_headers["content-type"] = JSON_MEDIA_TYPE
+            for name in ("content-encoding", "content-length"):
+                if name in request_headers:
+                    del request_headers[name]
+            receive = RequestBodyDecoder(receive, content_encoding, msgpack_body)
+
+        msgpack_response = msgpack is not None and bool(accepted_tokens(headers.get("accept")) & set(MSGPACK_MEDIA_TYPES))
+        encoder = ResponseEncoder(
+            send, msgpack_response, negotiate_encoding(headers.get("accept-encoding")), self.min_bytes
+        )
+        try:
+            await self.app(scope, receive, encoder.send)
+        except RequestDecodeError as e:
+            if encoder.started:
+                raise
+            await send_error(send, 400, str(e))
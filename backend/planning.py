@@ -0,0 +1,117 @@
+"""
+Multi-batch production planning
+Recipes become a material x recipe coefficient matrix built from the norm
+tables (via material_requirements.load_norms). A plan is a recipe x day
+matrix of planned weights, so requirements per day are one matrix product
+and projected balances one cumulative sum. All materials of a batch are
+taken on its planned day.
+"""
+from datetime import date, timedelta
+
+import numpy as np
+
+from material_requirements import load_norms, compare_with_balances
+
+class NormMatrix:
+    """
+    Coefficients of the recipes
+    linear: kg of material per kg of initial weight (per_100kg / 100)
+    capacity: kg of initial weight per casing unit (0 = not a casing),
+    casings are counted per batch, rounded up
+    """
+
+    def __init__(self, norms: dict):
+        self.recipe_ids = sorted(norms)
+        recipe_index = {recipe_id: i for i, recipe_id in enumerate(self.recipe_ids)}
+        self.material_ids = []
+        self.kinds = {}
+        material_index = {}
+        entries = []
+        for recipe_id, recipe_norms in norms.items():
+            for norm in recipe_norms:
+                nomenclature_id = norm['nomenclature_id']
+                if nomenclature_id not in material_index:
+                    material_index[nomenclature_id] = len(self.material_ids)
+                    self.material_ids.append(nomenclature_id)
+                    self.kinds[nomenclature_id] = []
+                if norm['kind'] not in self.kinds[nomenclature_id]:
+                    self.kinds[nomenclature_id].append(norm['kind'])
+                entries.append((material_index[nomenclature_id], recipe_index[recipe_id], norm))
+
+        shape = (len(self.material_ids), len(self.recipe_ids))
+        self.linear = np.zeros(shape)
+        self.capacity = np.zeros(shape)
+        for material, recipe, norm in entries:
+            if 'capacity_kg' in norm:
+                self.capacity[material, recipe] = norm['capacity_kg']
+            else:
+                self.linear[material, recipe] += norm['per_100kg'] / 100.0
+        self.recipe_index = recipe_index
+
+    def demand(self, recipe_idx: np.ndarray, day_idx: np.ndarray, weights: np.ndarray, days: int) -> np.ndarray:
+        """Material x day demand for batches given as parallel arrays"""
+        planned = np.zeros((len(self.recipe_ids), days))
+        np.add.at(planned, (recipe_idx, day_idx), weights)
+        demand = self.linear @ planned
+
+        casing_rows = np.flatnonzero(self.capacity.any(axis=1))
+        if casing_rows.size:
+            capacity = self.capacity[np.ix_(casing_rows, recipe_idx)]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                units = np.where(capacity > 0, np.ceil(weights / capacity), 0.0)
+            casing_demand = np.zeros((casing_rows.size, days))
+            rows = np.repeat(np.arange(casing_rows.size), day_idx.size)
+            np.add.at(casing_demand, (rows, np.tile(day_idx, casing_rows.size)), units.ravel())
+            demand[casing_rows] += casing_demand
+        return demand
+
+def expand_plan(items, start: date):
+    """Plan items -> parallel arrays (recipe_id, day offset, weight), one entry per batch"""
+    recipe_ids, offsets, weights = [], [], []
+    for item in items:
+        planned_date = item.planned_date or start
+        offset = (planned_date - start).days
+        recipe_ids.extend([item.recipe_id] * item.batches)
+        offsets.extend([offset] * item.batches)
+        weights.extend([item.initial_weight] * item.batches)
+    return recipe_ids, np.array(offsets, dtype=np.int64), np.array(weights, dtype=float)
+
+def build_plan(cursor, items) -> dict:
+    """Combined needs, shortfalls and the day each material runs out"""
+    today = date.today()
+    start = min([item.planned_date for item in items if item.planned_date] + [today])
+    recipe_ids, offsets, weights = expand_plan(items, start)
+    days = int(offsets.max()) + 1 if offsets.size else 1
+
+    matrix = NormMatrix(load_norms(cursor, recipe_ids))
+    recipe_idx = np.array([matrix.recipe_index[recipe_id] for recipe_id in recipe_ids], dtype=np.int64)
+    demand = matrix.demand(recipe_idx, offsets, weights, days)
+    totals = demand.sum(axis=1)
+
+    lines = compare_with_balances(cursor, {
+        nomenclature_id: {'kinds': matrix.kinds[nomenclature_id], 'required': float(totals[i])}
+        for i, nomenclature_id in enumerate(matrix.material_ids)
+    })
+    available = np.array([line['available'] for line in lines], dtype=float).reshape(-1, 1)
+    projected = available - np.cumsum(demand, axis=1)
+    negative = projected < -1e-9
+    runs_out = np.where(negative.any(axis=1), negative.argmax(axis=1), -1)
+
+    materials = []
+    for i, line in enumerate(lines):
+        materials.append({
+            **line,
+            'projected_min': round(float(projected[i].min()), 6),
+            'runs_out_on': (start + timedelta(days=int(runs_out[i]))).isoformat() if runs_out[i] >= 0 else None
+        })
+    materials.sort(key=lambda material: (material['runs_out_on'] is None, material['runs_out_on'] or '', -material['shortage']))
+
+    return {
+        'start_date': start.isoformat(),
+        'end_date': (start + timedelta(days=days - 1)).isoformat(),
+        'batches': len(recipe_ids),
+        'total_weight': round(float(weights.sum()), 6),
+        'feasible': not any(material['shortage'] > 0 for material in materials),
+        'materials': materials,
+        'shortages': [material for material in materials if material['shortage'] > 0]
+    }
@@ -1,40 +1,41 @@
 """
 Production module API endpoints
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from typing import List
 from datetime import datetime
 import json
+import time
 
-from database import get_db_connection
+from database import get_db_connection, chunked, placeholders
+from versioning import NOMENCLATURE, RECIPES, check_not_modified
+from events import publish_balances, publish_batch_state
+from singleflight import SingleFlight, flight_key
+from fast_json import json_response
+from material_requirements import check_requirements, ensure_available, shortages
+from stock_deduction import deduct, withdrawal, withdrawal_changes
+from production_steps import MIX, SALTING, SUGAR, WATER_MASSAGE, STUFF, run_step
+from planning import build_plan
+from batch_numbers import next_number
+from costing import complete_batch_cost, cost_dict
+from valuation import post_balances
+from yield_stats import combine, load_yield_stats, parse_day, record_yield, yield_summary
+from recipe_cache import FENUGREEK_ID, WATER_ID, recipe_catalog, get_compiled_recipe
+from batch_details import BATCH_ENCODER, OPERATIONS_QUERY, load_batch_full, operation_dict, parse_sections
 from models import (
     Recipe, RecipeStep, BatchCreate, Batch, BatchComplete, 
     BatchOperationCreate, BatchMixProduction, BatchSalting,
-    BatchSugar, BatchMassage, BatchStuff
+    BatchSugar, BatchMassage, BatchStuff, FeasibilityCheck, ProductionPlan
 )
 
+batches_flight = SingleFlight("production_batches")
+
 router = APIRouter(prefix="/api/production", tags=["production"])
 
 # Constants
-FENUGREEK_ID = 19  # Пажитник in nomenclature
-WATER_ID = 136     # Вода in nomenclature
-SALT_ID = 28       # Сіль in nomenclature
 FENUGREEK_WATER_RATIO = 4  # 1:4 rule
 
-# Product name to code mapping for batch numbers
-PRODUCT_CODE_MAP = {
-    'Бастурма класична': 'BAST',
-    'Бастурма з конини': 'HORSE',
-    'Бастурма конина': 'HORSE',
-    'Суджук': 'SUDJ',
-    'Курка': 'CHIK',
-    'Куряче': 'CHIK',
-    'Махан': 'MAHAN',
-    'Індичка': 'TURK',
-    'Свинина': 'PORK',
-    'Пластина': 'PLAST',
-}
-
 def calculate_produced_mix(spices: list) -> float:
     """
     Calculate produced mix quantity with fenugreek water rule
@@ -61,287 +62,116 @@ def calculate_produced_mix(spices: list) -> float:
 
 
 @router.get("/recipes", response_model=List[Recipe])
-async def get_recipes():
+async def get_recipes(request: Request, response: Response):
     """Get all recipes"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT r.id, r.name, r.target_product_id, n.name as product_name,
-                   r.expected_yield_min, r.expected_yield_max, r.description
-            FROM recipes r
-            LEFT JOIN nomenclature n ON r.target_product_id = n.id
-            ORDER BY r.name
-        """)
-        
-        recipes = []
-        for row in cursor.fetchall():
-            recipes.append(Recipe(
-                id=row.id,
-                name=row.name,
-                target_product_id=row.target_product_id,
-                target_product_name=row.product_name,
-                expected_yield_min=float(row.expected_yield_min),
-                expected_yield_max=float(row.expected_yield_max),
-                description=row.description,
-                steps=[]
-            ))
-        
-        return recipes
+    not_modified = check_not_modified(request, response, RECIPES, NOMENCLATURE)
+    if not_modified:
+        return not_modified
+    
+    catalog = await run_in_threadpool(recipe_catalog)
+    return [Recipe(**recipe.summary(), steps=[]) for recipe in catalog.recipes.values()]
 
 @router.get("/recipes/{recipe_id}", response_model=Recipe)
-async def get_recipe(recipe_id: int):
+async def get_recipe(recipe_id: int, request: Request, response: Response):
     """Get recipe with steps"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Get recipe
-        cursor.execute("""
-            SELECT r.id, r.name, r.target_product_id, n.name as product_name,
-                   r.expected_yield_min, r.expected_yield_max, r.description
-            FROM recipes r
-            LEFT JOIN nomenclature n ON r.target_product_id = n.id
-            WHERE r.id = ?
-        """, recipe_id)
-        
-        row = cursor.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Recipe not found")
-        
-        recipe = Recipe(
-            id=row.id,
-            name=row.name,
-            target_product_id=row.target_product_id,
-            target_product_name=row.product_name,
-            expected_yield_min=float(row.expected_yield_min),
-            expected_yield_max=float(row.expected_yield_max),
-            description=row.description,
-            steps=[]
-        )
-        
-        # Get steps
-        cursor.execute("""
-            SELECT id, step_order, step_type, step_name, duration_days, parameters, description
-            FROM recipe_steps
-            WHERE recipe_id = ?
-            ORDER BY step_order
-        """, recipe_id)
-        
-        for step_row in cursor.fetchall():
-            params = None
-            if step_row.parameters:
-                try:
-                    params = json.loads(step_row.parameters)
-                except:
-                    params = None
-            
-            recipe.steps.append(RecipeStep(
-                id=step_row.id,
-                step_order=step_row.step_order,
-                step_type=step_row.step_type,
-                step_name=step_row.step_name,
-                duration_days=float(step_row.duration_days),
-                parameters=params,
-                description=step_row.description
-            ))
-        
-        return recipe
+    not_modified = check_not_modified(request, response, RECIPES, NOMENCLATURE)
+    if not_modified:
+        return not_modified
+    
+    recipe = await run_in_threadpool(get_compiled_recipe, recipe_id)
+    return Recipe(**recipe.summary(), steps=[RecipeStep(**step) for step in recipe.steps])
 
 @router.get("/recipes/{recipe_id}/spices")
 async def get_recipe_spices(recipe_id: int):
     """Get spices/ingredients for a recipe"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Get spices
-        cursor.execute("""
-            SELECT rs.id, rs.nomenclature_id, n.name, rs.quantity_per_100kg, rs.is_fenugreek
-            FROM recipe_spices rs
-            JOIN nomenclature n ON rs.nomenclature_id = n.id
-            WHERE rs.recipe_id = ?
-            ORDER BY n.name
-        """, recipe_id)
-        
-        spices = []
-        for row in cursor.fetchall():
-            spices.append({
-                'id': row.id,
-                'nomenclature_id': row.nomenclature_id,
-                'name': row.name,
-                'quantity_per_100kg': float(row.quantity_per_100kg) if row.quantity_per_100kg else 0,
-                'is_fenugreek': bool(row.is_fenugreek)
-            })
-        
-        # Get ingredients
-        cursor.execute("""
-            SELECT ri.id, ri.nomenclature_id, n.name, ri.quantity_per_100kg, ri.is_optional
-            FROM recipe_ingredients ri
-            JOIN nomenclature n ON ri.nomenclature_id = n.id
-            WHERE ri.recipe_id = ?
-            ORDER BY n.name
-        """, recipe_id)
-        
-        ingredients = []
-        for row in cursor.fetchall():
-            ingredients.append({
-                'id': row.id,
-                'nomenclature_id': row.nomenclature_id,
-                'name': row.name,
-                'quantity_per_100kg': float(row.quantity_per_100kg) if row.quantity_per_100kg else 0,
-                'is_optional': bool(row.is_optional)
-            })
-        
-        return {
-            'spices': spices,
-            'ingredients': ingredients
-        }
+    recipe = await run_in_threadpool(get_compiled_recipe, recipe_id)
+    return {
+        'spices': recipe.spices,
+        'ingredients': recipe.ingredients
+    }
 
 @router.get("/recipes/{recipe_id}/materials")
 async def get_recipe_materials(recipe_id: int):
     """Get recipe materials (ingredients + spices) with nomenclature IDs"""
+    recipe = await run_in_threadpool(get_compiled_recipe, recipe_id)
+    return {
+        'spices': recipe.spices,
+        'ingredients': recipe.ingredients
+    }
+
+@router.post("/feasibility")
+async def check_feasibility(plan: FeasibilityCheck):
+    """Check stock for one or more planned batches (all norms of the recipes)"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        
-        # Get spices
-        cursor.execute("""
-            SELECT rs.id, rs.nomenclature_id, n.name, rs.quantity_per_100kg, rs.is_fenugreek
-            FROM recipe_spices rs
-            JOIN nomenclature n ON rs.nomenclature_id = n.id
-            WHERE rs.recipe_id = ?
-            ORDER BY n.name
-        """, recipe_id)
-        
-        spices = []
-        for row in cursor.fetchall():
-            spices.append({
-                'id': row.id,
-                'nomenclature_id': row.nomenclature_id,
-                'name': row.name,
-                'quantity_per_100kg': float(row.quantity_per_100kg) if row.quantity_per_100kg else 0,
-                'is_fenugreek': bool(row.is_fenugreek)
-            })
-        
-        # Get ingredients
-        cursor.execute("""
-            SELECT ri.id, ri.nomenclature_id, n.name, ri.quantity_per_100kg, ri.is_optional
-            FROM recipe_ingredients ri
-            JOIN nomenclature n ON ri.nomenclature_id = n.id
-            WHERE ri.recipe_id = ?
-            ORDER BY n.name
-        """, recipe_id)
-        
-        ingredients = []
-        for row in cursor.fetchall():
-            ingredients.append({
-                'id': row.id,
-                'nomenclature_id': row.nomenclature_id,
-                'name': row.name,
-                'quantity_per_100kg': float(row.quantity_per_100kg) if row.quantity_per_100kg else 0,
-                'is_optional': bool(row.is_optional)
-            })
+        lines = check_requirements(cursor, [(item.recipe_id, item.initial_weight) for item in plan.items])
+        short = shortages(lines)
         
         return {
-            'spices': spices,
-            'ingredients': ingredients
+            "feasible": not short,
+            "requirements": lines,
+            "shortages": short
         }
 
+@router.post("/plan")
+async def plan_production(plan: ProductionPlan):
+    """Combined material needs of a production plan, shortfalls and run-out days"""
+    if not plan.items or any(item.batches < 1 or item.initial_weight <= 0 for item in plan.items):
+        raise HTTPException(status_code=400, detail="План має містити партії з додатною вагою")
+    
+    started = time.perf_counter()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        result = build_plan(cursor, plan.items)
+    
+    result["computed_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return result
+
 @router.post("/batches", response_model=Batch)
 async def create_batch(batch_data: BatchCreate):
     """Create new production batch with stock availability check"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
-        # Verify recipe exists and get target product
-        cursor.execute("""
-            SELECT r.name, r.target_product_id, n.name as product_name
-            FROM recipes r
-            JOIN nomenclature n ON r.target_product_id = n.id
-            WHERE r.id = ?
-        """, batch_data.recipe_id)
-        recipe = cursor.fetchone()
-        if not recipe:
-            raise HTTPException(status_code=404, detail="Recipe not found")
+        # Check idempotency (offline clients send a key with batch creation)
+        if batch_data.idempotency_key:
+            cursor.execute(
+                "SELECT id FROM batches WHERE idempotency_key = ?",
+                batch_data.idempotency_key
+            )
+            existing = cursor.fetchone()
+            if existing:
+                return await get_batch(existing.id)
+        
+        # Verify recipe exists (compiled recipe carries the product code)
+        recipe = get_compiled_recipe(batch_data.recipe_id, cursor)
         
         # Check raw material availability on stock for ALL ingredients
-        cursor.execute("""
-            SELECT ri.nomenclature_id, n.name, ri.quantity_per_100kg
-            FROM recipe_ingredients ri
-            JOIN nomenclature n ON ri.nomenclature_id = n.id
-            WHERE ri.recipe_id = ? AND ri.is_optional = 0
-            ORDER BY ri.quantity_per_100kg DESC
-        """, batch_data.recipe_id)
-        
-        ingredients = cursor.fetchall()
-        insufficient_materials = []
-        
-        for ingredient in ingredients:
-            ingredient_id = ingredient.nomenclature_id
-            ingredient_name = ingredient.name
-            qty_per_100kg = float(ingredient.quantity_per_100kg)
-            
-            # Calculate required quantity based on batch initial_weight
-            required_qty = (batch_data.initial_weight * qty_per_100kg) / 100.0
-            
-            # Check stock balance
-            cursor.execute("""
-                SELECT COALESCE(quantity, 0) as quantity
-                FROM stock_balances
-                WHERE nomenclature_id = ?
-            """, ingredient_id)
-            
-            balance_row = cursor.fetchone()
-            current_balance = float(balance_row[0]) if balance_row else 0.0
-            
-            if current_balance < required_qty:
-                insufficient_materials.append({
-                    'name': ingredient_name,
-                    'required': required_qty,
-                    'available': current_balance
-                })
-        
-        # If any material is insufficient, raise error
-        if insufficient_materials:
-            error_details = "; ".join([
-                f"{m['name']}: потрібно {m['required']:.2f} кг, доступно {m['available']:.2f} кг"
-                for m in insufficient_materials
-            ])
-            raise HTTPException(
-                status_code=400,
-                detail=f"Недостатньо сировини на складі: {error_details}"
-            )
+        # (main raw material first: largest norm per 100 kg)
+        ingredients = check_requirements(
+            cursor, [(batch_data.recipe_id, batch_data.initial_weight)], kinds=('ingredient',)
+        )
+        ensure_available(ingredients, "Недостатньо сировини на складі")
         
         # Generate batch number with product code
         today = datetime.now().strftime("%d%m%Y")
         
-        # Find product code from recipe/product name
-        recipe_name = recipe.name
-        product_name = recipe.product_name
-        product_code = 'BATCH'  # Default fallback
-        
-        # Try to match recipe name first, then product name
-        for key, code in PRODUCT_CODE_MAP.items():
-            if key in recipe_name or key in product_name:
-                product_code = code
-                break
-        
-        # Count existing batches for today with this product code
-        cursor.execute("""
-            SELECT COUNT(*) FROM batches 
-            WHERE batch_number LIKE ?
-        """, f"{product_code}-{today}%")
-        count = cursor.fetchone()[0] + 1
-        
-        batch_number = f"{product_code}-{today}-{count}"
+        # Next number for today with this product code
+        prefix = f"{recipe.product_code}-{today}"
+        batch_number = f"{prefix}-{next_number(cursor, prefix, 'batches')}"
         
         # Create batch
         cursor.execute("""
             INSERT INTO batches (
                 batch_number, recipe_id, status, current_step,
-                initial_weight, trim_waste, trim_returned, operator_notes
+                initial_weight, trim_waste, trim_returned, operator_notes,
+                idempotency_key
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, batch_number, batch_data.recipe_id, 'created', 0,
             batch_data.initial_weight, batch_data.trim_waste,
-            batch_data.trim_returned, batch_data.operator_notes)
+            batch_data.trim_returned, batch_data.operator_notes,
+            batch_data.idempotency_key)
         
         batch_id = int(cursor.execute("SELECT @@IDENTITY").fetchone()[0])
         
@@ -349,52 +179,26 @@ async def create_batch(batch_data: BatchCreate):
         # Get main ingredient (first one with highest quantity) for auto-consumption
         if ingredients:
             main_ingredient = ingredients[0]  # Already ordered by quantity_per_100kg DESC
-            ingredient_id = main_ingredient.nomenclature_id
+            ingredient_id = main_ingredient['nomenclature_id']
             quantity_to_consume = batch_data.initial_weight
             
             # Add trim waste if not returned to stock
             if batch_data.trim_waste and batch_data.trim_waste > 0 and not batch_data.trim_returned:
                 quantity_to_consume += batch_data.trim_waste
             
-            # Get current balance for main ingredient
-            cursor.execute("""
-                SELECT COALESCE(quantity, 0) as quantity
-                FROM stock_balances
-                WHERE nomenclature_id = ?
-            """, ingredient_id)
-            
-            balance_row = cursor.fetchone()
-            current_balance = float(balance_row[0]) if balance_row else 0.0
             quantity_to_consume = float(quantity_to_consume)
             
-            # Create idempotency key for material consumption
-            material_key = f"batch-{batch_id}-raw-material-{datetime.now().timestamp()}"
-            
-            # Create withdrawal movement
-            new_balance = float(current_balance - quantity_to_consume)
-            cursor.execute("""
-                INSERT INTO stock_movements (
-                    nomenclature_id, operation_type, quantity, balance_after,
-                    source_operation_type, source_operation_id,
-                    idempotency_key, operation_date, metadata
-                )
-                VALUES (?, 'withdrawal', ?, ?, 'production', ?, ?, GETUTCDATE(), ?)
-            """, ingredient_id, quantity_to_consume, new_balance,
-                batch_number, material_key,
-                json.dumps({
+            # Withdraw under lock (the check above is not locked)
+            consumed = deduct(cursor, [withdrawal(
+                ingredient_id, quantity_to_consume, 'production',
+                f"batch-{batch_id}-raw-material-{datetime.now().timestamp()}",
+                {
                     'batch_id': batch_id,
                     'batch_number': batch_number,
                     'material_type': 'raw_material',
                     'auto_consumed': True
-                }))
-            
-            # Update stock balance
-            cursor.execute("""
-                UPDATE stock_balances
-                SET quantity = ?,
-                    last_updated = GETUTCDATE()
-                WHERE nomenclature_id = ?
-            """, new_balance, ingredient_id)
+                }
+            )], batch_number, "Недостатньо сировини на складі", batch_id)
             
             # Record in batch_materials
             cursor.execute("""
@@ -418,6 +222,10 @@ async def create_batch(batch_data: BatchCreate):
         row = cursor.fetchone()
         conn.commit()
         
+        if ingredients:
+            publish_balances(withdrawal_changes(consumed))
+        publish_batch_state(batch_id, row.status, batch_number=row.batch_number, current_step=row.current_step)
+        
         return Batch(
             id=row.id,
             batch_number=row.batch_number,
@@ -437,590 +245,322 @@ async def create_batch(batch_data: BatchCreate):
 @router.get("/batches", response_model=List[Batch])
 async def get_batches(status: str = None):
     """Get all batches with optional status filter"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        query = """
-            SELECT b.id, b.batch_number, b.recipe_id, r.name as recipe_name,
-                   b.status, b.current_step, b.started_at, b.completed_at,
-                   b.initial_weight, b.final_weight, b.trim_waste,
-                   b.trim_returned, b.operator_notes
-            FROM batches b
-            LEFT JOIN recipes r ON b.recipe_id = r.id
-        """
-        
-        if status:
-            query += " WHERE b.status = ?"
-            cursor.execute(query + " ORDER BY b.started_at DESC", status)
-        else:
-            cursor.execute(query + " ORDER BY b.started_at DESC")
+    def _get():
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+        
+            query = """
+                SELECT b.id, b.batch_number, b.recipe_id, r.name as recipe_name,
+                       b.status, b.current_step, b.started_at, b.completed_at,
+                       b.initial_weight, b.final_weight, b.trim_waste,
+                       b.trim_returned, b.operator_notes
+                FROM batches b
+                LEFT JOIN recipes r ON b.recipe_id = r.id
+            """
+        
+            if status:
+                query += " WHERE b.status = ?"
+                cursor.execute(query + " ORDER BY b.started_at DESC", status)
+            else:
+                cursor.execute(query + " ORDER BY b.started_at DESC")
         
-        batches = []
-        for row in cursor.fetchall():
-            batches.append(Batch(
-                id=row.id,
-                batch_number=row.batch_number,
-                recipe_id=row.recipe_id,
-                recipe_name=row.recipe_name,
-                status=row.status,
-                current_step=row.current_step,
-                started_at=row.started_at,
-                completed_at=row.completed_at,
-                initial_weight=float(row.initial_weight),
-                final_weight=float(row.final_weight) if row.final_weight else None,
-                trim_waste=float(row.trim_waste) if row.trim_waste else None,
-                trim_returned=row.trim_returned,
-                operator_notes=row.operator_notes
-            ))
-        
-        return batches
+            return BATCH_ENCODER.dumps(cursor.fetchall())
+    return json_response(await batches_flight.run(flight_key("/api/production/batches", status=status), _get))
 
-@router.get("/batches/{batch_id}", response_model=Batch)
-async def get_batch(batch_id: int):
-    """Get batch details"""
+# Fixed /batches/... paths must be registered before /batches/{batch_id}
+@router.get("/batches/analytics")
+async def get_batches_analytics(
+    start_date: str = None,
+    end_date: str = None,
+    recipe_id: int = None,
+    status: str = None
+):
+    """
+    Get analytics and statistics for batches
+    Yield figures of completed batches come from the per-recipe statistics
+    maintained at completion (period by completion day, UTC); open batches
+    are counted by start date.
+    """
+    try:
+        start_day, end_day = parse_day(start_date), parse_day(end_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Невірний формат дати")
+    
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT b.id, b.batch_number, b.recipe_id, r.name as recipe_name,
-                   b.status, b.current_step, b.started_at, b.completed_at,
-                   b.initial_weight, b.final_weight, b.trim_waste,
-                   b.trim_returned, b.operator_notes
-            FROM batches b
-            LEFT JOIN recipes r ON b.recipe_id = r.id
-            WHERE b.id = ?
-        """, batch_id)
+        # Precomputed yield statistics of completed batches
+        if status in (None, 'completed'):
+            parts, histograms = load_yield_stats(cursor, start_day, end_day, recipe_id)
+        else:
+            parts, histograms = {}, {}
         
-        row = cursor.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Batch not found")
+        # Build WHERE clause
+        where_clauses = []
+        params = []
         
-        return Batch(
-            id=row.id,
-            batch_number=row.batch_number,
-            recipe_id=row.recipe_id,
-            recipe_name=row.recipe_name,
-            status=row.status,
-            current_step=row.current_step,
-            started_at=row.started_at,
-            completed_at=row.completed_at,
-            initial_weight=float(row.initial_weight),
-            final_weight=float(row.final_weight) if row.final_weight else None,
-            trim_waste=float(row.trim_waste) if row.trim_waste else None,
-            trim_returned=row.trim_returned,
-            operator_notes=row.operator_notes
-        )
-
-
-@router.post("/batches/{batch_id}/operations")
-async def add_batch_operation(batch_id: int, operation: BatchOperationCreate):
-    """Add an operation to a batch (step completion)"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
+        if start_date:
+            where_clauses.append("b.started_at >= ?")
+            params.append(start_date)
         
-        # Get batch and current step
-        cursor.execute("""
-            SELECT b.*, rs.step_order, rs.step_type, rs.step_name
-            FROM batches b
-            LEFT JOIN recipe_steps rs ON b.recipe_id = rs.recipe_id AND rs.id = ?
-            WHERE b.id = ?
-        """, operation.step_id, batch_id)
+        if end_date:
+            where_clauses.append("b.started_at <= ?")
+            params.append(end_date)
         
-        batch = cursor.fetchone()
-        if not batch:
-            raise HTTPException(status_code=404, detail="Batch not found")
+        if recipe_id:
+            where_clauses.append("b.recipe_id = ?")
+            params.append(recipe_id)
         
-        if batch.status == 'completed':
-            raise HTTPException(status_code=400, detail="Batch already completed")
+        if status:
+            where_clauses.append("b.status = ?")
+            params.append(status)
         
-        # Check idempotency
-        cursor.execute(
-            "SELECT id FROM batch_operations WHERE idempotency_key = ?",
-            operation.idempotency_key
-        )
-        if cursor.fetchone():
-            return {"message": "Operation already recorded", "batch_id": batch_id}
+        where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
         
-        # Insert operation
-        cursor.execute("""
-            INSERT INTO batch_operations (
-                batch_id, step_id, operation_type, status,
-                weight_before, weight_after, parameters, notes, idempotency_key
-            )
-            VALUES (?, ?, ?, 'completed', ?, ?, ?, ?, ?)
-        """, batch_id, operation.step_id, batch.step_type,
-            operation.weight_before, operation.weight_after,
-            json.dumps(operation.parameters) if operation.parameters else None,
-            operation.notes, operation.idempotency_key)
+        # Open batches by recipe (index on status)
+        cursor.execute(f"""
+            SELECT b.recipe_id, b.status, COUNT(*)
+            FROM batches b
+            WHERE b.status <> 'completed' AND {where_sql}
+            GROUP BY b.recipe_id, b.status
+        """, *params)
         
-        # Update batch status and current step
-        new_status = 'in_progress' if batch.status == 'created' else batch.status
-        cursor.execute("""
-            UPDATE batches
-            SET status = ?,
-                current_step = ?,
-                updated_at = GETUTCDATE()
-            WHERE id = ?
-        """, new_status, batch.step_order, batch_id)
+        open_counts = {}
+        for row in cursor.fetchall():
+            open_counts.setdefault(row[0], {})[row[1]] = row[2]
+        
+        recipe_ids = sorted(set(parts) | set(open_counts))
+        recipes = {}
+        for chunk in chunked(recipe_ids):
+            cursor.execute(f"""
+                SELECT id, name, expected_yield_min, expected_yield_max
+                FROM recipes
+                WHERE id IN ({placeholders(len(chunk))})
+            """, chunk)
+            for row in cursor.fetchall():
+                recipes[row[0]] = row
         
-        conn.commit()
+        by_recipe = []
+        for key in recipe_ids:
+            recipe = recipes.get(key)
+            if recipe is None:
+                continue
+            entry = yield_summary(combine(parts.get(key, [])), histograms.get(key, {}))
+            open_count = sum(open_counts.get(key, {}).values())
+            by_recipe.append({
+                'recipe_id': key,
+                'recipe_name': recipe[1],
+                'batch_count': entry['completed_count'] + open_count,
+                **entry,
+                'expected_yield_min': float(recipe[2]) if recipe[2] else 0,
+                'expected_yield_max': float(recipe[3]) if recipe[3] else 0,
+            })
+        by_recipe.sort(key=lambda entry: entry['batch_count'], reverse=True)
         
-        return {
-            "message": "Operation added successfully",
-            "batch_id": batch_id,
-            "step_completed": batch.step_name,
-            "current_step": batch.step_order
-        }
-
-@router.get("/batches/{batch_id}/operations")
-async def get_batch_operations(batch_id: int):
-    """Get all operations for a batch"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
+        # Totals over all recipes: bucket stats and histograms combine the same way
+        total_histogram = {}
+        for histogram in histograms.values():
+            for bucket, count in histogram.items():
+                total_histogram[bucket] = total_histogram.get(bucket, 0) + count
+        summary = yield_summary(combine(part for rows in parts.values() for part in rows), total_histogram)
+        in_progress = sum(counts.get('in_progress', 0) for counts in open_counts.values())
+        created = sum(counts.get('created', 0) for counts in open_counts.values())
         
-        cursor.execute("""
-            SELECT bo.id, bo.batch_id, bo.step_id, bo.operation_type, bo.status,
-                   bo.started_at, bo.completed_at, bo.weight_before, bo.weight_after,
-                   bo.parameters, bo.notes, rs.step_name, rs.step_order
-            FROM batch_operations bo
-            JOIN recipe_steps rs ON bo.step_id = rs.id
-            WHERE bo.batch_id = ?
-            ORDER BY rs.step_order, bo.started_at
-        """, batch_id)
+        # Get recent batches
+        cursor.execute(f"""
+            SELECT TOP 10
+                b.id, b.batch_number, b.recipe_id, r.name as recipe_name,
+                b.status, b.started_at, b.completed_at,
+                b.initial_weight, b.final_weight,
+                CASE WHEN b.final_weight > 0 AND b.initial_weight > 0 
+                    THEN (b.final_weight * 100.0 / b.initial_weight) 
+                    ELSE NULL END as yield_percent
+            FROM batches b
+            JOIN recipes r ON b.recipe_id = r.id
+            WHERE {where_sql}
+            ORDER BY b.started_at DESC
+        """, *params)
         
-        operations = []
+        recent_batches = []
         for row in cursor.fetchall():
-            params = None
-            if row.parameters:
-                try:
-                    params = json.loads(row.parameters)
-                except:
-                    params = None
-            
-            operations.append({
-                'id': row.id,
-                'batch_id': row.batch_id,
-                'step_id': row.step_id,
-                'operation_type': row.operation_type,
-                'status': row.status,
-                'started_at': row.started_at.isoformat() if row.started_at else None,
-                'completed_at': row.completed_at.isoformat() if row.completed_at else None,
-                'weight_before': float(row.weight_before) if row.weight_before else None,
-                'weight_after': float(row.weight_after) if row.weight_after else None,
-                'parameters': params,
-                'notes': row.notes,
-                'step_name': row.step_name,
-                'step_order': row.step_order
+            recent_batches.append({
+                'id': row[0],
+                'batch_number': row[1],
+                'recipe_id': row[2],
+                'recipe_name': row[3],
+                'status': row[4],
+                'started_at': row[5].isoformat() if row[5] else None,
+                'completed_at': row[6].isoformat() if row[6] else None,
+                'initial_weight': float(row[7]) if row[7] else 0,
+                'final_weight': float(row[8]) if row[8] else 0,
+                'yield_percent': float(row[9]) if row[9] else None,
             })
         
-        return operations
-
-
-@router.post("/batches/{batch_id}/mix")
-async def produce_mix(batch_id: int, mix_data: BatchMixProduction):
-    """Produce mix (Chaman/Marinade) with fenugreek water rule"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Get batch
-        cursor.execute("SELECT * FROM batches WHERE id = ?", batch_id)
-        batch = cursor.fetchone()
-        if not batch:
-            raise HTTPException(status_code=404, detail="Batch not found")
-        
-        if batch.status == 'completed':
-            raise HTTPException(status_code=400, detail="Batch already completed")
-        
-        # Check if mix was already produced for this batch (prevent duplicate production)
-        cursor.execute(
-            "SELECT id FROM batch_mix_production WHERE batch_id = ?",
-            batch_id
-        )
-        if cursor.fetchone():
-            raise HTTPException(
-                status_code=400, 
-                detail="Суміш для цієї партії вже виготовлена. Повторне виготовлення заборонене."
-            )
-        
-        # Check idempotency
-        cursor.execute(
-            "SELECT id FROM batch_mix_production WHERE idempotency_key = ?",
-            mix_data.idempotency_key
-        )
-        if cursor.fetchone():
-            return {"message": "Mix already produced", "batch_id": batch_id}
-        
-        # Insert mix production record
-        cursor.execute("""
-            INSERT INTO batch_mix_production (
-                batch_id, mix_nomenclature_id, produced_quantity, used_quantity,
-                leftover_quantity, warehouse_mix_used, idempotency_key
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, batch_id, mix_data.mix_nomenclature_id, mix_data.produced_quantity,
-            mix_data.used_quantity, mix_data.leftover_quantity,
-            mix_data.warehouse_mix_used, mix_data.idempotency_key)
-        
-        # Deduct all spices from stock
-        # Get recipe_id from batch
-        recipe_id = batch.recipe_id
-        
-        # Get all spices for this recipe
-        cursor.execute("""
-            SELECT rs.nomenclature_id, rs.quantity_per_100kg, n.name
-            FROM recipe_spices rs
-            JOIN nomenclature n ON rs.nomenclature_id = n.id
-            WHERE rs.recipe_id = ?
-        """, recipe_id)
-        
-        spices = cursor.fetchall()
-        
-        # Calculate required quantity based on initial weight
-        initial_weight = float(batch.initial_weight)
-        
-        for spice_row in spices:
-            spice_id = spice_row[0]
-            quantity_per_100kg = float(spice_row[1])
-            spice_name = spice_row[2]
-            
-            # Calculate required quantity for this batch
-            required_quantity = (initial_weight / 100.0) * quantity_per_100kg
-            
-            # Check if enough stock
-            cursor.execute(
-                "SELECT quantity FROM stock_balances WHERE nomenclature_id = ?",
-                spice_id
-            )
-            result = cursor.fetchone()
-            current_balance = float(result[0]) if result else 0
-            
-            if current_balance < required_quantity:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Недостатньо специй '{spice_name}'. Доступно: {current_balance:.2f} кг, Потрібно: {required_quantity:.2f} кг"
-                )
-            
-            new_balance = current_balance - required_quantity
-            
-            # Create withdrawal record
-            spice_withdrawal_key = f"mix-spice-{batch_id}-{spice_id}-{mix_data.idempotency_key}"
-            
-            cursor.execute("""
-                INSERT INTO stock_movements (
-                    nomenclature_id, operation_type, quantity, balance_after,
-                    source_operation_type, source_operation_id,
-                    idempotency_key, operation_date, metadata
-                )
-                VALUES (?, 'withdrawal', ?, ?, 'production_spice_use', ?, ?, GETUTCDATE(), ?)
-            """, spice_id, required_quantity, new_balance, batch.batch_number, spice_withdrawal_key,
-                json.dumps({
-                    'batch_id': batch_id,
-                    'batch_number': batch.batch_number,
-                    'spice_name': spice_name,
-                    'recipe_id': recipe_id,
-                    'initial_weight': initial_weight
-                }))
-            
-            # Update stock balance
-            cursor.execute("""
-                UPDATE stock_balances
-                SET quantity = ?,
-                    last_updated = GETUTCDATE()
-                WHERE nomenclature_id = ?
-            """, new_balance, spice_id)
-        
-        # If leftover > 0, create stock receipt for mix
-        if mix_data.leftover_quantity > 0:
-            leftover_key = f"mix-leftover-{batch_id}-{mix_data.idempotency_key}"
-            
-            cursor.execute("""
-                INSERT INTO stock_movements (
-                    nomenclature_id, operation_type, quantity, balance_after,
-                    source_operation_type, source_operation_id,
-                    idempotency_key, operation_date, metadata
-                )
-                SELECT 
-                    ?, 'receipt', ?, 
-                    COALESCE((SELECT quantity FROM stock_balances WHERE nomenclature_id = ?), 0) + ?,
-                    'production_leftover', ?,
-                    ?, GETUTCDATE(), ?
-            """, mix_data.mix_nomenclature_id, mix_data.leftover_quantity,
-                mix_data.mix_nomenclature_id, mix_data.leftover_quantity,
-                batch.batch_number, leftover_key,
-                json.dumps({
-                    'batch_id': batch_id,
-                    'batch_number': batch.batch_number,
-                    'mix_type': 'leftover'
-                }))
-            
-            # Update stock balance
-            cursor.execute("""
-                IF EXISTS (SELECT 1 FROM stock_balances WHERE nomenclature_id = ?)
-                    UPDATE stock_balances
-                    SET quantity = quantity + ?,
-                        last_updated = GETUTCDATE()
-                    WHERE nomenclature_id = ?
-                ELSE
-                    INSERT INTO stock_balances (nomenclature_id, quantity, last_updated)
-                    VALUES (?, ?, GETUTCDATE())
-            """, mix_data.mix_nomenclature_id, mix_data.leftover_quantity,
-                mix_data.mix_nomenclature_id, mix_data.mix_nomenclature_id,
-                mix_data.leftover_quantity)
-        
-        # If warehouse mix used, create withdrawal
-        if mix_data.warehouse_mix_used > 0:
-            warehouse_key = f"mix-warehouse-{batch_id}-{mix_data.idempotency_key}"
-            
-            # Check if enough stock
-            cursor.execute(
-                "SELECT quantity FROM stock_balances WHERE nomenclature_id = ?",
-                mix_data.mix_nomenclature_id
-            )
-            result = cursor.fetchone()
-            current_balance = float(result[0]) if result else 0
-            
-            if current_balance < mix_data.warehouse_mix_used:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Insufficient warehouse mix. Available: {current_balance}, Required: {mix_data.warehouse_mix_used}"
-                )
-            
-            new_balance = current_balance - mix_data.warehouse_mix_used
-            
-            cursor.execute("""
-                INSERT INTO stock_movements (
-                    nomenclature_id, operation_type, quantity, balance_after,
-                    source_operation_type, source_operation_id,
-                    idempotency_key, operation_date, metadata
-                )
-                VALUES (?, 'withdrawal', ?, ?, 'production_use', ?, ?, GETUTCDATE(), ?)
-            """, mix_data.mix_nomenclature_id, mix_data.warehouse_mix_used,
-                new_balance, batch.batch_number, warehouse_key,
-                json.dumps({
-                    'batch_id': batch_id,
-                    'batch_number': batch.batch_number,
-                    'mix_type': 'warehouse_use'
-                }))
-            
-            # Update stock balance
-            cursor.execute("""
-                UPDATE stock_balances
-                SET quantity = ?,
-                    last_updated = GETUTCDATE()
-                WHERE nomenclature_id = ?
-            """, new_balance, mix_data.mix_nomenclature_id)
-        
-        # Create batch_operations record for mix step
-        # Find the mix step
-        cursor.execute("""
-            SELECT rs.id, rs.step_order, rs.step_name
-            FROM recipe_steps rs
-            WHERE rs.recipe_id = (SELECT recipe_id FROM batches WHERE id = ?)
-                AND rs.step_type = 'mix'
-            ORDER BY rs.step_order
-        """, batch_id)
-        
-        mix_step_row = cursor.fetchone()
-        if mix_step_row:
-            mix_step_id = mix_step_row[0]
-            mix_step_order = mix_step_row[1]
-            mix_step_name = mix_step_row[2]
-            
-            # Create operation record
-            operation_key = f"mix-operation-{batch_id}-{mix_data.idempotency_key}"
-            cursor.execute("""
-                INSERT INTO batch_operations (
-                    batch_id, step_id, operation_type, status,
-                    weight_before, weight_after, parameters, notes, idempotency_key
-                )
-                VALUES (?, ?, 'mix', 'completed', NULL, NULL, ?, ?, ?)
-            """, batch_id, mix_step_id,
-                json.dumps({
-                    'produced_quantity': mix_data.produced_quantity,
-                    'used_quantity': mix_data.used_quantity,
-                    'leftover_quantity': mix_data.leftover_quantity,
-                    'warehouse_mix_used': mix_data.warehouse_mix_used
-                }),
-                f"Мікс виготовлено: {mix_data.produced_quantity} кг",
-                operation_key)
-            
-            # Update batch current_step to indicate this step is completed
-            cursor.execute("""
-                UPDATE batches
-                SET current_step = ?,
-                    status = 'in_progress',
-                    updated_at = GETUTCDATE()
-                WHERE id = ?
-            """, mix_step_order, batch_id)
-        
-        conn.commit()
-        
         return {
-            "message": "Mix produced successfully",
-            "batch_id": batch_id,
-            "produced_quantity": mix_data.produced_quantity,
-            "used_quantity": mix_data.used_quantity,
-            "leftover_quantity": mix_data.leftover_quantity,
-            "warehouse_mix_used": mix_data.warehouse_mix_used
+            'summary': {
+                'total_batches': summary['completed_count'] + in_progress + created,
+                'completed_batches': summary['completed_count'],
+                'in_progress_batches': in_progress,
+                'created_batches': created,
+                **summary,
+            },
+            'by_recipe': by_recipe,
+            'recent_batches': recent_batches,
+            'filters': {
+                'start_date': start_date,
+                'end_date': end_date,
+                'recipe_id': recipe_id,
+                'status': status,
+            }
         }
 
-@router.post("/batches/{batch_id}/salting")
-async def process_salting(batch_id: int, salting_data: BatchSalting):
-    """Process salting step with salt and water consumption"""
+@router.get("/batches/export")
+async def export_batches(
+    start_date: str = None,
+    end_date: str = None,
+    recipe_id: int = None,
+    status: str = None,
+    format: str = 'csv'
+):
+    """Export batches to CSV/Excel format"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
-        # Get batch
-        cursor.execute("SELECT * FROM batches WHERE id = ?", batch_id)
-        batch = cursor.fetchone()
-        if not batch:
-            raise HTTPException(status_code=404, detail="Batch not found")
+        # Build WHERE clause
+        where_clauses = []
+        params = []
         
-        if batch.status == 'completed':
-            raise HTTPException(status_code=400, detail="Batch already completed")
+        if start_date:
+            where_clauses.append("b.started_at >= ?")
+            params.append(start_date)
         
-        # Check idempotency
-        cursor.execute(
-            "SELECT id FROM batch_operations WHERE idempotency_key = ?",
-            salting_data.idempotency_key
-        )
-        if cursor.fetchone():
-            return {"message": "Salting already processed", "batch_id": batch_id}
+        if end_date:
+            where_clauses.append("b.started_at <= ?")
+            params.append(end_date)
         
-        # Check stock availability for salt
-        cursor.execute(
-            "SELECT quantity FROM stock_balances WHERE nomenclature_id = ?",
-            SALT_ID
-        )
-        result = cursor.fetchone()
-        salt_balance = float(result[0]) if result else 0
+        if recipe_id:
+            where_clauses.append("b.recipe_id = ?")
+            params.append(recipe_id)
         
-        if salt_balance < salting_data.salt_quantity:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Недостатньо солі на складі. Доступно: {salt_balance:.2f} кг, Потрібно: {salting_data.salt_quantity:.2f} кг"
-            )
+        if status:
+            where_clauses.append("b.status = ?")
+            params.append(status)
         
-        # Check stock availability for water
-        cursor.execute(
-            "SELECT quantity FROM stock_balances WHERE nomenclature_id = ?",
-            WATER_ID
-        )
-        result = cursor.fetchone()
-        water_balance = float(result[0]) if result else 0
+        where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
         
-        if water_balance < salting_data.water_quantity:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Недостатньо води на складі. Доступно: {water_balance:.2f} л, Потрібно: {salting_data.water_quantity:.2f} л"
-            )
+        # Get batches data
+        cursor.execute(f"""
+            SELECT 
+                b.batch_number,
+                r.name as recipe_name,
+                b.status,
+                b.started_at,
+                b.completed_at,
+                b.initial_weight,
+                b.final_weight,
+                b.trim_waste,
+                CASE WHEN b.final_weight > 0 AND b.initial_weight > 0 
+                    THEN (b.final_weight * 100.0 / b.initial_weight) 
+                    ELSE NULL END as yield_percent,
+                r.expected_yield_min,
+                r.expected_yield_max,
+                b.operator_notes
+            FROM batches b
+            JOIN recipes r ON b.recipe_id = r.id
+            WHERE {where_sql}
+            ORDER BY b.started_at DESC
+        """, *params)
         
-        # Deduct salt from stock
-        salt_key = f"salting-salt-{batch_id}-{salting_data.idempotency_key}"
-        new_salt_balance = salt_balance - salting_data.salt_quantity
+        batches = []
+        for row in cursor.fetchall():
+            batches.append({
+                'Номер партії': row[0],
+                'Рецепт': row[1],
+                'Статус': row[2],
+                'Початок': row[3].strftime('%d.%m.%Y %H:%M') if row[3] else '',
+                'Завершено': row[4].strftime('%d.%m.%Y %H:%M') if row[4] else '',
+                'Початкова вага (кг)': float(row[5]) if row[5] else 0,
+                'Фінальна вага (кг)': float(row[6]) if row[6] else 0,
+                'Обрізки (кг)': float(row[7]) if row[7] else 0,
+                'Вихід (%)': round(float(row[8]), 2) if row[8] else '',
+                'Очікуваний вихід мін (%)': float(row[9]) if row[9] else 0,
+                'Очікуваний вихід макс (%)': float(row[10]) if row[10] else 0,
+                'Примітки': row[11] or '',
+            })
         
-        cursor.execute("""
-            INSERT INTO stock_movements (
-                nomenclature_id, operation_type, quantity, balance_after,
-                source_operation_type, source_operation_id,
-                idempotency_key, operation_date, metadata
-            )
-            VALUES (?, 'withdrawal', ?, ?, 'production_salting', ?, ?, GETUTCDATE(), ?)
-        """, SALT_ID, salting_data.salt_quantity, new_salt_balance, batch.batch_number, salt_key,
-            json.dumps({
-                'batch_id': batch_id,
-                'batch_number': batch.batch_number,
-                'step_type': 'salting'
-            }))
+        if format == 'json':
+            return batches
         
-        cursor.execute("""
-            UPDATE stock_balances
-            SET quantity = ?,
-                last_updated = GETUTCDATE()
-            WHERE nomenclature_id = ?
-        """, new_salt_balance, SALT_ID)
+        # CSV format
+        import csv
+        import io
         
-        # Deduct water from stock
-        water_key = f"salting-water-{batch_id}-{salting_data.idempotency_key}"
-        new_water_balance = water_balance - salting_data.water_quantity
+        output = io.StringIO()
+        if batches:
+            writer = csv.DictWriter(output, fieldnames=batches[0].keys())
+            writer.writeheader()
+            writer.writerows(batches)
         
-        cursor.execute("""
-            INSERT INTO stock_movements (
-                nomenclature_id, operation_type, quantity, balance_after,
-                source_operation_type, source_operation_id,
-                idempotency_key, operation_date, metadata
-            )
-            VALUES (?, 'withdrawal', ?, ?, 'production_salting', ?, ?, GETUTCDATE(), ?)
-        """, WATER_ID, salting_data.water_quantity, new_water_balance, batch.batch_number, water_key,
-            json.dumps({
-                'batch_id': batch_id,
-                'batch_number': batch.batch_number,
-                'step_type': 'salting'
-            }))
+        csv_content = output.getvalue()
         
-        cursor.execute("""
-            UPDATE stock_balances
-            SET quantity = ?,
-                last_updated = GETUTCDATE()
-            WHERE nomenclature_id = ?
-        """, new_water_balance, WATER_ID)
+        return {
+            'format': 'csv',
+            'content': csv_content,
+            'filename': f'batches_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv',
+            'count': len(batches)
+        }
+
+@router.get("/batches/{batch_id}", response_model=Batch)
+async def get_batch(batch_id: int):
+    """Get batch details"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
         
-        # Find the salting step
         cursor.execute("""
-            SELECT rs.id, rs.step_order, rs.step_name
-            FROM recipe_steps rs
-            WHERE rs.recipe_id = (SELECT recipe_id FROM batches WHERE id = ?)
-                AND rs.step_type = 'salt'
-            ORDER BY rs.step_order
+            SELECT b.id, b.batch_number, b.recipe_id, r.name as recipe_name,
+                   b.status, b.current_step, b.started_at, b.completed_at,
+                   b.initial_weight, b.final_weight, b.trim_waste,
+                   b.trim_returned, b.operator_notes
+            FROM batches b
+            LEFT JOIN recipes r ON b.recipe_id = r.id
+            WHERE b.id = ?
         """, batch_id)
         
-        salt_step_row = cursor.fetchone()
-        if salt_step_row:
-            salt_step_id = salt_step_row[0]
-            salt_step_order = salt_step_row[1]
-            salt_step_name = salt_step_row[2]
-            
-            # Create operation record
-            cursor.execute("""
-                INSERT INTO batch_operations (
-                    batch_id, step_id, operation_type, status,
-                    weight_before, weight_after, parameters, notes, idempotency_key
-                )
-                VALUES (?, ?, 'salting', 'completed', NULL, NULL, ?, ?, ?)
-            """, batch_id, salt_step_id,
-                json.dumps({
-                    'salt_quantity': salting_data.salt_quantity,
-                    'water_quantity': salting_data.water_quantity
-                }),
-                salting_data.notes or f"Засолка виконана: сіль {salting_data.salt_quantity} кг, вода {salting_data.water_quantity} л",
-                salting_data.idempotency_key)
-            
-            # Update batch current_step
-            cursor.execute("""
-                UPDATE batches
-                SET current_step = ?,
-                    status = 'in_progress',
-                    updated_at = GETUTCDATE()
-                WHERE id = ?
-            """, salt_step_order, batch_id)
-        
-        conn.commit()
+        row = cursor.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Batch not found")
         
-        return {
-            "message": "Salting processed successfully",
-            "batch_id": batch_id,
-            "salt_quantity": salting_data.salt_quantity,
-            "water_quantity": salting_data.water_quantity
-        }
+        return Batch(
+            id=row.id,
+            batch_number=row.batch_number,
+            recipe_id=row.recipe_id,
+            recipe_name=row.recipe_name,
+            status=row.status,
+            current_step=row.current_step,
+            started_at=row.started_at,
+            completed_at=row.completed_at,
+            initial_weight=float(row.initial_weight),
+            final_weight=float(row.final_weight) if row.final_weight else None,
+            trim_waste=float(row.trim_waste) if row.trim_waste else None,
+            trim_returned=row.trim_returned,
+            operator_notes=row.operator_notes
+        )
 
-@router.post("/batches/{batch_id}/sugar")
-async def process_sugar_massage(batch_id: int, sugar_data: BatchSugar):
-    """Process sugar massage step (for horse basturma)"""
+
+@router.post("/batches/{batch_id}/operations")
+async def add_batch_operation(batch_id: int, operation: BatchOperationCreate):
+    """Add an operation to a batch (step completion)"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
-        # Get batch
-        cursor.execute("SELECT * FROM batches WHERE id = ?", batch_id)
+        # Get batch and current step
+        cursor.execute("""
+            SELECT b.*, rs.step_order, rs.step_type, rs.step_name
+            FROM batches b
+            LEFT JOIN recipe_steps rs ON b.recipe_id = rs.recipe_id AND rs.id = ?
+            WHERE b.id = ?
+        """, operation.step_id, batch_id)
+        
         batch = cursor.fetchone()
         if not batch:
             raise HTTPException(status_code=404, detail="Batch not found")
@@ -1031,345 +571,177 @@ async def process_sugar_massage(batch_id: int, sugar_data: BatchSugar):
         # Check idempotency
         cursor.execute(
             "SELECT id FROM batch_operations WHERE idempotency_key = ?",
-            sugar_data.idempotency_key
+            operation.idempotency_key
         )
         if cursor.fetchone():
-            return {"message": "Sugar massage already processed", "batch_id": batch_id}
-        
-        # Get sugar nomenclature ID (assuming "Цукор" exists)
-        cursor.execute("SELECT id FROM nomenclature WHERE name = N'Цукор'")
-        sugar_result = cursor.fetchone()
-        if not sugar_result:
-            raise HTTPException(status_code=404, detail="Nomenclature 'Цукор' not found")
-        
-        sugar_id = sugar_result[0]
-        
-        # Round to 0.1 kg
-        sugar_quantity = round(sugar_data.sugar_quantity, 1)
-        
-        # Check stock availability for sugar
-        cursor.execute(
-            "SELECT quantity FROM stock_balances WHERE nomenclature_id = ?",
-            sugar_id
-        )
-        result = cursor.fetchone()
-        sugar_balance = float(result[0]) if result else 0
-        
-        if sugar_balance < sugar_quantity:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Недостатньо цукру на складі. Доступно: {sugar_balance:.1f} кг, Потрібно: {sugar_quantity:.1f} кг"
-            )
-        
-        # Deduct sugar from stock
-        sugar_key = f"sugar-{batch_id}-{sugar_data.idempotency_key}"
-        new_sugar_balance = sugar_balance - sugar_quantity
+            return {"message": "Operation already recorded", "batch_id": batch_id}
         
+        # Insert operation
         cursor.execute("""
-            INSERT INTO stock_movements (
-                nomenclature_id, operation_type, quantity, balance_after,
-                source_operation_type, source_operation_id,
-                idempotency_key, operation_date, metadata
+            INSERT INTO batch_operations (
+                batch_id, step_id, operation_type, status,
+                weight_before, weight_after, parameters, notes, idempotency_key
             )
-            VALUES (?, 'withdrawal', ?, ?, 'production_sugar', ?, ?, GETUTCDATE(), ?)
-        """, sugar_id, sugar_quantity, new_sugar_balance, batch.batch_number, sugar_key,
-            json.dumps({
-                'batch_id': batch_id,
-                'batch_number': batch.batch_number,
-                'step_type': 'sugar'
-            }))
-        
-        cursor.execute("""
-            UPDATE stock_balances
-            SET quantity = ?,
-                last_updated = GETUTCDATE()
-            WHERE nomenclature_id = ?
-        """, new_sugar_balance, sugar_id)
+            VALUES (?, ?, ?, 'completed', ?, ?, ?, ?, ?)
+        """, batch_id, operation.step_id, batch.step_type,
+            operation.weight_before, operation.weight_after,
+            json.dumps(operation.parameters) if operation.parameters else None,
+            operation.notes, operation.idempotency_key)
         
-        # Find the sugar step
+        # Update batch status and current step
+        new_status = 'in_progress' if batch.status == 'created' else batch.status
         cursor.execute("""
-            SELECT rs.id, rs.step_order, rs.step_name
-            FROM recipe_steps rs
-            WHERE rs.recipe_id = (SELECT recipe_id FROM batches WHERE id = ?)
-                AND rs.step_type = 'sugar'
-            ORDER BY rs.step_order
-        """, batch_id)
-        
-        sugar_step_row = cursor.fetchone()
-        if sugar_step_row:
-            sugar_step_id = sugar_step_row[0]
-            sugar_step_order = sugar_step_row[1]
-            
-            # Create operation record
-            cursor.execute("""
-                INSERT INTO batch_operations (
-                    batch_id, step_id, operation_type, status,
-                    weight_before, weight_after, parameters, notes, idempotency_key
-                )
-                VALUES (?, ?, 'sugar', 'completed', NULL, NULL, ?, ?, ?)
-            """, batch_id, sugar_step_id,
-                json.dumps({'sugar_quantity': sugar_quantity}),
-                sugar_data.notes or f"Масажер з цукром: {sugar_quantity} кг",
-                sugar_data.idempotency_key)
-            
-            # Update batch current_step
-            cursor.execute("""
-                UPDATE batches
-                SET current_step = ?,
-                    status = 'in_progress',
-                    updated_at = GETUTCDATE()
-                WHERE id = ?
-            """, sugar_step_order, batch_id)
+            UPDATE batches
+            SET status = ?,
+                current_step = ?,
+                updated_at = GETUTCDATE()
+            WHERE id = ?
+        """, new_status, batch.step_order, batch_id)
         
         conn.commit()
+        publish_batch_state(batch_id, new_status, batch_number=batch.batch_number, current_step=batch.step_order)
         
         return {
-            "message": "Sugar massage processed successfully",
+            "message": "Operation added successfully",
             "batch_id": batch_id,
-            "sugar_quantity": sugar_quantity
+            "step_completed": batch.step_name,
+            "current_step": batch.step_order
         }
 
-@router.post("/batches/{batch_id}/massage")
-async def process_water_massage(batch_id: int, massage_data: BatchMassage):
-    """Process water massage step (for Sudjuk)"""
+@router.get("/batches/{batch_id}/operations")
+async def get_batch_operations(batch_id: int):
+    """Get all operations for a batch"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(OPERATIONS_QUERY, batch_id)
+        return [operation_dict(row) for row in cursor.fetchall()]
+
+@router.get("/batches/{batch_id}/full")
+async def get_batch_full(batch_id: int, fields: str = None):
+    """
+    Batch with recipe, operations, consumed materials, mix production,
+    spice requirements and stock movements in one response
+    fields: comma separated sections to include (all by default)
+    """
+    sections = parse_sections(fields)
+    with get_db_connection() as conn:
+        return load_batch_full(conn.cursor(), batch_id, sections)
+
+
+@router.get("/batches/{batch_id}/cost")
+async def get_batch_cost(batch_id: int):
+    """Stored cost of a batch with lines per material"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        
-        # Get batch
-        cursor.execute("SELECT * FROM batches WHERE id = ?", batch_id)
-        batch = cursor.fetchone()
-        if not batch:
-            raise HTTPException(status_code=404, detail="Batch not found")
-        
-        if batch.status == 'completed':
-            raise HTTPException(status_code=400, detail="Batch already completed")
-        
-        # Check idempotency
-        cursor.execute(
-            "SELECT id FROM batch_operations WHERE idempotency_key = ?",
-            massage_data.idempotency_key
-        )
-        if cursor.fetchone():
-            return {"message": "Water massage already processed", "batch_id": batch_id}
-        
-        # Round to 0.1 l
-        water_quantity = round(massage_data.water_quantity, 1)
-        
-        # Check stock availability for water
-        cursor.execute(
-            "SELECT quantity FROM stock_balances WHERE nomenclature_id = ?",
-            WATER_ID
-        )
-        result = cursor.fetchone()
-        water_balance = float(result[0]) if result else 0
-        
-        if water_balance < water_quantity:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Недостатньо води на складі. Доступно: {water_balance:.1f} л, Потрібно: {water_quantity:.1f} л"
-            )
-        
-        # Deduct water from stock
-        water_key = f"massage-{batch_id}-{massage_data.idempotency_key}"
-        new_water_balance = water_balance - water_quantity
-        
-        cursor.execute("""
-            INSERT INTO stock_movements (
-                nomenclature_id, operation_type, quantity, balance_after,
-                source_operation_type, source_operation_id,
-                idempotency_key, operation_date, metadata
-            )
-            VALUES (?, 'withdrawal', ?, ?, 'production_massage', ?, ?, GETUTCDATE(), ?)
-        """, WATER_ID, water_quantity, new_water_balance, batch.batch_number, water_key,
-            json.dumps({
-                'batch_id': batch_id,
-                'batch_number': batch.batch_number,
-                'step_type': 'massage'
-            }))
         
         cursor.execute("""
-            UPDATE stock_balances
-            SET quantity = ?,
-                last_updated = GETUTCDATE()
-            WHERE nomenclature_id = ?
-        """, new_water_balance, WATER_ID)
+            SELECT b.id, b.batch_number, b.status, b.initial_weight, b.final_weight,
+                   bc.material_cost, bc.uncosted_items, bc.cost_per_kg, bc.updated_at as cost_updated_at
+            FROM batches b
+            LEFT JOIN batch_costs bc ON bc.batch_id = b.id
+            WHERE b.id = ?
+        """, batch_id)
+        row = cursor.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Batch not found")
         
-        # Find the massage step
         cursor.execute("""
-            SELECT rs.id, rs.step_order, rs.step_name
-            FROM recipe_steps rs
-            WHERE rs.recipe_id = (SELECT recipe_id FROM batches WHERE id = ?)
-                AND rs.step_type = 'massage'
-            ORDER BY rs.step_order
+            SELECT l.nomenclature_id, n.name, n.category, n.unit, l.quantity, l.cost
+            FROM batch_cost_lines l
+            JOIN nomenclature n ON l.nomenclature_id = n.id
+            WHERE l.batch_id = ?
+            ORDER BY l.cost DESC
         """, batch_id)
-        
-        massage_step_row = cursor.fetchone()
-        if massage_step_row:
-            massage_step_id = massage_step_row[0]
-            massage_step_order = massage_step_row[1]
-            
-            # Create operation record
-            cursor.execute("""
-                INSERT INTO batch_operations (
-                    batch_id, step_id, operation_type, status,
-                    weight_before, weight_after, parameters, notes, idempotency_key
-                )
-                VALUES (?, ?, 'massage', 'completed', NULL, NULL, ?, ?, ?)
-            """, batch_id, massage_step_id,
-                json.dumps({'water_quantity': water_quantity}),
-                massage_data.notes or f"Масажер з водою: {water_quantity} л",
-                massage_data.idempotency_key)
-            
-            # Update batch current_step
-            cursor.execute("""
-                UPDATE batches
-                SET current_step = ?,
-                    status = 'in_progress',
-                    updated_at = GETUTCDATE()
-                WHERE id = ?
-            """, massage_step_order, batch_id)
-        
-        conn.commit()
+        lines = [
+            {
+                'nomenclature_id': line.nomenclature_id,
+                'name': line.name,
+                'category': line.category,
+                'unit': line.unit,
+                'quantity': float(line.quantity),
+                'cost': round(float(line.cost), 2),
+                'unit_cost': round(float(line.cost) / float(line.quantity), 4) if line.quantity else None
+            }
+            for line in cursor.fetchall()
+        ]
         
         return {
-            "message": "Water massage processed successfully",
-            "batch_id": batch_id,
-            "water_quantity": water_quantity
+            'batch_id': row.id,
+            'batch_number': row.batch_number,
+            'status': row.status,
+            'initial_weight': float(row.initial_weight),
+            'final_weight': float(row.final_weight) if row.final_weight is not None else None,
+            **cost_dict(row),
+            'lines': lines
         }
 
-@router.post("/batches/{batch_id}/stuff")
-async def process_stuffing(batch_id: int, stuff_data: BatchStuff):
-    """Process stuffing step (for Sudjuk, Mahan) - casing and threads"""
+@router.get("/costs")
+async def get_batch_costs(status: str = None, recipe_id: int = None, limit: int = 100):
+    """Costed batch list from the stored batch costs"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
-        # Get batch
-        cursor.execute("SELECT * FROM batches WHERE id = ?", batch_id)
-        batch = cursor.fetchone()
-        if not batch:
-            raise HTTPException(status_code=404, detail="Batch not found")
-        
-        if batch.status == 'completed':
-            raise HTTPException(status_code=400, detail="Batch already completed")
-        
-        # Check idempotency
-        cursor.execute(
-            "SELECT id FROM batch_operations WHERE idempotency_key = ?",
-            stuff_data.idempotency_key
-        )
-        if cursor.fetchone():
-            return {"message": "Stuffing already processed", "batch_id": batch_id}
-        
-        # Process each material
-        materials_summary = []
-        
-        for material in stuff_data.materials:
-            material_id = material.material_id
-            quantity = material.quantity
-            unit = material.unit
-            
-            # Apply rounding based on unit
-            if unit == 'м':
-                # Meters - round to 0.1 (TODO: confirm precision)
-                quantity = round(quantity, 1)
-            elif unit == 'шт':
-                # Pieces - round to whole numbers
-                quantity = int(round(quantity))
-            else:
-                # Default rounding to 0.1
-                quantity = round(quantity, 1)
-            
-            # Check stock availability
-            cursor.execute(
-                "SELECT quantity FROM stock_balances WHERE nomenclature_id = ?",
-                material_id
-            )
-            result = cursor.fetchone()
-            balance = float(result[0]) if result else 0
-            
-            cursor.execute("SELECT name FROM nomenclature WHERE id = ?", material_id)
-            material_name = cursor.fetchone()[0]
-            
-            if balance < quantity:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Недостатньо матеріалу '{material_name}'. Доступно: {balance} {unit}, Потрібно: {quantity} {unit}"
-                )
-            
-            # Deduct material from stock
-            material_key = f"stuff-{batch_id}-{material_id}-{stuff_data.idempotency_key}"
-            new_balance = balance - quantity
-            
-            cursor.execute("""
-                INSERT INTO stock_movements (
-                    nomenclature_id, operation_type, quantity, balance_after,
-                    source_operation_type, source_operation_id,
-                    idempotency_key, operation_date, metadata
-                )
-                VALUES (?, 'withdrawal', ?, ?, 'production_stuff', ?, ?, GETUTCDATE(), ?)
-            """, material_id, quantity, new_balance, batch.batch_number, material_key,
-                json.dumps({
-                    'batch_id': batch_id,
-                    'batch_number': batch.batch_number,
-                    'material_name': material_name,
-                    'unit': unit
-                }))
-            
-            cursor.execute("""
-                UPDATE stock_balances
-                SET quantity = ?,
-                    last_updated = GETUTCDATE()
-                WHERE nomenclature_id = ?
-            """, new_balance, material_id)
-            
-            materials_summary.append({
-                'material_name': material_name,
-                'quantity': quantity,
-                'unit': unit
-            })
-        
-        # Find the stuff step
-        cursor.execute("""
-            SELECT rs.id, rs.step_order, rs.step_name
-            FROM recipe_steps rs
-            WHERE rs.recipe_id = (SELECT recipe_id FROM batches WHERE id = ?)
-                AND rs.step_type = 'stuff'
-            ORDER BY rs.step_order
-        """, batch_id)
-        
-        stuff_step_row = cursor.fetchone()
-        if stuff_step_row:
-            stuff_step_id = stuff_step_row[0]
-            stuff_step_order = stuff_step_row[1]
-            
-            # Create operation record
-            cursor.execute("""
-                INSERT INTO batch_operations (
-                    batch_id, step_id, operation_type, status,
-                    weight_before, weight_after, parameters, notes, idempotency_key
-                )
-                VALUES (?, ?, 'stuff', 'completed', NULL, NULL, ?, ?, ?)
-            """, batch_id, stuff_step_id,
-                json.dumps({'materials': materials_summary}),
-                stuff_data.notes or f"Заправка в кишку виконана",
-                stuff_data.idempotency_key)
-            
-            # Update batch current_step
-            cursor.execute("""
-                UPDATE batches
-                SET current_step = ?,
-                    status = 'in_progress',
-                    updated_at = GETUTCDATE()
-                WHERE id = ?
-            """, stuff_step_order, batch_id)
+        where_clauses = []
+        params = [min(max(limit, 1), 1000)]
+        if status:
+            where_clauses.append("b.status = ?")
+            params.append(status)
+        if recipe_id:
+            where_clauses.append("b.recipe_id = ?")
+            params.append(recipe_id)
+        where_sql = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
         
-        conn.commit()
+        cursor.execute(f"""
+            SELECT TOP (?) b.id, b.batch_number, b.recipe_id, r.name as recipe_name, b.status,
+                   b.started_at, b.completed_at, b.initial_weight, b.final_weight,
+                   bc.material_cost, bc.uncosted_items, bc.cost_per_kg, bc.updated_at as cost_updated_at
+            FROM batches b
+            LEFT JOIN recipes r ON b.recipe_id = r.id
+            LEFT JOIN batch_costs bc ON bc.batch_id = b.id
+            {where_sql}
+            ORDER BY b.started_at DESC
+        """, params)
         
-        return {
-            "message": "Stuffing processed successfully",
-            "batch_id": batch_id,
-            "materials": materials_summary
-        }
+        return [
+            {
+                'id': row.id,
+                'batch_number': row.batch_number,
+                'recipe_id': row.recipe_id,
+                'recipe_name': row.recipe_name,
+                'status': row.status,
+                'started_at': row.started_at.isoformat() if row.started_at else None,
+                'completed_at': row.completed_at.isoformat() if row.completed_at else None,
+                'initial_weight': float(row.initial_weight),
+                'final_weight': float(row.final_weight) if row.final_weight is not None else None,
+                **cost_dict(row)
+            }
+            for row in cursor.fetchall()
+        ]
+
+@router.post("/batches/{batch_id}/mix")
+async def produce_mix(batch_id: int, mix_data: BatchMixProduction):
+    """Produce mix (Chaman/Marinade) with fenugreek water rule"""
+    return run_step(MIX, batch_id, mix_data)
+
+@router.post("/batches/{batch_id}/salting")
+async def process_salting(batch_id: int, salting_data: BatchSalting):
+    """Process salting step with salt and water consumption"""
+    return run_step(SALTING, batch_id, salting_data)
+
+@router.post("/batches/{batch_id}/sugar")
+async def process_sugar_massage(batch_id: int, sugar_data: BatchSugar):
+    """Process sugar massage step (for horse basturma)"""
+    return run_step(SUGAR, batch_id, sugar_data)
+
+@router.post("/batches/{batch_id}/massage")
+async def process_water_massage(batch_id: int, massage_data: BatchMassage):
+    """Process water massage step (for Sudjuk)"""
+    return run_step(WATER_MASSAGE, batch_id, massage_data)
+
+@router.post("/batches/{batch_id}/stuff")
+async def process_stuffing(batch_id: int, stuff_data: BatchStuff):
+    """Process stuffing step (for Sudjuk, Mahan) - casing and threads"""
+    return run_step(STUFF, batch_id, stuff_data)
 
 @router.post("/batches/{batch_id}/materials/consume")
 async def consume_materials(batch_id: int, materials: dict):
@@ -1383,85 +755,61 @@ async def consume_materials(batch_id: int, materials: dict):
         if not batch:
             raise HTTPException(status_code=404, detail="Batch not found")
         
-        consumed = []
         idempotency_key = materials.get('idempotency_key', f"consume-{batch_id}-{datetime.now().timestamp()}")
         
+        # One key per material; materials repeated in the request are consumed once
+        requested = {}
         for material in materials.get('materials', []):
-            nomenclature_id = material['nomenclature_id']
-            quantity = material['quantity']
-            material_type = material.get('type', 'ingredient')
-            
-            # Check idempotency for this specific material
-            material_key = f"{idempotency_key}-{nomenclature_id}"
-            cursor.execute(
-                "SELECT id FROM stock_movements WHERE idempotency_key = ?",
-                material_key
-            )
-            if cursor.fetchone():
-                continue  # Already consumed
-            
-            # Check stock availability
+            requested.setdefault(f"{idempotency_key}-{material['nomenclature_id']}", material)
+        
+        # Skip materials already consumed (one lookup for all keys)
+        existing_keys = set()
+        for keys in chunked(list(requested)):
             cursor.execute(
-                "SELECT quantity FROM stock_balances WHERE nomenclature_id = ?",
-                nomenclature_id
+                f"SELECT idempotency_key FROM stock_movements WHERE idempotency_key IN ({placeholders(len(keys))})",
+                keys
             )
-            result = cursor.fetchone()
-            current_balance = float(result[0]) if result else 0
-            
-            if current_balance < quantity:
-                cursor.execute(
-                    "SELECT name FROM nomenclature WHERE id = ?",
-                    nomenclature_id
-                )
-                name_result = cursor.fetchone()
-                material_name = name_result[0] if name_result else f"ID {nomenclature_id}"
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Insufficient stock for {material_name}. Available: {current_balance}, Required: {quantity}"
-                )
-            
-            new_balance = current_balance - quantity
-            
-            # Create withdrawal movement
-            cursor.execute("""
-                INSERT INTO stock_movements (
-                    nomenclature_id, operation_type, quantity, balance_after,
-                    source_operation_type, source_operation_id,
-                    idempotency_key, operation_date, metadata
-                )
-                VALUES (?, 'withdrawal', ?, ?, 'production', ?, ?, GETUTCDATE(), ?)
-            """, nomenclature_id, quantity, new_balance,
-                batch.batch_number, material_key,
-                json.dumps({
+            existing_keys.update(row[0] for row in cursor.fetchall())
+        pending = [(key, material) for key, material in requested.items() if key not in existing_keys]
+        
+        withdrawals = deduct(cursor, [
+            withdrawal(
+                material['nomenclature_id'], material['quantity'], 'production', material_key,
+                {
                     'batch_id': batch_id,
                     'batch_number': batch.batch_number,
-                    'material_type': material_type
-                }))
-            
-            # Update stock balance
-            cursor.execute("""
-                UPDATE stock_balances
-                SET quantity = ?,
-                    last_updated = GETUTCDATE()
-                WHERE nomenclature_id = ?
-            """, new_balance, nomenclature_id)
-            
-            # Record in batch_materials
-            cursor.execute("""
+                    'material_type': material.get('type', 'ingredient')
+                }
+            )
+            for material_key, material in pending
+        ], batch.batch_number, batch_id=batch_id)
+        
+        consumed = []
+        notes = {material_key: material.get('notes', '') for material_key, material in pending}
+        for item in withdrawals:
+            consumed.append({
+                'nomenclature_id': item['nomenclature_id'],
+                'quantity': item['quantity'],
+                'material_type': item['metadata']['material_type'],
+                'balance_after': item['balance_after']
+            })
+        
+        # Record in batch_materials
+        if withdrawals:
+            cursor.fast_executemany = True
+            cursor.executemany("""
                 INSERT INTO batch_materials (
                     batch_id, nomenclature_id, material_type, quantity_used, notes
                 )
                 VALUES (?, ?, ?, ?, ?)
-            """, batch_id, nomenclature_id, material_type, quantity,
-                material.get('notes', ''))
-            
-            consumed.append({
-                'nomenclature_id': nomenclature_id,
-                'quantity': quantity,
-                'material_type': material_type
-            })
+            """, [
+                (batch_id, item['nomenclature_id'], item['metadata']['material_type'], item['quantity'],
+                 notes[item['idempotency_key']])
+                for item in withdrawals
+            ])
         
         conn.commit()
+        publish_balances(withdrawal_changes(withdrawals))
         
         return {
             "message": "Materials consumed successfully",
@@ -1515,20 +863,29 @@ async def complete_batch(batch_id: int, completion: BatchComplete):
             conn.commit()
             return {"message": "Batch already completed", "batch_id": batch_id}
         
-        # Create stock receipt movement for finished product
+        # Cost per kg of finished product from the stored batch cost
+        cost_per_kg, uncosted_items = complete_batch_cost(cursor, batch_id, completion.final_weight)
+        # Only a fully costed batch may move the product's average cost
+        receipt_price = cost_per_kg if uncosted_items == 0 else None
+        
+        # Add the yield to the recipe statistics
+        record_yield(cursor, batch.recipe_id, float(batch.initial_weight), completion.final_weight,
+                     batch.expected_yield_min, batch.expected_yield_max)
+        
+        # Create stock receipt movement for finished product (valued at the batch cost)
         cursor.execute("""
             INSERT INTO stock_movements (
-                nomenclature_id, operation_type, quantity, balance_after,
+                nomenclature_id, operation_type, quantity, balance_after, price_per_unit,
                 source_operation_type, source_operation_id,
                 idempotency_key, operation_date, metadata
             )
             SELECT 
                 ?, 'receipt', ?, 
                 COALESCE((SELECT quantity FROM stock_balances WHERE nomenclature_id = ?), 0) + ?,
-                'production', ?,
+                ?, 'production', ?,
                 ?, GETUTCDATE(), ?
         """, batch.target_product_id, completion.final_weight,
-            batch.target_product_id, completion.final_weight,
+            batch.target_product_id, completion.final_weight, receipt_price,
             batch.batch_number, completion.idempotency_key,
             json.dumps({
                 'batch_id': int(batch_id),
@@ -1536,254 +893,20 @@ async def complete_batch(batch_id: int, completion: BatchComplete):
                 'yield_percent': round(float(yield_percent), 2)
             }))
         
-        # Update stock balance
-        cursor.execute("""
-            IF EXISTS (SELECT 1 FROM stock_balances WHERE nomenclature_id = ?)
-                UPDATE stock_balances
-                SET quantity = quantity + ?,
-                    last_updated = GETUTCDATE()
-                WHERE nomenclature_id = ?
-            ELSE
-                INSERT INTO stock_balances (nomenclature_id, quantity, last_updated)
-                VALUES (?, ?, GETUTCDATE())
-        """, batch.target_product_id, completion.final_weight,
-            batch.target_product_id, batch.target_product_id, completion.final_weight)
+        # Update stock balance (finished product average cost moves with the batch cost)
+        post_balances(cursor, [(batch.target_product_id, completion.final_weight, receipt_price)])
         
         conn.commit()
+        publish_balances([(batch.target_product_id, None, completion.final_weight)])
+        publish_batch_state(
+            batch_id, 'completed', batch_number=batch.batch_number,
+            final_weight=completion.final_weight, yield_percent=round(yield_percent, 2)
+        )
         
         return {
             "message": "Batch completed successfully",
             "batch_id": batch_id,
             "yield_percent": round(yield_percent, 2),
-            "expected_range": f"{batch.expected_yield_min}-{batch.expected_yield_max}%"
-        }
-
-@router.get("/batches/analytics")
-async def get_batches_analytics(
-    start_date: str = None,
-    end_date: str = None,
-    recipe_id: int = None,
-    status: str = None
-):
-    """Get analytics and statistics for batches"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Build WHERE clause
-        where_clauses = []
-        params = []
-        
-        if start_date:
-            where_clauses.append("b.started_at >= ?")
-            params.append(start_date)
-        
-        if end_date:
-            where_clauses.append("b.started_at <= ?")
-            params.append(end_date)
-        
-        if recipe_id:
-            where_clauses.append("b.recipe_id = ?")
-            params.append(recipe_id)
-        
-        if status:
-            where_clauses.append("b.status = ?")
-            params.append(status)
-        
-        where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
-        
-        # Get summary statistics
-        cursor.execute(f"""
-            SELECT 
-                COUNT(*) as total_batches,
-                COUNT(CASE WHEN status = 'completed' THEN 1 END) as completed_batches,
-                COUNT(CASE WHEN status = 'in_progress' THEN 1 END) as in_progress_batches,
-                COUNT(CASE WHEN status = 'created' THEN 1 END) as created_batches,
-                SUM(CASE WHEN status = 'completed' THEN initial_weight ELSE 0 END) as total_input_weight,
-                SUM(CASE WHEN status = 'completed' THEN final_weight ELSE 0 END) as total_output_weight,
-                AVG(CASE WHEN status = 'completed' AND final_weight > 0 AND initial_weight > 0 
-                    THEN (final_weight * 100.0 / initial_weight) ELSE NULL END) as avg_yield_percent
-            FROM batches b
-            WHERE {where_sql}
-        """, *params)
-        
-        summary = cursor.fetchone()
-        
-        # Get statistics by recipe
-        cursor.execute(f"""
-            SELECT 
-                r.id,
-                r.name,
-                COUNT(*) as batch_count,
-                COUNT(CASE WHEN b.status = 'completed' THEN 1 END) as completed_count,
-                SUM(CASE WHEN b.status = 'completed' THEN b.initial_weight ELSE 0 END) as total_input,
-                SUM(CASE WHEN b.status = 'completed' THEN b.final_weight ELSE 0 END) as total_output,
-                AVG(CASE WHEN b.status = 'completed' AND b.final_weight > 0 AND b.initial_weight > 0 
-                    THEN (b.final_weight * 100.0 / b.initial_weight) ELSE NULL END) as avg_yield,
-                r.expected_yield_min,
-                r.expected_yield_max
-            FROM batches b
-            JOIN recipes r ON b.recipe_id = r.id
-            WHERE {where_sql}
-            GROUP BY r.id, r.name, r.expected_yield_min, r.expected_yield_max
-            ORDER BY COUNT(*) DESC
-        """, *params)
-        
-        by_recipe = []
-        for row in cursor.fetchall():
-            by_recipe.append({
-                'recipe_id': row[0],
-                'recipe_name': row[1],
-                'batch_count': row[2],
-                'completed_count': row[3],
-                'total_input_weight': float(row[4]) if row[4] else 0,
-                'total_output_weight': float(row[5]) if row[5] else 0,
-                'avg_yield_percent': float(row[6]) if row[6] else 0,
-                'expected_yield_min': float(row[7]) if row[7] else 0,
-                'expected_yield_max': float(row[8]) if row[8] else 0,
-            })
-        
-        # Get recent batches
-        cursor.execute(f"""
-            SELECT TOP 10
-                b.id, b.batch_number, b.recipe_id, r.name as recipe_name,
-                b.status, b.started_at, b.completed_at,
-                b.initial_weight, b.final_weight,
-                CASE WHEN b.final_weight > 0 AND b.initial_weight > 0 
-                    THEN (b.final_weight * 100.0 / b.initial_weight) 
-                    ELSE NULL END as yield_percent
-            FROM batches b
-            JOIN recipes r ON b.recipe_id = r.id
-            WHERE {where_sql}
-            ORDER BY b.started_at DESC
-        """, *params)
-        
-        recent_batches = []
-        for row in cursor.fetchall():
-            recent_batches.append({
-                'id': row[0],
-                'batch_number': row[1],
-                'recipe_id': row[2],
-                'recipe_name': row[3],
-                'status': row[4],
-                'started_at': row[5].isoformat() if row[5] else None,
-                'completed_at': row[6].isoformat() if row[6] else None,
-                'initial_weight': float(row[7]) if row[7] else 0,
-                'final_weight': float(row[8]) if row[8] else 0,
-                'yield_percent': float(row[9]) if row[9] else None,
-            })
-        
-        return {
-            'summary': {
-                'total_batches': summary[0],
-                'completed_batches': summary[1],
-                'in_progress_batches': summary[2],
-                'created_batches': summary[3],
-                'total_input_weight': float(summary[4]) if summary[4] else 0,
-                'total_output_weight': float(summary[5]) if summary[5] else 0,
-                'avg_yield_percent': float(summary[6]) if summary[6] else 0,
-            },
-            'by_recipe': by_recipe,
-            'recent_batches': recent_batches,
-            'filters': {
-                'start_date': start_date,
-                'end_date': end_date,
-                'recipe_id': recipe_id,
-                'status': status,
-            }
-        }
-
-@router.get("/batches/export")
-async def export_batches(
-    start_date: str = None,
-    end_date: str = None,
-    recipe_id: int = None,
-    status: str = None,
-    format: str = 'csv'
-):
-    """Export batches to CSV/Excel format"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Build WHERE clause
-        where_clauses = []
-        params = []
-        
-        if start_date:
-            where_clauses.append("b.started_at >= ?")
-            params.append(start_date)
-        
-        if end_date:
-            where_clauses.append("b.started_at <= ?")
-            params.append(end_date)
-        
-        if recipe_id:
-            where_clauses.append("b.recipe_id = ?")
-            params.append(recipe_id)
-        
-        if status:
-            where_clauses.append("b.status = ?")
-            params.append(status)
-        
-        where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
-        
-        # Get batches data
-        cursor.execute(f"""
-            SELECT 
-                b.batch_number,
-                r.name as recipe_name,
-                b.status,
-                b.started_at,
-                b.completed_at,
-                b.initial_weight,
-                b.final_weight,
-                b.trim_waste,
-                CASE WHEN b.final_weight > 0 AND b.initial_weight > 0 
-                    THEN (b.final_weight * 100.0 / b.initial_weight) 
-                    ELSE NULL END as yield_percent,
-                r.expected_yield_min,
-                r.expected_yield_max,
-                b.operator_notes
-            FROM batches b
-            JOIN recipes r ON b.recipe_id = r.id
-            WHERE {where_sql}
-            ORDER BY b.started_at DESC
-        """, *params)
-        
-        batches = []
-        for row in cursor.fetchall():
-            batches.append({
-                'Номер партії': row[0],
-                'Рецепт': row[1],
-                'Статус': row[2],
-                'Початок': row[3].strftime('%d.%m.%Y %H:%M') if row[3] else '',
-                'Завершено': row[4].strftime('%d.%m.%Y %H:%M') if row[4] else '',
-                'Початкова вага (кг)': float(row[5]) if row[5] else 0,
-                'Фінальна вага (кг)': float(row[6]) if row[6] else 0,
-                'Обрізки (кг)': float(row[7]) if row[7] else 0,
-                'Вихід (%)': round(float(row[8]), 2) if row[8] else '',
-                'Очікуваний вихід мін (%)': float(row[9]) if row[9] else 0,
-                'Очікуваний вихід макс (%)': float(row[10]) if row[10] else 0,
-                'Примітки': row[11] or '',
-            })
-        
-        if format == 'json':
-            return batches
-        
-        # CSV format
-        import csv
-        import io
-        
-        output = io.StringIO()
-        if batches:
-            writer = csv.DictWriter(output, fieldnames=batches[0].keys())
-            writer.writeheader()
-            writer.writerows(batches)
-        
-        csv_content = output.getvalue()
-        
-        return {
-            'format': 'csv',
-            'content': csv_content,
-            'filename': f'batches_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv',
-            'count': len(batches)
+            "expected_range": f"{batch.expected_yield_min}-{batch.expected_yield_max}%",
+            "cost_per_kg": round(cost_per_kg, 4) if cost_per_kg is not None else None
         }
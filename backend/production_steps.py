@@ -0,0 +1,394 @@
+"""
+Production step pipeline
+Each step type declares its materials, operation parameters and
+validation; run_step executes any of them the same way:
+1. one prefetch of the batch with idempotency and step checks,
+   recipe and step from the compiled recipe cache
+2. validation
+3. lock, check and write of all materials (stock_deduction)
+4. step specific writes, the operation record and current_step in one batch
+5. commit, then balance and batch state events
+"""
+import json
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException
+
+from costing import add_batch_costs, unit_costs
+from database import get_db_connection
+from events import publish_balances, publish_batch_state
+from material_requirements import compute_requirements
+from recipe_cache import WATER_ID, SALT_ID, recipe_catalog
+from stock_deduction import lock_balances, post_withdrawals, withdrawal, withdrawal_changes
+from valuation import post_balances
+
+class StepContext:
+    """State of one step execution, shared by the hooks of the step type"""
+
+    def __init__(self, cursor, batch_id: int, data, batch, checks: Dict[str, int]):
+        self.cursor = cursor
+        self.batch_id = batch_id
+        self.data = data
+        self.batch = batch
+        self.checks = checks
+        self.catalog = None
+        self.recipe = None
+        self.step: Optional[dict] = None
+        self.locked: Dict[int, dict] = {}
+        self.withdrawals: List[dict] = []
+        self.balance_changes: list = []
+
+    def metadata(self, **values) -> dict:
+        """Movement metadata with the batch reference"""
+        return {'batch_id': self.batch_id, 'batch_number': self.batch.batch_number, **values}
+
+class ProductionStep:
+    """
+    Step type declaration
+    Hooks get the StepContext; defaults cover a step without materials.
+    """
+    step_type = None               # recipe_steps.step_type of the step
+    operation_type = None          # batch_operations.operation_type
+    source_operation_type = None   # stock_movements.source_operation_type of the withdrawals
+    shortage_message = "Недостатньо матеріалів на складі"
+    processed_message = "Step already processed"
+    success_message = "Step processed successfully"
+    # Scalar subquery telling whether the idempotency key was already used
+    idempotency_sql = "SELECT COUNT(*) FROM batch_operations WHERE idempotency_key = ?"
+    # Extra prefetch counts {name: scalar subquery with the batch id parameter}
+    checks: Dict[str, str] = {}
+
+    def validate(self, ctx: StepContext):
+        pass
+
+    def materials(self, ctx: StepContext) -> List[dict]:
+        """Withdrawals of the step (stock_deduction.withdrawal)"""
+        return []
+
+    def on_locked(self, ctx: StepContext):
+        """Called with ctx.locked and ctx.withdrawals filled, before the withdrawals are checked"""
+        pass
+
+    def write(self, ctx: StepContext):
+        """Step specific writes after the withdrawals"""
+        pass
+
+    def operation_key(self, ctx: StepContext) -> str:
+        return ctx.data.idempotency_key
+
+    def parameters(self, ctx: StepContext) -> dict:
+        return {}
+
+    def notes(self, ctx: StepContext) -> Optional[str]:
+        return getattr(ctx.data, 'notes', None)
+
+    def result(self, ctx: StepContext) -> dict:
+        return {}
+
+def prefetch(cursor, spec: ProductionStep, batch_id: int, idempotency_key: str):
+    """Batch row with the idempotency flag and the step checks in one query"""
+    check_columns = "".join(f",\n               ({sql}) AS {name}" for name, sql in spec.checks.items())
+    cursor.execute(f"""
+        SELECT b.id, b.batch_number, b.recipe_id, b.status, b.current_step, b.initial_weight,
+               ({spec.idempotency_sql}) AS processed{check_columns}
+        FROM batches b
+        WHERE b.id = ?
+    """, idempotency_key, *([batch_id] * len(spec.checks)), batch_id)
+    return cursor.fetchone()
+
+def run_step(spec: ProductionStep, batch_id: int, data) -> dict:
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        batch = prefetch(cursor, spec, batch_id, data.idempotency_key)
+        if not batch:
+            raise HTTPException(status_code=404, detail="Batch not found")
+
+        if batch.status == 'completed':
+            raise HTTPException(status_code=400, detail="Batch already completed")
+
+        if batch.processed:
+            return {"message": spec.processed_message, "batch_id": batch_id}
+
+        ctx = StepContext(cursor, batch_id, data, batch, {name: getattr(batch, name) for name in spec.checks})
+        ctx.catalog = recipe_catalog(cursor)
+        ctx.recipe = ctx.catalog.get(batch.recipe_id)
+        ctx.step = ctx.recipe.step(spec.step_type)
+        spec.validate(ctx)
+
+        # Materials: one lock for all balances, one bulk write
+        ctx.withdrawals = spec.materials(ctx)
+        if ctx.withdrawals:
+            ctx.locked = lock_balances(cursor, [item['nomenclature_id'] for item in ctx.withdrawals])
+            spec.on_locked(ctx)
+            ctx.withdrawals = post_withdrawals(
+                cursor, ctx.withdrawals, ctx.locked, batch.batch_number, spec.shortage_message, batch_id
+            )
+            ctx.balance_changes.extend(withdrawal_changes(ctx.withdrawals))
+
+        spec.write(ctx)
+
+        # Operation record and current_step in one round trip
+        if ctx.step:
+            cursor.execute("""
+                INSERT INTO batch_operations (
+                    batch_id, step_id, operation_type, status,
+                    weight_before, weight_after, parameters, notes, idempotency_key
+                )
+                VALUES (?, ?, ?, 'completed', NULL, NULL, ?, ?, ?);
+
+                UPDATE batches
+                SET current_step = ?,
+                    status = 'in_progress',
+                    updated_at = GETUTCDATE()
+                WHERE id = ?;
+            """, batch_id, ctx.step['id'], spec.operation_type,
+                json.dumps(spec.parameters(ctx)), spec.notes(ctx), spec.operation_key(ctx),
+                ctx.step['step_order'], batch_id)
+
+        conn.commit()
+        publish_balances(ctx.balance_changes)
+        if ctx.step:
+            publish_batch_state(batch_id, 'in_progress', batch_number=batch.batch_number,
+                                current_step=ctx.step['step_order'])
+
+        return {"message": spec.success_message, "batch_id": batch_id, **spec.result(ctx)}
+
+class MixStep(ProductionStep):
+    """Mix (Chaman/Marinade): all recipe spices for the batch weight, warehouse mix, leftover back to stock"""
+    step_type = 'mix'
+    operation_type = 'mix'
+    shortage_message = "Недостатньо спецій або міксу на складі"
+    processed_message = "Mix already produced"
+    success_message = "Mix produced successfully"
+    idempotency_sql = "SELECT COUNT(*) FROM batch_mix_production WHERE idempotency_key = ?"
+    checks = {'mix_produced': "SELECT COUNT(*) FROM batch_mix_production WHERE batch_id = ?"}
+
+    def validate(self, ctx):
+        # Mix is produced once per batch
+        if ctx.checks['mix_produced']:
+            raise HTTPException(
+                status_code=400,
+                detail="Суміш для цієї партії вже виготовлена. Повторне виготовлення заборонене."
+            )
+
+    def materials(self, ctx):
+        data = ctx.data
+        initial_weight = float(ctx.batch.initial_weight)
+        spice_names = {spice['nomenclature_id']: spice['name'] for spice in ctx.recipe.spices}
+        required = compute_requirements(
+            {ctx.recipe.id: ctx.recipe.norms}, [(ctx.recipe.id, initial_weight)], kinds=('spice',)
+        )
+        withdrawals = [
+            withdrawal(
+                spice_id, line['required'], 'production_spice_use',
+                f"mix-spice-{ctx.batch_id}-{spice_id}-{data.idempotency_key}",
+                ctx.metadata(spice_name=spice_names.get(spice_id), recipe_id=ctx.recipe.id,
+                             initial_weight=initial_weight)
+            )
+            for spice_id, line in required.items()
+        ]
+        if data.warehouse_mix_used > 0:
+            withdrawals.append(withdrawal(
+                data.mix_nomenclature_id, data.warehouse_mix_used, 'production_use',
+                f"mix-warehouse-{ctx.batch_id}-{data.idempotency_key}",
+                ctx.metadata(mix_type='warehouse_use')
+            ))
+        return withdrawals
+
+    def write(self, ctx):
+        data = ctx.data
+        cursor = ctx.cursor
+        cursor.execute("""
+            INSERT INTO batch_mix_production (
+                batch_id, mix_nomenclature_id, produced_quantity, used_quantity,
+                leftover_quantity, warehouse_mix_used, idempotency_key
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, ctx.batch_id, data.mix_nomenclature_id, data.produced_quantity,
+            data.used_quantity, data.leftover_quantity,
+            data.warehouse_mix_used, data.idempotency_key)
+
+        # Leftover goes back to stock
+        if data.leftover_quantity > 0:
+            cursor.execute("""
+                INSERT INTO stock_movements (
+                    nomenclature_id, operation_type, quantity, balance_after,
+                    source_operation_type, source_operation_id,
+                    idempotency_key, operation_date, metadata
+                )
+                SELECT
+                    ?, 'receipt', ?,
+                    COALESCE((SELECT quantity FROM stock_balances WHERE nomenclature_id = ?), 0) + ?,
+                    'production_leftover', ?,
+                    ?, GETUTCDATE(), ?
+            """, data.mix_nomenclature_id, data.leftover_quantity,
+                data.mix_nomenclature_id, data.leftover_quantity,
+                ctx.batch.batch_number, f"mix-leftover-{ctx.batch_id}-{data.idempotency_key}",
+                json.dumps(ctx.metadata(mix_type='leftover')))
+            post_balances(cursor, [(data.mix_nomenclature_id, data.leftover_quantity, None)])
+            ctx.balance_changes.append((data.mix_nomenclature_id, None, data.leftover_quantity))
+            
+            # Leftover returns its value to the batch
+            unit_cost = unit_costs(cursor, [data.mix_nomenclature_id])[data.mix_nomenclature_id]
+            add_batch_costs(cursor, ctx.batch_id, [(data.mix_nomenclature_id, -data.leftover_quantity, unit_cost)])
+
+    def operation_key(self, ctx):
+        return f"mix-operation-{ctx.batch_id}-{ctx.data.idempotency_key}"
+
+    def parameters(self, ctx):
+        return self.result(ctx)
+
+    def notes(self, ctx):
+        return f"Мікс виготовлено: {ctx.data.produced_quantity} кг"
+
+    def result(self, ctx):
+        return {
+            'produced_quantity': ctx.data.produced_quantity,
+            'used_quantity': ctx.data.used_quantity,
+            'leftover_quantity': ctx.data.leftover_quantity,
+            'warehouse_mix_used': ctx.data.warehouse_mix_used
+        }
+
+class SaltingStep(ProductionStep):
+    """Salting: salt and water"""
+    step_type = 'salt'
+    operation_type = 'salting'
+    source_operation_type = 'production_salting'
+    shortage_message = "Недостатньо солі або води на складі"
+    processed_message = "Salting already processed"
+    success_message = "Salting processed successfully"
+
+    def materials(self, ctx):
+        key = ctx.data.idempotency_key
+        metadata = ctx.metadata(step_type='salting')
+        return [
+            withdrawal(SALT_ID, ctx.data.salt_quantity, self.source_operation_type,
+                       f"salting-salt-{ctx.batch_id}-{key}", metadata),
+            withdrawal(WATER_ID, ctx.data.water_quantity, self.source_operation_type,
+                       f"salting-water-{ctx.batch_id}-{key}", metadata)
+        ]
+
+    def parameters(self, ctx):
+        return self.result(ctx)
+
+    def notes(self, ctx):
+        return ctx.data.notes or (
+            f"Засолка виконана: сіль {ctx.data.salt_quantity} кг, вода {ctx.data.water_quantity} л"
+        )
+
+    def result(self, ctx):
+        return {'salt_quantity': ctx.data.salt_quantity, 'water_quantity': ctx.data.water_quantity}
+
+class SugarStep(ProductionStep):
+    """Sugar massage (horse basturma), rounded to 0.1 kg"""
+    step_type = 'sugar'
+    operation_type = 'sugar'
+    source_operation_type = 'production_sugar'
+    shortage_message = "Недостатньо цукру на складі"
+    processed_message = "Sugar massage already processed"
+    success_message = "Sugar massage processed successfully"
+
+    def quantity(self, ctx) -> float:
+        return round(ctx.data.sugar_quantity, 1)
+
+    def validate(self, ctx):
+        if ctx.catalog.sugar_id is None:
+            raise HTTPException(status_code=404, detail="Nomenclature 'Цукор' not found")
+
+    def materials(self, ctx):
+        return [withdrawal(
+            ctx.catalog.sugar_id, self.quantity(ctx), self.source_operation_type,
+            f"sugar-{ctx.batch_id}-{ctx.data.idempotency_key}", ctx.metadata(step_type='sugar')
+        )]
+
+    def parameters(self, ctx):
+        return self.result(ctx)
+
+    def notes(self, ctx):
+        return ctx.data.notes or f"Масажер з цукром: {self.quantity(ctx)} кг"
+
+    def result(self, ctx):
+        return {'sugar_quantity': self.quantity(ctx)}
+
+class WaterMassageStep(ProductionStep):
+    """Water massage (Sudjuk), rounded to 0.1 l"""
+    step_type = 'massage'
+    operation_type = 'massage'
+    source_operation_type = 'production_massage'
+    shortage_message = "Недостатньо води на складі"
+    processed_message = "Water massage already processed"
+    success_message = "Water massage processed successfully"
+
+    def quantity(self, ctx) -> float:
+        return round(ctx.data.water_quantity, 1)
+
+    def materials(self, ctx):
+        return [withdrawal(
+            WATER_ID, self.quantity(ctx), self.source_operation_type,
+            f"massage-{ctx.batch_id}-{ctx.data.idempotency_key}", ctx.metadata(step_type='massage')
+        )]
+
+    def parameters(self, ctx):
+        return self.result(ctx)
+
+    def notes(self, ctx):
+        return ctx.data.notes or f"Масажер з водою: {self.quantity(ctx)} л"
+
+    def result(self, ctx):
+        return {'water_quantity': self.quantity(ctx)}
+
+def round_material_quantity(quantity: float, unit: str):
+    """Pieces to whole numbers; meters and everything else to 0.1, the precision operators enter sugar and water in"""
+    if unit == 'шт':
+        return int(round(quantity))
+    return round(quantity, 1)
+
+class StuffStep(ProductionStep):
+    """Stuffing (Sudjuk, Mahan): casing and threads entered by the operator"""
+    step_type = 'stuff'
+    operation_type = 'stuff'
+    source_operation_type = 'production_stuff'
+    processed_message = "Stuffing already processed"
+    success_message = "Stuffing processed successfully"
+
+    def materials(self, ctx):
+        return [
+            withdrawal(
+                material.material_id, round_material_quantity(material.quantity, material.unit),
+                self.source_operation_type,
+                f"stuff-{ctx.batch_id}-{material.material_id}-{ctx.data.idempotency_key}",
+                ctx.metadata(material_name=None, unit=material.unit)
+            )
+            for material in ctx.data.materials
+        ]
+
+    def on_locked(self, ctx):
+        # Material names come with the locked balances
+        for item in ctx.withdrawals:
+            item['metadata']['material_name'] = ctx.locked.get(item['nomenclature_id'], {}).get('name')
+
+    def summary(self, ctx) -> List[dict]:
+        return [
+            {
+                'material_name': ctx.locked.get(material.material_id, {}).get('name'),
+                'quantity': round_material_quantity(material.quantity, material.unit),
+                'unit': material.unit
+            }
+            for material in ctx.data.materials
+        ]
+
+    def parameters(self, ctx):
+        return {'materials': self.summary(ctx)}
+
+    def notes(self, ctx):
+        return ctx.data.notes or "Заправка в кишку виконана"
+
+    def result(self, ctx):
+        return {'materials': self.summary(ctx)}
+
+MIX = MixStep()
+SALTING = SaltingStep()
+SUGAR = SugarStep()
+WATER_MASSAGE = WaterMassageStep()
+STUFF = StuffStep()
@@ -0,0 +1,240 @@
+"""
+Compiled recipe cache
+All recipes with parsed steps, spices, ingredients, per-100 kg norms and
+batch number product code are loaded in one pass (one query per table)
+and kept in memory while the RECIPES and NOMENCLATURE versions (versioning)
+stay the same; checking them needs no query.
+"""
+import json
+import threading
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException
+
+from database import get_db_connection
+from versioning import NOMENCLATURE, RECIPES, etag_for
+
+FENUGREEK_ID = 19  # Пажитник in nomenclature
+WATER_ID = 136     # Вода in nomenclature
+SALT_ID = 28       # Сіль in nomenclature
+SUGAR_NAME = 'Цукор'
+
+# recipe_steps.parameters norm -> (kind, nomenclature id; None means sugar, looked up by name)
+STEP_NORMS = {
+    'salt_per_100kg': ('salt', SALT_ID),
+    'water_per_100kg': ('water', WATER_ID),
+    'sugar_per_100kg': ('sugar', None),
+}
+
+# Product name to code mapping for batch numbers
+PRODUCT_CODE_MAP = {
+    'Бастурма класична': 'BAST',
+    'Бастурма з конини': 'HORSE',
+    'Бастурма конина': 'HORSE',
+    'Суджук': 'SUDJ',
+    'Курка': 'CHIK',
+    'Куряче': 'CHIK',
+    'Махан': 'MAHAN',
+    'Індичка': 'TURK',
+    'Свинина': 'PORK',
+    'Пластина': 'PLAST',
+}
+DEFAULT_PRODUCT_CODE = 'BATCH'
+
+_catalog = {"version": None, "value": None}
+_lock = threading.Lock()
+
+def parse_parameters(value: Optional[str]) -> Optional[dict]:
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
+
+def product_code_for(recipe_name: str, product_name: Optional[str]) -> str:
+    """Recipe name is matched first, then product name"""
+    for key, code in PRODUCT_CODE_MAP.items():
+        if key in recipe_name or key in (product_name or ''):
+            return code
+    return DEFAULT_PRODUCT_CODE
+
+class CompiledRecipe:
+    def __init__(self, row):
+        self.id = row.id
+        self.name = row.name
+        self.target_product_id = row.target_product_id
+        self.target_product_name = row.product_name
+        self.expected_yield_min = float(row.expected_yield_min)
+        self.expected_yield_max = float(row.expected_yield_max)
+        self.description = row.description
+        self.product_code = product_code_for(row.name, row.product_name)
+        self.steps: List[dict] = []
+        self.spices: List[dict] = []
+        self.ingredients: List[dict] = []
+        self.norms: List[dict] = []
+        self.steps_by_type: Dict[str, dict] = {}
+        self.steps_by_id: Dict[int, dict] = {}
+
+    def step(self, step_type: str) -> Optional[dict]:
+        """First step of the type (lowest step_order)"""
+        return self.steps_by_type.get(step_type)
+
+    def compile(self, sugar_id: Optional[int]):
+        """Lookups and norms once steps, spices and ingredients are loaded"""
+        for step in self.steps:
+            self.steps_by_type.setdefault(step['step_type'], step)
+            self.steps_by_id[step['id']] = step
+
+        # Ingredients first, largest norm first (the main raw material)
+        for ingredient in sorted(self.ingredients, key=lambda item: -item['quantity_per_100kg']):
+            if not ingredient['is_optional']:
+                self.norms.append({
+                    'nomenclature_id': ingredient['nomenclature_id'],
+                    'kind': 'ingredient',
+                    'per_100kg': ingredient['quantity_per_100kg']
+                })
+        for spice in self.spices:
+            self.norms.append({
+                'nomenclature_id': spice['nomenclature_id'],
+                'kind': 'spice',
+                'per_100kg': spice['quantity_per_100kg']
+            })
+        for step in self.steps:
+            parameters = step['parameters'] if isinstance(step['parameters'], dict) else {}
+            for name, (kind, nomenclature_id) in STEP_NORMS.items():
+                if nomenclature_id is None:
+                    nomenclature_id = sugar_id
+                if parameters.get(name) and nomenclature_id is not None:
+                    self.norms.append({
+                        'nomenclature_id': nomenclature_id,
+                        'kind': kind,
+                        'per_100kg': float(parameters[name])
+                    })
+
+            # Casing options name the casing only when a nomenclature is assigned to them
+            if step['step_type'] == 'stuff':
+                for option in parameters.get('casing_options') or []:
+                    if option.get('nomenclature_id') and option.get('capacity'):
+                        self.norms.append({
+                            'nomenclature_id': option['nomenclature_id'],
+                            'kind': 'casing',
+                            'capacity_kg': float(option['capacity'])
+                        })
+                        break
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "target_product_id": self.target_product_id,
+            "target_product_name": self.target_product_name,
+            "expected_yield_min": self.expected_yield_min,
+            "expected_yield_max": self.expected_yield_max,
+            "description": self.description
+        }
+
+    def as_dict(self) -> dict:
+        return {
+            **self.summary(),
+            "steps": self.steps,
+            "spices": self.spices,
+            "ingredients": self.ingredients
+        }
+
+class RecipeCatalog:
+    def __init__(self, recipes: Dict[int, CompiledRecipe], sugar_id: Optional[int]):
+        self.recipes = recipes
+        self.sugar_id = sugar_id
+
+    def get(self, recipe_id: int) -> CompiledRecipe:
+        recipe = self.recipes.get(recipe_id)
+        if recipe is None:
+            raise HTTPException(status_code=404, detail="Recipe not found")
+        return recipe
+
+def load_catalog(cursor) -> RecipeCatalog:
+    cursor.execute("SELECT id FROM nomenclature WHERE name = ?", SUGAR_NAME)
+    row = cursor.fetchone()
+    sugar_id = row[0] if row else None
+
+    cursor.execute("""
+        SELECT r.id, r.name, r.target_product_id, n.name as product_name,
+               r.expected_yield_min, r.expected_yield_max, r.description
+        FROM recipes r
+        LEFT JOIN nomenclature n ON r.target_product_id = n.id
+        ORDER BY r.name
+    """)
+    recipes = {row.id: CompiledRecipe(row) for row in cursor.fetchall()}
+
+    cursor.execute("""
+        SELECT recipe_id, id, step_order, step_type, step_name, duration_days, parameters, description
+        FROM recipe_steps
+        ORDER BY recipe_id, step_order
+    """)
+    for row in cursor.fetchall():
+        if row.recipe_id in recipes:
+            recipes[row.recipe_id].steps.append({
+                "id": row.id,
+                "step_order": row.step_order,
+                "step_type": row.step_type,
+                "step_name": row.step_name,
+                "duration_days": float(row.duration_days),
+                "parameters": parse_parameters(row.parameters),
+                "description": row.description
+            })
+
+    cursor.execute("""
+        SELECT rs.recipe_id, rs.id, rs.nomenclature_id, n.name, rs.quantity_per_100kg, rs.is_fenugreek
+        FROM recipe_spices rs
+        JOIN nomenclature n ON rs.nomenclature_id = n.id
+        ORDER BY rs.recipe_id, n.name
+    """)
+    for row in cursor.fetchall():
+        if row.recipe_id in recipes:
+            recipes[row.recipe_id].spices.append({
+                "id": row.id,
+                "nomenclature_id": row.nomenclature_id,
+                "name": row.name,
+                "quantity_per_100kg": float(row.quantity_per_100kg) if row.quantity_per_100kg else 0,
+                "is_fenugreek": bool(row.is_fenugreek)
+            })
+
+    cursor.execute("""
+        SELECT ri.recipe_id, ri.id, ri.nomenclature_id, n.name, ri.quantity_per_100kg, ri.is_optional
+        FROM recipe_ingredients ri
+        JOIN nomenclature n ON ri.nomenclature_id = n.id
+        ORDER BY ri.recipe_id, n.name
+    """)
+    for row in cursor.fetchall():
+        if row.recipe_id in recipes:
+            recipes[row.recipe_id].ingredients.append({
+                "id": row.id,
+                "nomenclature_id": row.nomenclature_id,
+                "name": row.name,
+                "quantity_per_100kg": float(row.quantity_per_100kg) if row.quantity_per_100kg else 0,
+                "is_optional": bool(row.is_optional)
+            })
+
+    for recipe in recipes.values():
+        recipe.compile(sugar_id)
+    return RecipeCatalog(recipes, sugar_id)
+
+def recipe_catalog(cursor=None) -> RecipeCatalog:
+    """
+    Compiled recipes for the current data version
+    Loaded over the given cursor (or a new connection) only after a version change
+    """
+    version = etag_for(RECIPES, NOMENCLATURE)
+    with _lock:
+        if _catalog["version"] != version:
+            if cursor is not None:
+                _catalog["value"] = load_catalog(cursor)
+            else:
+                with get_db_connection() as conn:
+                    _catalog["value"] = load_catalog(conn.cursor())
+            _catalog["version"] = version
+        return _catalog["value"]
+
+def get_compiled_recipe(recipe_id: int, cursor=None) -> CompiledRecipe:
+    return recipe_catalog(cursor).get(recipe_id)
@@ -1,24 +1,66 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.concurrency import run_in_threadpool
-from typing import List, Optional
+from fastapi.responses import StreamingResponse
+from typing import Iterator, List, Optional, Tuple
 from datetime import datetime
 import json
 import os
+import pyodbc
 from dotenv import load_dotenv
 
-from database import get_db_connection, init_database
+from database import get_db_connection, init_database, chunked, placeholders
+from valuation import post_balances, stock_valuation
 from models import (
     NomenclatureCreate, Nomenclature, StockOperation,
-    StockMovement, StockBalance, InventorySessionCreate,
-    InventorySession, InventoryComplete, SyncBatch,
-    BatchStockOperation, BatchResponse, BatchOperationResult
+    StockMovement, StockBalance, StockBalanceChanges, InventorySessionCreate,
+    InventorySession, InventoryComplete, InventoryItemCreate,
+    InventoryCountLines, SyncBatch,
+    BatchStockOperation, BatchResponse, BatchOperationResult,
+    BatchCreate, BatchOperationCreate, BatchMixProduction, BatchSalting,
+    BatchSugar, BatchMassage, BatchStuff, BatchComplete,
+    PackagingBatchCreate, PackagingOperationCreate, PackagingBatchComplete
+)
+from batch_operations import iter_batch, process_batch
+from sync_engine import iter_sync_replay, iter_sync_operations
+from versioning import NOMENCLATURE, bump_version, check_not_modified, load_versions
+from events import TOPICS, subscribe, event_stream, publish_balances
+from payload_codecs import PayloadCodecMiddleware
+from compression import MIN_BYTES as COMPRESSION_MIN_BYTES, CompressionMiddleware, compression_stats
+from bootstrap import build_bootstrap
+from singleflight import SingleFlight, flight_key, singleflight_stats
+from fast_json import RowEncoder, dumps, json_response
+from idempotency_store import request_fingerprint, lookup_response, store_response, remember_response
+from streaming import (
+    NDJSON_MEDIA_TYPE, wants_ndjson, ndjson_line, line_record,
+    batch_summary, summary_record, iterate_in_thread
+)
+from production_api import (
+    router as production_router,
+    create_batch, add_batch_operation, produce_mix, process_salting,
+    process_sugar_massage, process_water_massage, process_stuffing, complete_batch
+)
+from packaging_api import (
+    router as packaging_router,
+    create_packaging_batch, record_packaging_operation, complete_packaging_batch
 )
-from production_api import router as production_router
-from packaging_api import router as packaging_router
 
 load_dotenv()
 
+balances_flight = SingleFlight("stock_balances")
+
+NOMENCLATURE_ENCODER = RowEncoder(
+    Nomenclature, ("id", "name", "category", "unit", "precision_digits", "created_at", "updated_at")
+)
+BALANCE_ENCODER = RowEncoder(
+    StockBalance, ("nomenclature_id", "nomenclature_name", "category", "unit", "quantity", "last_updated")
+)
+MOVEMENT_ENCODER = RowEncoder(
+    StockMovement,
+    ("id", "nomenclature_id", "operation_type", "quantity", "balance_after",
+     "idempotency_key", "metadata", "operation_date", "created_at")
+)
+
 app = FastAPI(title="Склад API")
 
 # Include production router
@@ -34,11 +76,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# msgpack / gzip / zstd payloads for sync, bulk and delta-sync endpoints
+app.add_middleware(PayloadCodecMiddleware, min_bytes=COMPRESSION_MIN_BYTES)
+
+# br / gzip for the remaining responses above the size threshold
+app.add_middleware(CompressionMiddleware)
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize database on startup"""
     try:
         await run_in_threadpool(init_database)
+        await run_in_threadpool(load_versions)
     except Exception as e:
         print(f"Error initializing database: {e}")
 
@@ -82,23 +131,207 @@ def get_current_balance_locked(conn, nomenclature_id: int) -> float:
     row = cursor.fetchone()
     return float(row[0]) if row else 0.0
 
-def update_balance(conn, nomenclature_id: int, new_balance: float):
-    """Update or insert balance"""
+def update_balance(conn, nomenclature_id: int, new_balance: float,
+                   received_quantity: float = 0, price_per_unit: Optional[float] = None):
+    """Update or insert balance; a priced receipt moves the average cost (valuation)"""
+    post_balances(conn.cursor(), [(nomenclature_id, new_balance, price_per_unit, received_quantity)], absolute=True)
+
+# Ledger sign of each stock_movements.operation_type; batch_* rows are zero-quantity batch headers
+MOVEMENT_SIGNS = {
+    'receipt': 1,
+    'inventory_adjustment_receipt': 1,
+    'withdrawal': -1,
+    'inventory_adjustment_withdrawal': -1,
+    'batch_receipt': 0,
+    'batch_withdrawal': 0,
+}
+
+def take_inventory_snapshot(conn, session_id: int, session: InventorySessionCreate):
+    """
+    Capture system quantities for the inventory scope and the ledger watermark
+    Runs in a SNAPSHOT isolation transaction: balances and the watermark are
+    read from one consistent version without locking out postings.
+    """
+    cursor = conn.cursor()
+    query = """
+        INSERT INTO inventory_snapshot_items (session_id, nomenclature_id, system_quantity)
+        SELECT ?, n.id, COALESCE(sb.quantity, 0)
+        FROM nomenclature n
+        LEFT JOIN stock_balances sb ON n.id = sb.nomenclature_id
+        WHERE 1=1
+    """
+    params = [session_id]
+    if session.session_type == 'partial':
+        if session.nomenclature_ids:
+            query += f" AND n.id IN ({placeholders(len(session.nomenclature_ids))})"
+            params.extend(session.nomenclature_ids)
+        if session.category:
+            query += " AND n.category = ?"
+            params.append(session.category)
+    
+    cursor.execute(query, params)
+    
+    cursor.execute(
+        """UPDATE inventory_sessions
+           SET snapshot_movement_id = (SELECT COALESCE(MAX(id), 0) FROM stock_movements)
+           WHERE id = ?""",
+        (session_id,)
+    )
+
+def get_movement_deltas_since(conn, movement_id: int) -> dict:
+    """Net stock change per nomenclature for movements posted after movement_id"""
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT nomenclature_id FROM stock_balances WHERE nomenclature_id = ?",
-        (nomenclature_id,)
+        """SELECT nomenclature_id, operation_type, SUM(quantity)
+           FROM stock_movements
+           WHERE id > ?
+           GROUP BY nomenclature_id, operation_type""",
+        (movement_id,)
+    )
+    deltas = {}
+    for nomenclature_id, operation_type, quantity in cursor.fetchall():
+        if operation_type not in MOVEMENT_SIGNS:
+            raise HTTPException(status_code=500, detail=f"Невідомий тип операції в журналі руху: {operation_type}")
+        deltas[nomenclature_id] = deltas.get(nomenclature_id, 0.0) + MOVEMENT_SIGNS[operation_type] * float(quantity)
+    return deltas
+
+def apply_balance_delta(conn, nomenclature_id: int, delta: float):
+    """Add delta to balance (inserts the balance row if missing), valued at the average cost"""
+    post_balances(conn.cursor(), [(nomenclature_id, delta, None)])
+
+def collect_counted_items(conn, session_id: int, submitted_items) -> List[InventoryItemCreate]:
+    """
+    Counted quantities for a session: scanner lines accumulated per item,
+    explicitly submitted items override them
+    HOLDLOCK keeps new lines out of the session until the completion commits.
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT nomenclature_id, SUM(quantity)
+           FROM inventory_count_lines WITH (HOLDLOCK)
+           WHERE session_id = ?
+           GROUP BY nomenclature_id""",
+        (session_id,)
     )
-    if cursor.fetchone():
+    counted = {row[0]: float(row[1]) for row in cursor.fetchall()}
+    for item in submitted_items:
+        counted[item.nomenclature_id] = item.actual_quantity
+    
+    return [
+        InventoryItemCreate(nomenclature_id=nomenclature_id, actual_quantity=quantity)
+        for nomenclature_id, quantity in counted.items()
+    ]
+
+def reconcile_inventory_snapshot(conn, session_id: int, snapshot_movement_id: int, items, idempotency_key: str) -> List[dict]:
+    """
+    Reconcile counts against the session snapshot.
+    Difference = counted - snapshot; movements posted during the count are
+    taken from one ledger range query and carried over into the new balance.
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT s.nomenclature_id, s.system_quantity, n.precision_digits
+           FROM inventory_snapshot_items s
+           JOIN nomenclature n ON s.nomenclature_id = n.id
+           WHERE s.session_id = ?""",
+        (session_id,)
+    )
+    snapshot = {row[0]: (float(row[1]), row[2]) for row in cursor.fetchall()}
+    
+    out_of_scope = [item.nomenclature_id for item in items if item.nomenclature_id not in snapshot]
+    if out_of_scope:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Позиції поза межами інвентаризації: {', '.join(str(i) for i in out_of_scope)}"
+        )
+    
+    deltas = get_movement_deltas_since(conn, snapshot_movement_id)
+    adjustments = []
+    
+    for item in items:
+        system_quantity, precision = snapshot[item.nomenclature_id]
+        in_session_delta = round_quantity(deltas.get(item.nomenclature_id, 0.0), precision)
+        actual_quantity = round_quantity(item.actual_quantity, precision)
+        difference = round_quantity(actual_quantity - system_quantity, precision)
+        
         cursor.execute(
-            "UPDATE stock_balances SET quantity = ?, last_updated = GETUTCDATE() WHERE nomenclature_id = ?",
-            (new_balance, nomenclature_id)
+            """INSERT INTO inventory_items 
+               (session_id, nomenclature_id, system_quantity, actual_quantity, difference)
+               VALUES (?, ?, ?, ?, ?)""",
+            (session_id, item.nomenclature_id, system_quantity, actual_quantity, difference)
         )
-    else:
+        
+        if difference != 0:
+            operation_type = 'inventory_adjustment_receipt' if difference > 0 else 'inventory_adjustment_withdrawal'
+            movement_key = f"{idempotency_key}_adj_{item.nomenclature_id}"
+            balance_after = round_quantity(actual_quantity + in_session_delta, precision)
+            
+            cursor.execute(
+                """INSERT INTO stock_movements 
+                   (nomenclature_id, operation_type, quantity, balance_after, idempotency_key, metadata)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (item.nomenclature_id, operation_type, abs(difference), balance_after, movement_key,
+                 json.dumps({"inventory_session_id": session_id, "in_session_delta": in_session_delta}))
+            )
+            
+            # Relative update keeps movements posted during the count intact
+            apply_balance_delta(conn, item.nomenclature_id, difference)
+            
+            adjustments.append({
+                "nomenclature_id": item.nomenclature_id,
+                "difference": difference,
+                "system_quantity": system_quantity,
+                "actual_quantity": actual_quantity,
+                "in_session_delta": in_session_delta,
+                "balance_after": balance_after
+            })
+    
+    return adjustments
+
+def reconcile_inventory_current(conn, session_id: int, items, idempotency_key: str) -> List[dict]:
+    """Reconcile counts against balances at completion time"""
+    cursor = conn.cursor()
+    adjustments = []
+    
+    for item in items:
+        precision = get_nomenclature_precision(conn, item.nomenclature_id)
+        system_quantity = get_current_balance(conn, item.nomenclature_id)
+        actual_quantity = round_quantity(item.actual_quantity, precision)
+        difference = round_quantity(actual_quantity - system_quantity, precision)
+        
+        # Save inventory item
         cursor.execute(
-            "INSERT INTO stock_balances (nomenclature_id, quantity) VALUES (?, ?)",
-            (nomenclature_id, new_balance)
+            """INSERT INTO inventory_items 
+               (session_id, nomenclature_id, system_quantity, actual_quantity, difference)
+               VALUES (?, ?, ?, ?, ?)""",
+            (session_id, item.nomenclature_id, system_quantity, actual_quantity, difference)
         )
+        
+        # If there's a difference, create adjustment movement
+        if difference != 0:
+            operation_type = 'inventory_adjustment_receipt' if difference > 0 else 'inventory_adjustment_withdrawal'
+            movement_key = f"{idempotency_key}_adj_{item.nomenclature_id}"
+            
+            cursor.execute(
+                """INSERT INTO stock_movements 
+                   (nomenclature_id, operation_type, quantity, balance_after, idempotency_key, metadata)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (item.nomenclature_id, operation_type, abs(difference), actual_quantity, movement_key,
+                 json.dumps({"inventory_session_id": session_id}))
+            )
+            
+            # Update balance
+            update_balance(conn, item.nomenclature_id, actual_quantity)
+            
+            adjustments.append({
+                "nomenclature_id": item.nomenclature_id,
+                "difference": difference,
+                "system_quantity": system_quantity,
+                "actual_quantity": actual_quantity,
+                "balance_after": actual_quantity
+            })
+    
+    return adjustments
 
 # API Endpoints
 
@@ -106,29 +339,37 @@ def update_balance(conn, nomenclature_id: int, new_balance: float):
 async def health_check():
     return {"status": "ok", "service": "warehouse-api"}
 
+@app.get("/api/metrics/singleflight")
+async def get_singleflight_metrics():
+    """Статистика об'єднання однакових запитів читання"""
+    return {"flights": singleflight_stats()}
+
+@app.get("/api/metrics/compression")
+async def get_compression_metrics():
+    """Стиснення відповідей по маршрутах (байти до/після)"""
+    return {"min_bytes": COMPRESSION_MIN_BYTES, "routes": compression_stats()}
+
+@app.get("/api/bootstrap")
+async def bootstrap(reference_version: Optional[str] = None):
+    """Довідники та поточні залишки одним запитом (холодний старт клієнта)"""
+    body = await run_in_threadpool(build_bootstrap, reference_version)
+    return Response(content=body, media_type="application/json", headers={"Cache-Control": "no-store"})
+
 @app.get("/api/nomenclature", response_model=List[Nomenclature])
-async def get_nomenclature():
+async def get_nomenclature(request: Request, response: Response):
     """Отримати всю номенклатуру"""
+    not_modified = check_not_modified(request, response, NOMENCLATURE)
+    if not_modified:
+        return not_modified
+    
     def _get():
         with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT id, name, category, unit, precision_digits, created_at, updated_at FROM nomenclature ORDER BY category, name"
             )
-            rows = cursor.fetchall()
-            return [
-                Nomenclature(
-                    id=row[0],
-                    name=row[1],
-                    category=row[2],
-                    unit=row[3],
-                    precision_digits=row[4],
-                    created_at=row[5],
-                    updated_at=row[6]
-                )
-                for row in rows
-            ]
-    return await run_in_threadpool(_get)
+            return NOMENCLATURE_ENCODER.dumps(cursor.fetchall())
+    return json_response(await run_in_threadpool(_get), response)
 
 @app.post("/api/nomenclature", response_model=Nomenclature)
 async def create_nomenclature(item: NomenclatureCreate):
@@ -143,6 +384,7 @@ async def create_nomenclature(item: NomenclatureCreate):
                 )
                 new_id = cursor.fetchone()[0]
                 conn.commit()
+                bump_version(NOMENCLATURE)
                 
                 # Fetch created item
                 cursor.execute(
@@ -185,28 +427,80 @@ async def get_balances(category: Optional[str] = None):
             else:
                 cursor.execute(query + " ORDER BY n.category, n.name")
             
-            rows = cursor.fetchall()
-            return [
-                StockBalance(
-                    nomenclature_id=row[0],
-                    nomenclature_name=row[1],
-                    category=row[2],
-                    unit=row[3],
-                    quantity=float(row[4]),
-                    last_updated=row[5]
+            return BALANCE_ENCODER.dumps(cursor.fetchall())
+    return json_response(await balances_flight.run(flight_key("/api/stock/balances", category=category), _get))
+
+@app.get("/api/stock/balances/changes", response_model=StockBalanceChanges)
+async def get_balance_changes(since: Optional[str] = None, category: Optional[str] = None):
+    """Отримати залишки, змінені після токена (дельта-синхронізація)"""
+    if since is not None and not since.isdigit():
+        raise HTTPException(status_code=400, detail="Невірний токен синхронізації")
+    
+    def _get():
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Rows below the lowest active rowversion are all committed,
+            # so nothing in flight can be skipped by the next poll
+            cursor.execute("SELECT CAST(MIN_ACTIVE_ROWVERSION() AS BIGINT)")
+            token = cursor.fetchone()[0]
+            
+            query = """
+            SELECT 
+                n.id, n.name, n.category, n.unit,
+                COALESCE(sb.quantity, 0) as quantity,
+                COALESCE(sb.last_updated, n.created_at) as last_updated
+            FROM nomenclature n
+            LEFT JOIN stock_balances sb ON n.id = sb.nomenclature_id
+            WHERE 1=1
+            """
+            params = []
+            if since is not None:
+                query += """
+                AND (
+                    (n.row_version >= CAST(CAST(? AS BIGINT) AS BINARY(8))
+                     AND n.row_version < CAST(CAST(? AS BIGINT) AS BINARY(8)))
+                    OR (sb.row_version >= CAST(CAST(? AS BIGINT) AS BINARY(8))
+                        AND sb.row_version < CAST(CAST(? AS BIGINT) AS BINARY(8)))
                 )
-                for row in rows
-            ]
-    return await run_in_threadpool(_get)
+                """
+                params.extend([int(since), token, int(since), token])
+            if category:
+                query += " AND n.category = ?"
+                params.append(category)
+            
+            cursor.execute(query + " ORDER BY n.category, n.name", params)
+            return dumps({
+                "token": str(token),
+                "full": since is None,
+                "items": BALANCE_ENCODER.encode_rows(cursor.fetchall())
+            })
+    return json_response(await run_in_threadpool(_get))
+
+@app.get("/api/stock/valuation")
+async def get_stock_valuation(as_of: Optional[datetime] = None, category: Optional[str] = None,
+                              items: bool = False):
+    """Вартість запасів за середньозваженою собівартістю (поточна або на дату)"""
+    def _get():
+        with get_db_connection() as conn:
+            return dumps(stock_valuation(conn.cursor(), as_of, category, items))
+    return json_response(await run_in_threadpool(_get))
 
 @app.post("/api/stock/receipt")
 async def stock_receipt(operation: StockOperation):
     """Прихід товару на склад"""
+    fingerprint = request_fingerprint("stock_receipt", operation)
+    
     def _receipt():
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
-            # Check idempotency
+            # Retried request - replay the original response
+            replay = lookup_response(conn, operation.idempotency_key, fingerprint)
+            if replay:
+                return replay
+            
+            # Check idempotency (posted before responses were stored)
             cursor.execute(
                 "SELECT id FROM stock_movements WHERE idempotency_key = ?",
                 (operation.idempotency_key,)
@@ -234,25 +528,36 @@ async def stock_receipt(operation: StockOperation):
                 (operation.nomenclature_id, quantity, new_balance, operation.price_per_unit, operation.idempotency_key, metadata_json)
             )
             
-            # Update balance
-            update_balance(conn, operation.nomenclature_id, new_balance)
+            # Update balance (priced receipts move the average cost)
+            update_balance(conn, operation.nomenclature_id, new_balance, quantity, operation.price_per_unit)
             
-            conn.commit()
-            return {
+            response = store_response(conn, operation.idempotency_key, "stock_receipt", fingerprint, {
                 "status": "success",
                 "message": "Прихід оброблено успішно",
                 "balance_after": new_balance
-            }
+            })
+            
+            conn.commit()
+            remember_response(operation.idempotency_key, fingerprint, response)
+            publish_balances([(operation.nomenclature_id, new_balance, quantity)])
+            return response
     return await run_in_threadpool(_receipt)
 
 @app.post("/api/stock/withdrawal")
 async def stock_withdrawal(operation: StockOperation):
     """Розхід товару зі складу"""
+    fingerprint = request_fingerprint("stock_withdrawal", operation)
+    
     def _withdrawal():
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
-            # Check idempotency
+            # Retried request - replay the original response
+            replay = lookup_response(conn, operation.idempotency_key, fingerprint)
+            if replay:
+                return replay
+            
+            # Check idempotency (posted before responses were stored)
             cursor.execute(
                 "SELECT id FROM stock_movements WHERE idempotency_key = ?",
                 (operation.idempotency_key,)
@@ -296,12 +601,16 @@ async def stock_withdrawal(operation: StockOperation):
             # Update balance
             update_balance(conn, operation.nomenclature_id, new_balance)
             
-            conn.commit()
-            return {
+            response = store_response(conn, operation.idempotency_key, "stock_withdrawal", fingerprint, {
                 "status": "success",
                 "message": "Розхід оброблено успішно",
                 "balance_after": new_balance
-            }
+            })
+            
+            conn.commit()
+            remember_response(operation.idempotency_key, fingerprint, response)
+            publish_balances([(operation.nomenclature_id, new_balance, -quantity)])
+            return response
     return await run_in_threadpool(_withdrawal)
 
 @app.get("/api/stock/movements", response_model=List[StockMovement])
@@ -334,23 +643,8 @@ async def get_movements(
             query += f" OFFSET 0 ROWS FETCH NEXT {limit} ROWS ONLY"
             
             cursor.execute(query, params)
-            rows = cursor.fetchall()
-            
-            return [
-                StockMovement(
-                    id=row[0],
-                    nomenclature_id=row[1],
-                    operation_type=row[2],
-                    quantity=float(row[3]),
-                    balance_after=float(row[4]),
-                    idempotency_key=row[5],
-                    metadata=row[6],
-                    operation_date=row[7],
-                    created_at=row[8]
-                )
-                for row in rows
-            ]
-    return await run_in_threadpool(_get)
+            return MOVEMENT_ENCODER.dumps(cursor.fetchall())
+    return json_response(await run_in_threadpool(_get))
 
 @app.post("/api/stock/inventory/start", response_model=InventorySession)
 async def start_inventory(session: InventorySessionCreate):
@@ -358,6 +652,8 @@ async def start_inventory(session: InventorySessionCreate):
     def _start():
         with get_db_connection() as conn:
             cursor = conn.cursor()
+            # Set before the transaction's first read (see take_inventory_snapshot)
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL SNAPSHOT")
             
             # Check idempotency
             cursor.execute(
@@ -388,6 +684,9 @@ async def start_inventory(session: InventorySessionCreate):
                 (session.session_type, session.idempotency_key, metadata_json)
             )
             new_id = cursor.fetchone()[0]
+            
+            # Freeze system quantities for the session scope
+            take_inventory_snapshot(conn, new_id, session)
             conn.commit()
             
             cursor.execute(
@@ -409,13 +708,20 @@ async def start_inventory(session: InventorySessionCreate):
 @app.post("/api/stock/inventory/complete")
 async def complete_inventory(inventory: InventoryComplete):
     """Завершити інвентаризацію"""
+    fingerprint = request_fingerprint("inventory_complete", inventory)
+    
     def _complete():
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
+            # Retried request - replay the original response
+            replay = lookup_response(conn, inventory.idempotency_key, fingerprint)
+            if replay:
+                return replay
+            
             # Check if session exists and is in progress
             cursor.execute(
-                "SELECT status FROM inventory_sessions WHERE id = ?",
+                "SELECT status, snapshot_movement_id FROM inventory_sessions WITH (UPDLOCK, HOLDLOCK) WHERE id = ?",
                 (inventory.session_id,)
             )
             session_row = cursor.fetchone()
@@ -425,44 +731,18 @@ async def complete_inventory(inventory: InventoryComplete):
             if session_row[0] == 'completed':
                 return {"status": "already_completed", "message": "Інвентаризація вже завершена"}
             
-            adjustments = []
+            items = collect_counted_items(conn, inventory.session_id, inventory.items)
             
-            for item in inventory.items:
-                precision = get_nomenclature_precision(conn, item.nomenclature_id)
-                system_quantity = get_current_balance(conn, item.nomenclature_id)
-                actual_quantity = round_quantity(item.actual_quantity, precision)
-                difference = round_quantity(actual_quantity - system_quantity, precision)
-                
-                # Save inventory item
-                cursor.execute(
-                    """INSERT INTO inventory_items 
-                       (session_id, nomenclature_id, system_quantity, actual_quantity, difference)
-                       VALUES (?, ?, ?, ?, ?)""",
-                    (inventory.session_id, item.nomenclature_id, system_quantity, actual_quantity, difference)
+            if session_row[1] is not None:
+                adjustments = reconcile_inventory_snapshot(
+                    conn, inventory.session_id, session_row[1],
+                    items, inventory.idempotency_key
+                )
+            else:
+                # Sessions started before snapshots existed: compare with current balance
+                adjustments = reconcile_inventory_current(
+                    conn, inventory.session_id, items, inventory.idempotency_key
                 )
-                
-                # If there's a difference, create adjustment movement
-                if difference != 0:
-                    operation_type = 'inventory_adjustment_receipt' if difference > 0 else 'inventory_adjustment_withdrawal'
-                    movement_key = f"{inventory.idempotency_key}_adj_{item.nomenclature_id}"
-                    
-                    cursor.execute(
-                        """INSERT INTO stock_movements 
-                           (nomenclature_id, operation_type, quantity, balance_after, idempotency_key, metadata)
-                           VALUES (?, ?, ?, ?, ?, ?)""",
-                        (item.nomenclature_id, abs(difference), actual_quantity, movement_key,
-                         json.dumps({"inventory_session_id": inventory.session_id}))
-                    )
-                    
-                    # Update balance
-                    update_balance(conn, item.nomenclature_id, actual_quantity)
-                    
-                    adjustments.append({
-                        "nomenclature_id": item.nomenclature_id,
-                        "difference": difference,
-                        "system_quantity": system_quantity,
-                        "actual_quantity": actual_quantity
-                    })
             
             # Mark session as completed
             cursor.execute(
@@ -470,151 +750,388 @@ async def complete_inventory(inventory: InventoryComplete):
                 (inventory.session_id,)
             )
             
-            conn.commit()
-            return {
+            response = store_response(conn, inventory.idempotency_key, "inventory_complete", fingerprint, {
                 "status": "success",
                 "message": "Інвентаризацію завершено",
                 "adjustments_count": len(adjustments),
                 "adjustments": adjustments
-            }
+            })
+            
+            conn.commit()
+            remember_response(inventory.idempotency_key, fingerprint, response)
+            publish_balances(
+                (adj["nomenclature_id"], adj["balance_after"], adj["difference"]) for adj in adjustments
+            )
+            return response
     return await run_in_threadpool(_complete)
 
-@app.post("/api/stock/receipt/bulk", response_model=BatchResponse)
-async def batch_receipt(batch_operation: BatchStockOperation):
-    """Масовий прихід товарів"""
-    from batch_operations import process_batch_receipt
+def check_session_in_progress(cursor, session_id: int):
+    """404 for an unknown session, 400 once it is completed"""
+    cursor.execute("SELECT status FROM inventory_sessions WHERE id = ?", (session_id,))
+    session_row = cursor.fetchone()
+    if not session_row:
+        raise HTTPException(status_code=404, detail="Сесія інвентаризації не знайдена")
     
-    def _batch():
-        try:
-            with get_db_connection() as conn:
-                successful, failed = process_batch_receipt(
-                    conn, batch_operation,
-                    get_nomenclature_precision,
-                    get_current_balance_locked,
-                    update_balance
+    if session_row[0] != 'in_progress':
+        raise HTTPException(status_code=400, detail="Інвентаризація вже завершена")
+
+@app.post("/api/stock/inventory/{session_id}/lines")
+async def add_inventory_count_lines(session_id: int, payload: InventoryCountLines):
+    """Додати рядки підрахунку до інвентаризації (сканер)"""
+    def _add():
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Shared read: scanners on one session do not serialize on its row
+            check_session_in_progress(cursor, session_id)
+            
+            # Skip keys repeated within the request and keys already stored
+            lines = list({line.line_key: line for line in payload.lines}.values())
+            existing_keys = set()
+            for keys in chunked([line.line_key for line in lines]):
+                cursor.execute(
+                    f"""SELECT line_key FROM inventory_count_lines
+                        WHERE session_id = ? AND line_key IN ({placeholders(len(keys))})""",
+                    [session_id, *keys]
                 )
+                existing_keys.update(row[0] for row in cursor.fetchall())
+            
+            new_lines = [line for line in lines if line.line_key not in existing_keys]
+            if new_lines:
+                cursor.fast_executemany = True
+                try:
+                    cursor.executemany(
+                        """INSERT INTO inventory_count_lines
+                           (session_id, nomenclature_id, quantity, line_key, device_id)
+                           VALUES (?, ?, ?, ?, ?)""",
+                        [(session_id, line.nomenclature_id, line.quantity, line.line_key, payload.device_id)
+                         for line in new_lines]
+                    )
+                except pyodbc.IntegrityError as e:
+                    if "UNIQUE" in str(e) or "duplicate" in str(e).lower():
+                        # Same line sent concurrently by another request - safe to retry
+                        raise HTTPException(status_code=409, detail="Рядок вже записується, повторіть запит")
+                    raise HTTPException(status_code=400, detail="Номенклатура не знайдена")
                 
-                total = len(batch_operation.operations)
-                success_count = len(successful)
-                fail_count = len(failed)
-                
-                results = successful + failed
-                
-                if fail_count == 0:
-                    status = "success"
-                    message = f"Всі {total} операцій виконано успішно"
-                elif success_count == 0:
-                    status = "error"
-                    message = f"Всі {total} операцій провалились"
-                else:
-                    status = "partial_success"
-                    message = f"Виконано {success_count} з {total} операцій. Провалено: {fail_count}"
-                
-                return BatchResponse(
-                    status=status,
-                    total_operations=total,
-                    successful=success_count,
-                    failed=fail_count,
-                    results=results,
-                    message=message
-                )
-        except Exception as e:
-            # Rollback happened (all_or_nothing=True)
-            error_msg = str(e)
-            return BatchResponse(
-                status="error",
-                total_operations=len(batch_operation.operations),
-                successful=0,
-                failed=len(batch_operation.operations),
-                results=[
-                    {"nomenclature_id": item.nomenclature_id, "status": "error", 
-                     "message": f"Batch failed: {error_msg}", "balance_after": None}
-                    for item in batch_operation.operations
-                ],
-                message=f"Batch operation failed: {error_msg}"
+                # complete_inventory range-locks the session's lines while it reads them,
+                # so lines inserted after that read only get here once it has committed
+                check_session_in_progress(cursor, session_id)
+            
+            conn.commit()
+            return {
+                "status": "success",
+                "accepted": len(new_lines),
+                "duplicates": len(payload.lines) - len(new_lines)
+            }
+    return await run_in_threadpool(_add)
+
+@app.get("/api/stock/inventory/{session_id}/lines")
+async def get_inventory_counts(session_id: int):
+    """Отримати накопичені підрахунки інвентаризації"""
+    def _get():
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT nomenclature_id, SUM(quantity), COUNT(*)
+                   FROM inventory_count_lines
+                   WHERE session_id = ?
+                   GROUP BY nomenclature_id""",
+                (session_id,)
             )
-    return await run_in_threadpool(_batch)
+            return [
+                {
+                    "nomenclature_id": row[0],
+                    "counted_quantity": float(row[1]),
+                    "lines_count": row[2]
+                }
+                for row in cursor.fetchall()
+            ]
+    return await run_in_threadpool(_get)
+
+def publish_posted_lines(results: List[dict]):
+    """Push balances of posted bulk/sync lines to subscribers (call after commit)"""
+    publish_balances(
+        (result["nomenclature_id"], result["balance_after"], None)
+        for result in results if result["status"] == "success"
+    )
+
+def compact_batch_response(content: dict) -> dict:
+    """Compact presentation of a bulk response: only the failed lines"""
+    return {**content, "results": [line for line in content["results"] if line["status"] == "error"]}
+
+def run_bulk_operation(batch_operation: BatchStockOperation, operation_type: str, compact: bool = False):
+    """Process bulk receipt/withdrawal and build the full (or compact) response"""
+    total = len(batch_operation.operations)
+    # compact only changes the presentation: the full response is stored
+    endpoint = f"bulk_{operation_type}"
+    fingerprint = request_fingerprint(endpoint, batch_operation)
+    response = None
+    try:
+        with get_db_connection() as conn:
+            # Retried request - replay the original response
+            replay = lookup_response(conn, batch_operation.idempotency_key, fingerprint)
+            if replay:
+                return compact_batch_response(json.loads(replay.body)) if compact else replay
+            
+            successful, failed = process_batch(
+                conn, batch_operation, operation_type,
+                get_nomenclature_precision,
+                get_current_balance_locked,
+                update_balance
+            )
+            
+            status, message = batch_summary(total, len(successful), len(failed))
+            result = BatchResponse(
+                status=status,
+                total_operations=total,
+                successful=len(successful),
+                failed=len(failed),
+                results=successful + failed,
+                message=message
+            )
+            # Partial batches are not stored: a retry has to re-post the failed lines
+            if not failed:
+                response = store_response(conn, batch_operation.idempotency_key, endpoint, fingerprint, result)
+    except HTTPException:
+        raise
+    except Exception as e:
+        # Rollback happened (all_or_nothing=True)
+        error_msg = str(e)
+        return BatchResponse(
+            status="error",
+            total_operations=total,
+            successful=0,
+            failed=total,
+            results=[] if compact else [
+                {"nomenclature_id": item.nomenclature_id, "status": "error",
+                 "message": f"Batch failed: {error_msg}", "balance_after": None}
+                for item in batch_operation.operations
+            ],
+            message=f"Batch operation failed: {error_msg}"
+        )
+    
+    publish_posted_lines(successful)
+    if response is not None:
+        remember_response(batch_operation.idempotency_key, fingerprint, response)
+    if compact:
+        return compact_batch_response(result.model_dump())
+    return result if response is None else response
+
+def stream_bulk_operation(batch_operation: BatchStockOperation, operation_type: str, compact: bool = False):
+    """
+    NDJSON generator: one record per processed line, summary last
+    A line is only sent once committed: partial batches commit chunk by chunk,
+    all-or-nothing batches send their lines after the commit.
+    """
+    total = len(batch_operation.operations)
+    partial = not batch_operation.all_or_nothing
+    success_count = 0
+    fail_count = 0
+    posted = []
+    lines = []
+    try:
+        with get_db_connection() as conn:
+            for idx, result in iter_batch(
+                conn, batch_operation, operation_type,
+                get_nomenclature_precision,
+                get_current_balance_locked,
+                update_balance,
+                commit_chunks=partial
+            ):
+                if result["status"] == "error":
+                    fail_count += 1
+                else:
+                    success_count += 1
+                    if partial:
+                        publish_posted_lines([result])
+                    else:
+                        posted.append(result)
+                    if compact:
+                        continue
+                if partial:
+                    yield ndjson_line(line_record(idx, result))
+                else:
+                    lines.append(ndjson_line(line_record(idx, result)))
+    except Exception as e:
+        # Rollback happened: nothing of an all-or-nothing batch was sent,
+        # lines of committed chunks stand
+        if partial:
+            yield ndjson_line(summary_record(
+                total, success_count, total - success_count, message=f"Batch operation failed: {e}"
+            ))
+        else:
+            yield ndjson_line(summary_record(
+                total, 0, total, status="error", message=f"Batch operation failed: {e}"
+            ))
+        return
+    
+    yield from lines
+    publish_posted_lines(posted)
+    yield ndjson_line(summary_record(total, success_count, fail_count))
+
+@app.post("/api/stock/receipt/bulk", response_model=BatchResponse)
+async def batch_receipt(batch_operation: BatchStockOperation, request: Request,
+                        stream: bool = False, compact: bool = False):
+    """Масовий прихід товарів"""
+    if wants_ndjson(request, stream):
+        return StreamingResponse(
+            iterate_in_thread(stream_bulk_operation(batch_operation, 'receipt', compact)),
+            media_type=NDJSON_MEDIA_TYPE
+        )
+    return await run_in_threadpool(run_bulk_operation, batch_operation, 'receipt', compact)
 
 @app.post("/api/stock/withdrawal/bulk", response_model=BatchResponse)
-async def batch_withdrawal(batch_operation: BatchStockOperation):
+async def batch_withdrawal(batch_operation: BatchStockOperation, request: Request,
+                           stream: bool = False, compact: bool = False):
     """Масовий розхід товарів"""
-    from batch_operations import process_batch_withdrawal
+    if wants_ndjson(request, stream):
+        return StreamingResponse(
+            iterate_in_thread(stream_bulk_operation(batch_operation, 'withdrawal', compact)),
+            media_type=NDJSON_MEDIA_TYPE
+        )
+    return await run_in_threadpool(run_bulk_operation, batch_operation, 'withdrawal', compact)
+
+def iter_stock_sync(operations) -> Iterator[Tuple[int, dict]]:
+    """Replay a run of offline stock operations over one connection, publish after commit"""
+    stored = []
+    with get_db_connection() as conn:
+        yield from iter_sync_replay(conn, operations, stored)
+    # Only operations posted now (replayed results were published when posted)
+    for idempotency_key, fingerprint, response, _ in stored:
+        remember_response(idempotency_key, fingerprint, response)
+    publish_posted_lines([result for _, _, _, result in stored])
+
+def sync_batch_step(handler, model):
+    """Sync handler for an endpoint taking (batch_id, payload)"""
+    async def _replay(payload: dict, batch_id: int) -> dict:
+        return await handler(batch_id, model(**payload))
+    return _replay
+
+def response_content(response) -> dict:
+    """Endpoint result as a dict (stored responses come back as raw JSON)"""
+    if isinstance(response, Response):
+        return json.loads(response.body)
+    return response
+
+async def sync_inventory(payload: dict, batch_id: Optional[int]) -> dict:
+    return response_content(await complete_inventory(InventoryComplete(**payload)))
+
+async def sync_inventory_lines(payload: dict, batch_id: Optional[int]) -> dict:
+    try:
+        session_id = int(payload["session_id"])
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Не вказано або невірний session_id інвентаризації")
+    return await add_inventory_count_lines(session_id, InventoryCountLines(**payload))
+
+async def sync_batch_create(payload: dict, batch_id: Optional[int]) -> dict:
+    batch = await create_batch(BatchCreate(**payload))
+    return {"batch_id": batch.id, "batch_number": batch.batch_number, "batch_status": batch.status}
+
+async def sync_packaging_create(payload: dict, batch_id: Optional[int]) -> dict:
+    batch = await create_packaging_batch(PackagingBatchCreate(**payload))
+    return {"batch_id": batch.id, "batch_number": batch.batch_number, "batch_status": batch.status}
+
+# Document operations accepted by /api/sync/operations
+SYNC_DOCUMENT_HANDLERS = {
+    "inventory": sync_inventory,
+    "inventory_lines": sync_inventory_lines,
+    "batch_create": sync_batch_create,
+    "batch_operation": sync_batch_step(add_batch_operation, BatchOperationCreate),
+    "batch_mix": sync_batch_step(produce_mix, BatchMixProduction),
+    "batch_salting": sync_batch_step(process_salting, BatchSalting),
+    "batch_sugar": sync_batch_step(process_sugar_massage, BatchSugar),
+    "batch_massage": sync_batch_step(process_water_massage, BatchMassage),
+    "batch_stuff": sync_batch_step(process_stuffing, BatchStuff),
+    "batch_complete": sync_batch_step(complete_batch, BatchComplete),
+    "packaging_create": sync_packaging_create,
+    "packaging_operation": sync_batch_step(record_packaging_operation, PackagingOperationCreate),
+    "packaging_complete": sync_batch_step(complete_packaging_batch, PackagingBatchComplete)
+}
+
+def post_stock_sync(operations) -> List[Tuple[int, dict]]:
+    """Results of a stock run, returned once committed (one worker thread throughout)"""
+    return list(iter_stock_sync(operations))
+
+async def replay_sync_operations(batch: SyncBatch) -> List[dict]:
+    """Replay offline operations in timestamp order, results in request order"""
+    results = [None] * len(batch.operations)
+    async for idx, result in iter_sync_operations(batch.operations, SYNC_DOCUMENT_HANDLERS, post_stock_sync):
+        results[idx] = result
+    return results
+
+async def stream_sync_operations(batch: SyncBatch, compact: bool = False):
+    """NDJSON generator for offline sync, summary after the last operation"""
+    total = len(batch.operations)
+    counts = {"success": 0, "error": 0}
     
-    def _batch():
-        try:
-            with get_db_connection() as conn:
-                successful, failed = process_batch_withdrawal(
-                    conn, batch_operation,
-                    get_nomenclature_precision,
-                    get_current_balance_locked,
-                    update_balance
-                )
-                
-                total = len(batch_operation.operations)
-                success_count = len(successful)
-                fail_count = len(failed)
-                
-                results = successful + failed
-                
-                if fail_count == 0:
-                    status = "success"
-                    message = f"Всі {total} операцій виконано успішно"
-                elif success_count == 0:
-                    status = "error"
-                    message = f"Всі {total} операцій провалились"
-                else:
-                    status = "partial_success"
-                    message = f"Виконано {success_count} з {total} операцій. Провалено: {fail_count}"
-                
-                return BatchResponse(
-                    status=status,
-                    total_operations=total,
-                    successful=success_count,
-                    failed=fail_count,
-                    results=results,
-                    message=message
-                )
-        except Exception as e:
-            # Rollback happened (all_or_nothing=True)
-            error_msg = str(e)
-            return BatchResponse(
-                status="error",
-                total_operations=len(batch_operation.operations),
-                successful=0,
-                failed=len(batch_operation.operations),
-                results=[
-                    {"nomenclature_id": item.nomenclature_id, "status": "error",
-                     "message": f"Batch failed: {error_msg}", "balance_after": None}
-                    for item in batch_operation.operations
-                ],
-                message=f"Batch operation failed: {error_msg}"
-            )
-    return await run_in_threadpool(_batch)
+    async for idx, result in iter_sync_operations(batch.operations, SYNC_DOCUMENT_HANDLERS, post_stock_sync):
+        if result["status"] == "error":
+            counts["error"] += 1
+            yield ndjson_line({"i": idx, "k": result["idempotency_key"], "s": "error", "e": result["message"]})
+            continue
+        counts["success"] += 1
+        if not compact:
+            yield ndjson_line(line_record(idx, result["result"], key=result["idempotency_key"]))
+    
+    yield ndjson_line(summary_record(total, counts["success"], counts["error"]))
 
 @app.post("/api/sync/operations")
-async def sync_operations(batch: SyncBatch):
+async def sync_operations(batch: SyncBatch, request: Request,
+                          stream: bool = False, compact: bool = False):
     """Синхронізувати офлайн операції"""
-    results = []
+    if wants_ndjson(request, stream):
+        return StreamingResponse(stream_sync_operations(batch, compact), media_type=NDJSON_MEDIA_TYPE)
     
-    for op in batch.operations:
-        try:
-            if op.operation_type == "receipt":
-                stock_op = StockOperation(**op.data)
-                result = await stock_receipt(stock_op)
-                results.append({"idempotency_key": op.idempotency_key, "status": "success", "result": result})
-            elif op.operation_type == "withdrawal":
-                stock_op = StockOperation(**op.data)
-                result = await stock_withdrawal(stock_op)
-                results.append({"idempotency_key": op.idempotency_key, "status": "success", "result": result})
-            else:
-                results.append({"idempotency_key": op.idempotency_key, "status": "error", "message": "Невідомий тип операції"})
-        except HTTPException as e:
-            results.append({"idempotency_key": op.idempotency_key, "status": "error", "message": str(e.detail)})
-        except Exception as e:
-            results.append({"idempotency_key": op.idempotency_key, "status": "error", "message": str(e)})
+    results = await replay_sync_operations(batch)
     
+    if compact:
+        failed = [r for r in results if r["status"] == "error"]
+        return {
+            "total": len(results),
+            "successful": len(results) - len(failed),
+            "failed": len(failed),
+            "results": failed
+        }
     return {"results": results}
 
+@app.get("/api/events")
+async def events(
+    topics: Optional[str] = None,
+    category: Optional[str] = None,
+    nomenclature_id: Optional[int] = None,
+    batch_id: Optional[int] = None,
+    packaging_batch_id: Optional[int] = None
+):
+    """Потік змін залишків та партій (Server-Sent Events)"""
+    selected = set(topics.split(",")) if topics else set(TOPICS)
+    unknown = selected - set(TOPICS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Невідомі теми: {', '.join(sorted(unknown))}")
+    
+    nomenclature_ids = None
+    if category:
+        # Category is resolved to ids once, at subscribe time
+        def _resolve():
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT id FROM nomenclature WHERE category = ?", (category,))
+                return {row[0] for row in cursor.fetchall()}
+        nomenclature_ids = await run_in_threadpool(_resolve)
+    if nomenclature_id is not None:
+        nomenclature_ids = {nomenclature_id} if nomenclature_ids is None else nomenclature_ids & {nomenclature_id}
+    
+    subscription = subscribe(
+        selected,
+        nomenclature_ids=nomenclature_ids,
+        batch_id=batch_id,
+        packaging_batch_id=packaging_batch_id
+    )
+    return StreamingResponse(
+        event_stream(subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -11,6 +11,7 @@ import csv
 from dotenv import load_dotenv
 
 from database import get_db_connection, init_database
+from idempotency_store import request_fingerprint, lookup_response, store_response, remember_response
 from models import (
     NomenclatureCreate, Nomenclature, StockOperation,
     StockMovement, StockBalance, InventorySessionCreate,
@@ -189,11 +190,18 @@ async def get_balances(category: Optional[str] = None):
 @app.post("/api/stock/receipt")
 async def stock_receipt(operation: StockOperation):
     """Прихід товару на склад"""
+    fingerprint = request_fingerprint("stock_receipt", operation)
+    
     def _receipt():
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
-            # Check idempotency
+            # Retried request - replay the original response (409 on a different request)
+            replay = lookup_response(conn, operation.idempotency_key, fingerprint)
+            if replay:
+                return replay
+            
+            # Check idempotency (posted before responses were stored)
             cursor.execute(
                 "SELECT id, quantity, price_per_unit FROM stock_movements WHERE idempotency_key = ?",
                 (operation.idempotency_key,)
@@ -234,22 +242,32 @@ async def stock_receipt(operation: StockOperation):
             # Update balance
             update_balance(conn, operation.nomenclature_id, new_balance)
             
-            conn.commit()
-            return {
+            response = store_response(conn, operation.idempotency_key, "stock_receipt", fingerprint, {
                 "status": "success",
                 "message": "Прихід оброблено успішно",
                 "balance_after": new_balance
-            }
+            })
+            
+            conn.commit()
+            remember_response(operation.idempotency_key, fingerprint, response)
+            return response
     return await run_in_threadpool(_receipt)
 
 @app.post("/api/stock/withdrawal")
 async def stock_withdrawal(operation: StockOperation):
     """Розхід товару зі складу"""
+    fingerprint = request_fingerprint("stock_withdrawal", operation)
+    
     def _withdrawal():
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
-            # Check idempotency
+            # Retried request - replay the original response (409 on a different request)
+            replay = lookup_response(conn, operation.idempotency_key, fingerprint)
+            if replay:
+                return replay
+            
+            # Check idempotency (posted before responses were stored)
             cursor.execute(
                 "SELECT id, quantity FROM stock_movements WHERE idempotency_key = ?",
                 (operation.idempotency_key,)
@@ -303,12 +321,15 @@ async def stock_withdrawal(operation: StockOperation):
             # Update balance
             update_balance(conn, operation.nomenclature_id, new_balance)
             
-            conn.commit()
-            return {
+            response = store_response(conn, operation.idempotency_key, "stock_withdrawal", fingerprint, {
                 "status": "success",
                 "message": "Розхід оброблено успішно",
                 "balance_after": new_balance
-            }
+            })
+            
+            conn.commit()
+            remember_response(operation.idempotency_key, fingerprint, response)
+            return response
     return await run_in_threadpool(_withdrawal)
 
 @app.get("/api/stock/movements", response_model=List[StockMovement])
@@ -0,0 +1,83 @@
+"""
+Request coalescing (single-flight) for hot read endpoints
+Concurrent identical reads (same route and normalized query parameters)
+share one in-flight DB execution and its result. An optional reuse window
+(SINGLEFLIGHT_REUSE_MS, off by default) also serves requests arriving
+right after the execution finished.
+"""
+import asyncio
+import os
+import time
+from typing import Callable, Dict, List
+
+from fastapi.concurrency import run_in_threadpool
+
+REUSE_SECONDS = float(os.getenv("SINGLEFLIGHT_REUSE_MS", "0")) / 1000.0
+
+_flights: List["SingleFlight"] = []
+
+def flight_key(route: str, **params) -> tuple:
+    """Route plus query parameters; unset parameters and their order do not matter"""
+    return (route,) + tuple(sorted((name, str(value)) for name, value in params.items() if value is not None))
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key (all callers on one event loop)"""
+
+    def __init__(self, name: str, reuse_seconds: float = REUSE_SECONDS):
+        self.name = name
+        self.reuse_seconds = reuse_seconds
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self._recent: Dict[tuple, tuple] = {}
+        self.requests = 0
+        self.executions = 0
+        self.shared = 0
+        self.reused = 0
+        _flights.append(self)
+
+    async def run(self, key: tuple, func: Callable):
+        """Result of func() (blocking, run in the threadpool), shared with identical concurrent calls"""
+        self.requests += 1
+
+        if self.reuse_seconds > 0:
+            recent = self._recent.get(key)
+            if recent and recent[0] > time.monotonic():
+                self.reused += 1
+                return recent[1]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            self.executions += 1
+            task = asyncio.ensure_future(run_in_threadpool(func))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, key=key: self._settle(key, done))
+
+        # shield: a disconnected caller must not cancel the execution others wait for
+        return await asyncio.shield(task)
+
+    def _settle(self, key: tuple, task: asyncio.Future):
+        self._inflight.pop(key, None)
+        # exception() also marks the error as retrieved when nobody waits anymore
+        if task.cancelled() or task.exception() is not None:
+            return
+        if self.reuse_seconds > 0:
+            now = time.monotonic()
+            if len(self._recent) >= 256:
+                self._recent = {k: v for k, v in self._recent.items() if v[0] > now}
+            self._recent[key] = (now + self.reuse_seconds, task.result())
+
+    def stats(self) -> dict:
+        hits = self.shared + self.reused
+        return {
+            "name": self.name,
+            "requests": self.requests,
+            "executions": self.executions,
+            "shared": self.shared,
+            "reused": self.reused,
+            "in_flight": len(self._inflight),
+            "hit_ratio": round(hits / self.requests, 4) if self.requests else 0.0
+        }
+
+def singleflight_stats() -> list:
+    return [flight.stats() for flight in _flights]
@@ -0,0 +1,127 @@
+"""
+Material deduction for production steps
+All balances a step takes from are locked in one statement (UPDLOCK,
+HOLDLOCK, ascending nomenclature id so concurrent steps lock in the same
+order), checked together and written in bulk: movements in one batched
+INSERT, balances in one valued MERGE by delta (valuation). A concurrent
+step waits on the locks instead of passing the check on a balance that is
+about to change. Withdrawals carry the item's locked average cost
+(price_per_unit); for a production batch they are added to the batch cost
+(costing).
+"""
+import json
+from typing import Dict, Iterable, List, Optional
+
+from costing import add_batch_costs
+from database import chunked, placeholders
+from material_requirements import ensure_available
+from valuation import post_balances
+
+def withdrawal(nomenclature_id: int, quantity: float, source_operation_type: str,
+               idempotency_key: str, metadata: Optional[dict] = None) -> dict:
+    """One withdrawal movement of a step"""
+    return {
+        'nomenclature_id': nomenclature_id,
+        'quantity': float(quantity),
+        'source_operation_type': source_operation_type,
+        'idempotency_key': idempotency_key,
+        'metadata': metadata or {},
+        'balance_after': None,
+        'unit_cost': None
+    }
+
+def lock_balances(cursor, nomenclature_ids: Iterable[int]) -> Dict[int, dict]:
+    """
+    Lock the balances of the ids until the transaction ends
+    {nomenclature_id: {name, unit, quantity, avg_cost}}; a missing balance row is
+    read as 0 and its key range stays locked as well
+    """
+    ids = sorted(set(nomenclature_ids))
+    locked = {}
+    for chunk in chunked(ids):
+        cursor.execute(f"""
+            SELECT n.id, n.name, n.unit, COALESCE(sb.quantity, 0) as quantity, sb.avg_cost
+            FROM nomenclature n
+            LEFT JOIN stock_balances sb WITH (UPDLOCK, HOLDLOCK, ROWLOCK) ON n.id = sb.nomenclature_id
+            WHERE n.id IN ({placeholders(len(chunk))})
+            ORDER BY n.id
+        """, chunk)
+        for row in cursor.fetchall():
+            locked[row[0]] = {
+                'name': row[1],
+                'unit': row[2],
+                'quantity': float(row[3]),
+                'avg_cost': float(row[4]) if row[4] is not None else None
+            }
+    return locked
+
+def post_withdrawals(cursor, withdrawals: List[dict], locked: Dict[int, dict], source_operation_id: str,
+                     message: str = "Недостатньо матеріалів на складі",
+                     batch_id: Optional[int] = None) -> List[dict]:
+    """
+    Check the withdrawals against locked balances and write them
+    Zero quantities are dropped; balance_after is filled in request order.
+    Withdrawals are valued at the locked average cost; with batch_id they
+    are added to the batch cost.
+    """
+    withdrawals = [item for item in withdrawals if item['quantity'] > 0]
+    if not withdrawals:
+        return []
+
+    required = {}
+    for item in withdrawals:
+        required[item['nomenclature_id']] = required.get(item['nomenclature_id'], 0.0) + item['quantity']
+
+    lines = []
+    for nomenclature_id, quantity in required.items():
+        balance = locked.get(nomenclature_id, {'name': None, 'unit': '', 'quantity': 0.0})
+        quantity = round(quantity, 6)
+        lines.append({
+            'nomenclature_id': nomenclature_id,
+            'name': balance['name'],
+            'unit': balance['unit'],
+            'required': quantity,
+            'available': balance['quantity'],
+            'shortage': round(max(quantity - balance['quantity'], 0.0), 6)
+        })
+    ensure_available(lines, message)
+
+    balances = {nomenclature_id: locked[nomenclature_id]['quantity'] for nomenclature_id in required}
+    for item in withdrawals:
+        balances[item['nomenclature_id']] -= item['quantity']
+        item['balance_after'] = balances[item['nomenclature_id']]
+        item['unit_cost'] = locked[item['nomenclature_id']].get('avg_cost')
+
+    cursor.fast_executemany = True
+    cursor.executemany("""
+        INSERT INTO stock_movements (
+            nomenclature_id, operation_type, quantity, balance_after, price_per_unit,
+            source_operation_type, source_operation_id,
+            idempotency_key, operation_date, metadata
+        )
+        VALUES (?, 'withdrawal', ?, ?, ?, ?, ?, ?, GETUTCDATE(), ?)
+    """, [
+        (item['nomenclature_id'], item['quantity'], item['balance_after'], item['unit_cost'],
+         item['source_operation_type'], source_operation_id, item['idempotency_key'],
+         json.dumps(item['metadata']))
+        for item in withdrawals
+    ])
+    cursor.fast_executemany = False
+
+    post_balances(cursor, [(nomenclature_id, -quantity, None) for nomenclature_id, quantity in required.items()])
+
+    if batch_id is not None:
+        add_batch_costs(cursor, batch_id, [
+            (item['nomenclature_id'], item['quantity'], item['unit_cost']) for item in withdrawals
+        ])
+    return withdrawals
+
+def deduct(cursor, withdrawals: List[dict], source_operation_id: str,
+           message: str = "Недостатньо матеріалів на складі", batch_id: Optional[int] = None) -> List[dict]:
+    """Lock, check and write the withdrawals of one step"""
+    locked = lock_balances(cursor, [item['nomenclature_id'] for item in withdrawals])
+    return post_withdrawals(cursor, withdrawals, locked, source_operation_id, message, batch_id)
+
+def withdrawal_changes(withdrawals: List[dict]) -> list:
+    """(nomenclature_id, balance_after, delta) for publish_balances"""
+    return [(item['nomenclature_id'], item['balance_after'], -item['quantity']) for item in withdrawals]
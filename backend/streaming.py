@@ -0,0 +1,79 @@
+"""
+NDJSON streaming helpers for bulk and sync endpoints
+One compact record per processed line, then a summary record
+"""
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator, Optional
+
+from fastapi import Request
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+_DONE = object()
+
+def wants_ndjson(request: Request, stream: bool = False) -> bool:
+    """Streaming is opt-in: ?stream=true or Accept: application/x-ndjson"""
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+def ndjson_line(record: dict) -> bytes:
+    """Serialize one NDJSON record"""
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+
+def line_record(idx: int, result: dict, key: Optional[str] = None) -> dict:
+    """
+    Compact per-line record:
+    i - line index, k - idempotency key, id - nomenclature, s - status,
+    b - balance after, e - error message
+    """
+    record = {"i": idx}
+    if key is not None:
+        record["k"] = key
+    if result.get("nomenclature_id") is not None:
+        record["id"] = result["nomenclature_id"]
+    record["s"] = result["status"]
+    if result.get("balance_after") is not None:
+        record["b"] = result["balance_after"]
+    if result["status"] == "error":
+        record["e"] = result.get("message")
+    return record
+
+def batch_summary(total: int, success_count: int, fail_count: int) -> tuple:
+    """Overall (status, message) of a bulk operation"""
+    if fail_count == 0:
+        return "success", f"Всі {total} операцій виконано успішно"
+    if success_count == 0:
+        return "error", f"Всі {total} операцій провалились"
+    return "partial_success", f"Виконано {success_count} з {total} операцій. Провалено: {fail_count}"
+
+def summary_record(total: int, success_count: int, fail_count: int, status: Optional[str] = None, message: Optional[str] = None) -> dict:
+    """Final NDJSON record; authoritative for all-or-nothing batches"""
+    default_status, default_message = batch_summary(total, success_count, fail_count)
+    return {
+        "summary": True,
+        "status": status or default_status,
+        "total_operations": total,
+        "successful": success_count,
+        "failed": fail_count,
+        "message": message or default_message
+    }
+
+async def iterate_in_thread(iterator: Iterator) -> AsyncIterator:
+    """
+    Drive a blocking generator from one dedicated thread, so the pyodbc
+    connection it holds is never used from another thread. Stopping early
+    (client disconnect) closes the generator on that thread, which rolls back.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        while True:
+            item = await loop.run_in_executor(executor, next, iterator, _DONE)
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        # Queued behind a next() that may still be running
+        executor.submit(iterator.close)
+        executor.shutdown(wait=False)
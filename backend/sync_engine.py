@@ -0,0 +1,451 @@
+"""
+Replay engine for offline sync (/api/sync/operations)
+All operations are replayed in client timestamp order; an operation
+referring to a batch created in the same sync waits for the creation.
+Consecutive stock operations are posted together over one connection:
+already processed keys are filtered with one IN query, the rest is
+grouped per nomenclature and posted with a savepoint per operation.
+Document operations (inventory, production, packaging) go through their
+API handlers, one transaction each.
+Results are stored with the request fingerprint (idempotency_store): a
+retried operation gets its original result back, the same key with a
+different request gets the 409 conflict as its error.
+"""
+import json
+from collections import defaultdict
+from itertools import groupby
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pyodbc
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+
+from batch_operations import round_quantity
+from database import get_db_connection, chunked, placeholders
+from idempotency_store import lookup_entries, remember_response, replay_entry, request_fingerprint, store_response
+from models import StockOperation, SyncOperation
+from valuation import post_balances
+
+# Operation types posted directly to the stock ledger
+STOCK_OPERATION_TYPES = ("receipt", "withdrawal")
+
+# Direct endpoint of each stock operation (same request model and fingerprint,
+# so a key posted through either path replays the same response)
+STOCK_ENDPOINTS = {"receipt": "stock_receipt", "withdrawal": "stock_withdrawal"}
+
+# Stored results of document operations are kept apart from the responses
+# their handlers store under the operation key
+DOCUMENT_KEY_PREFIX = "sync:"
+
+# Batch kinds that sync operations can refer to -> table holding their keys
+BATCH_TABLES = {
+    "batch": "batches",
+    "packaging_batch": "packaging_batches"
+}
+
+# Operations creating a batch -> kind of the created batch
+BATCH_CREATE_TYPES = {
+    "batch_create": "batch",
+    "packaging_create": "packaging_batch"
+}
+
+# Operations applied to an existing batch -> kind of the batch
+BATCH_REF_TYPES = {
+    "batch_operation": "batch",
+    "batch_mix": "batch",
+    "batch_salting": "batch",
+    "batch_sugar": "batch",
+    "batch_massage": "batch",
+    "batch_stuff": "batch",
+    "batch_complete": "batch",
+    "packaging_operation": "packaging_batch",
+    "packaging_complete": "packaging_batch"
+}
+
+# Operations replayed through their API handlers (one transaction each)
+DOCUMENT_OPERATION_TYPES = ("inventory", "inventory_lines") + tuple(BATCH_CREATE_TYPES) + tuple(BATCH_REF_TYPES)
+
+class SyncOperationError(Exception):
+    """Operation rejected by validation (nothing was written for it)"""
+    pass
+
+def sync_error(op: SyncOperation, message: str) -> dict:
+    return {"idempotency_key": op.idempotency_key, "status": "error", "message": message}
+
+def sync_success(op: SyncOperation, result: dict) -> dict:
+    return {"idempotency_key": op.idempotency_key, "status": "success", "result": result}
+
+def sync_replay(op: SyncOperation, idempotency_key: str, fingerprint: str, entry: tuple) -> dict:
+    """Stored result of a retried operation, or the 409 conflict as its error"""
+    try:
+        response = replay_entry(idempotency_key, fingerprint, entry)
+    except HTTPException as e:
+        return sync_error(op, str(e.detail))
+    return sync_success(op, json.loads(response.body))
+
+def stock_replay(op: SyncOperation, stock_op: StockOperation, fingerprint: str, entry: tuple) -> dict:
+    """sync_replay of a stock operation; the stored endpoint body gains the nomenclature"""
+    result = sync_replay(op, stock_op.idempotency_key, fingerprint, entry)
+    if result["status"] == "success":
+        result["result"] = {"nomenclature_id": stock_op.nomenclature_id, **result["result"]}
+    return result
+
+def fetch_processed_keys(conn, keys: List[str]) -> set:
+    """Keys that already have a movement"""
+    cursor = conn.cursor()
+    processed = set()
+    for chunk in chunked(list(set(keys))):
+        cursor.execute(
+            f"SELECT idempotency_key FROM stock_movements WHERE idempotency_key IN ({placeholders(len(chunk))})",
+            chunk
+        )
+        processed.update(row[0] for row in cursor.fetchall())
+    return processed
+
+def fetch_nomenclature_info(conn, nomenclature_ids: List[int]) -> dict:
+    """nomenclature_id -> (precision_digits, unit)"""
+    cursor = conn.cursor()
+    info = {}
+    for chunk in chunked(nomenclature_ids):
+        cursor.execute(
+            f"SELECT id, precision_digits, unit FROM nomenclature WHERE id IN ({placeholders(len(chunk))})",
+            chunk
+        )
+        info.update({row[0]: (row[1], row[2]) for row in cursor.fetchall()})
+    return info
+
+def lock_balances(conn, nomenclature_ids: List[int]) -> dict:
+    """Lock balance rows in id order (consistent lock ordering) and return them"""
+    cursor = conn.cursor()
+    balances = {}
+    for chunk in chunked(sorted(nomenclature_ids)):
+        cursor.execute(
+            f"""SELECT nomenclature_id, quantity FROM stock_balances WITH (UPDLOCK, ROWLOCK)
+                WHERE nomenclature_id IN ({placeholders(len(chunk))})
+                ORDER BY nomenclature_id""",
+            chunk
+        )
+        balances.update({row[0]: float(row[1]) for row in cursor.fetchall()})
+    return balances
+
+def post_stock_operation(cursor, operation_type: str, stock_op: StockOperation, precision: int, unit: str, current_balance: float) -> float:
+    """Insert the movement for one operation, returns the new balance"""
+    quantity = round_quantity(stock_op.quantity, precision)
+    if quantity <= 0:
+        raise SyncOperationError("Кількість має бути більше нуля")
+
+    if operation_type == "withdrawal":
+        if current_balance < quantity:
+            raise SyncOperationError(
+                f"Недостатньо товару на складі. Доступно: {current_balance} {unit}, запитано: {quantity} {unit}"
+            )
+        new_balance = round_quantity(current_balance - quantity, precision)
+        price_per_unit = None
+    else:
+        new_balance = round_quantity(current_balance + quantity, precision)
+        price_per_unit = stock_op.price_per_unit
+
+    metadata_json = json.dumps(stock_op.metadata) if stock_op.metadata else None
+    cursor.execute(
+        """INSERT INTO stock_movements
+           (nomenclature_id, operation_type, quantity, balance_after, price_per_unit, idempotency_key, metadata)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        (stock_op.nomenclature_id, operation_type, quantity, new_balance, price_per_unit,
+         stock_op.idempotency_key, metadata_json)
+    )
+    return new_balance
+
+def write_balance(cursor, nomenclature_id: int, quantity: float, receipts: List[Tuple[float, float]]):
+    """Final balance of a nomenclature; priced receipts (quantity, price) move the average cost"""
+    changes = [(nomenclature_id, quantity, price, received) for received, price in receipts]
+    post_balances(cursor, changes or [(nomenclature_id, quantity, None)], absolute=True)
+
+def iter_sync_replay(conn, operations: List[Tuple[int, SyncOperation]],
+                     stored: Optional[list] = None) -> Iterator[Tuple[int, dict]]:
+    """
+    Replay a run of stock operations given as (operation_index, operation),
+    yielding (operation_index, result) in processing order. The caller
+    commits once at the end and then passes the (key, fingerprint, response,
+    result) entries collected in stored to remember_response.
+    The stored response is the direct endpoint's own body, so a key replays
+    the same bytes through either path.
+    """
+    cursor = conn.cursor()
+
+    # Parse and validate payloads up front
+    pending = []
+    for idx, op in operations:
+        if op.operation_type in DOCUMENT_OPERATION_TYPES:
+            continue
+        if op.operation_type not in STOCK_OPERATION_TYPES:
+            yield idx, sync_error(op, "Невідомий тип операції")
+            continue
+        try:
+            pending.append((idx, op, StockOperation(**op.data)))
+        except ValidationError as e:
+            yield idx, sync_error(op, str(e))
+
+    fingerprints = {
+        idx: request_fingerprint(STOCK_ENDPOINTS[op.operation_type], stock_op) for idx, op, stock_op in pending
+    }
+
+    # 1. Pre-filter already processed keys with one IN query each: stored
+    # results are replayed, movements posted before results were stored
+    # are reported as processed
+    keys = [stock_op.idempotency_key for _, _, stock_op in pending]
+    processed_keys = fetch_processed_keys(conn, keys)
+    entries = lookup_entries(conn, keys)
+    remaining = []
+    for idx, op, stock_op in pending:
+        key = stock_op.idempotency_key
+        if key in entries:
+            yield idx, stock_replay(op, stock_op, fingerprints[idx], entries[key])
+        elif key in processed_keys:
+            yield idx, sync_success(op, {"status": "already_processed", "message": "Операція вже оброблена"})
+        else:
+            remaining.append((idx, op, stock_op))
+
+    if not remaining:
+        return
+
+    # 2. Order by client timestamp (stable for equal timestamps)
+    remaining.sort(key=lambda entry: entry[1].timestamp)
+
+    # 3. Group per nomenclature; groups are posted in id order
+    groups = defaultdict(list)
+    for entry in remaining:
+        groups[entry[2].nomenclature_id].append(entry)
+
+    nomenclature_info = fetch_nomenclature_info(conn, list(groups))
+    balances = lock_balances(conn, list(groups))
+
+    for nomenclature_id in sorted(groups):
+        if nomenclature_id not in nomenclature_info:
+            for idx, op, _ in groups[nomenclature_id]:
+                yield idx, sync_error(op, "Номенклатура не знайдена")
+            continue
+
+        precision, unit = nomenclature_info[nomenclature_id]
+        balance = balances.get(nomenclature_id, 0.0)
+        posted = False
+        receipts = []
+
+        for idx, op, stock_op in groups[nomenclature_id]:
+            key = stock_op.idempotency_key
+            # Same key queued twice in one sync
+            if key in entries:
+                yield idx, stock_replay(op, stock_op, fingerprints[idx], entries[key])
+                continue
+
+            savepoint = f"sync_op_{idx}"
+            cursor.execute(f"SAVE TRANSACTION {savepoint}")
+            try:
+                new_balance = post_stock_operation(cursor, op.operation_type, stock_op, precision, unit, balance)
+                body = {
+                    "status": "success",
+                    "message": "Прихід оброблено успішно" if op.operation_type == "receipt" else "Розхід оброблено успішно",
+                    "balance_after": new_balance
+                }
+                response = store_response(conn, key, STOCK_ENDPOINTS[op.operation_type], fingerprints[idx], body)
+            except SyncOperationError as e:
+                yield idx, sync_error(op, str(e))
+                continue
+            except Exception as e:
+                cursor.execute(f"ROLLBACK TRANSACTION {savepoint}")
+                yield idx, sync_error(op, str(e))
+                continue
+
+            balance = new_balance
+            result = {"nomenclature_id": nomenclature_id, **body}
+            entries[key] = (fingerprints[idx], response.status_code, response.body)
+            if stored is not None:
+                stored.append((key, fingerprints[idx], response, result))
+            posted = True
+            if op.operation_type == "receipt" and stock_op.price_per_unit is not None:
+                receipts.append((round_quantity(stock_op.quantity, precision), stock_op.price_per_unit))
+            yield idx, sync_success(op, result)
+
+        # One balance write per nomenclature
+        if posted:
+            write_balance(cursor, nomenclature_id, balance, receipts)
+
+def operation_payload(op: SyncOperation) -> dict:
+    """Operation data; the operation key is the default idempotency key"""
+    return {"idempotency_key": op.idempotency_key, **op.data}
+
+def is_stock_operation(op: SyncOperation) -> bool:
+    return op.operation_type not in DOCUMENT_OPERATION_TYPES
+
+def plan_operations(operations: List[SyncOperation]) -> List[Tuple[int, SyncOperation]]:
+    """
+    Order all operations by client timestamp; an operation referring
+    to a batch created in the same sync is held back until the creation
+    (device clocks may disagree).
+    """
+    ordered = sorted(enumerate(operations), key=lambda entry: entry[1].timestamp)
+    creations = {
+        (BATCH_CREATE_TYPES[op.operation_type], operation_payload(op)["idempotency_key"])
+        for _, op in ordered if op.operation_type in BATCH_CREATE_TYPES
+    }
+
+    planned = []
+    created = set()
+    waiting = defaultdict(list)
+
+    def emit(entry):
+        planned.append(entry)
+        op = entry[1]
+        if op.operation_type in BATCH_CREATE_TYPES:
+            ref = (BATCH_CREATE_TYPES[op.operation_type], operation_payload(op)["idempotency_key"])
+            created.add(ref)
+            for dependent in waiting.pop(ref, []):
+                emit(dependent)
+
+    for entry in ordered:
+        op = entry[1]
+        if op.operation_type in BATCH_REF_TYPES and op.data.get("batch_id") is None:
+            ref = (BATCH_REF_TYPES[op.operation_type], op.data.get("batch_ref"))
+            if ref in creations and ref not in created:
+                waiting[ref].append(entry)
+                continue
+        emit(entry)
+
+    return planned
+
+def fetch_batch_ids(conn, kind: str, keys: List[str]) -> dict:
+    """idempotency key of batch creation -> batch id"""
+    cursor = conn.cursor()
+    ids = {}
+    for chunk in chunked(list(set(keys))):
+        cursor.execute(
+            f"SELECT idempotency_key, id FROM {BATCH_TABLES[kind]} WHERE idempotency_key IN ({placeholders(len(chunk))})",
+            chunk
+        )
+        ids.update({row[0]: row[1] for row in cursor.fetchall()})
+    return ids
+
+def fetch_batch_refs(refs: List[Tuple[str, str]]) -> dict:
+    """Resolve refs to batches created by earlier syncs: (kind, key) -> batch id"""
+    if not refs:
+        return {}
+    keys_by_kind = defaultdict(list)
+    for kind, key in refs:
+        keys_by_kind[kind].append(key)
+
+    resolved = {}
+    with get_db_connection() as conn:
+        for kind, keys in keys_by_kind.items():
+            for key, batch_id in fetch_batch_ids(conn, kind, keys).items():
+                resolved[(kind, key)] = batch_id
+    return resolved
+
+def fetch_stored_entries(keys: List[str]) -> Dict[str, tuple]:
+    if not keys:
+        return {}
+    with get_db_connection() as conn:
+        return lookup_entries(conn, keys)
+
+def save_document_result(idempotency_key: str, endpoint: str, fingerprint: str, result: dict) -> tuple:
+    """
+    Store a document operation result once its handler has committed
+    Returns the stored entry; a concurrent sync of the same operation may
+    have stored it first
+    """
+    try:
+        with get_db_connection() as conn:
+            response = store_response(conn, idempotency_key, endpoint, fingerprint, result)
+    except pyodbc.IntegrityError:
+        return fetch_stored_entries([idempotency_key]).get(idempotency_key)
+    remember_response(idempotency_key, fingerprint, response)
+    return fingerprint, response.status_code, response.body
+
+async def iter_sync_operations(operations: List[SyncOperation], handlers: Dict[str, Callable],
+                               post_stock: Callable) -> AsyncIterator[Tuple[int, dict]]:
+    """
+    Replay offline operations, yielding (operation_index, result) in
+    processing order.
+    post_stock: [(operation_index, operation)] -> [(operation_index, result)],
+    posts a run of stock operations and returns once they are committed.
+    handlers: operation_type -> async (payload, batch_id) -> dict for document
+    operations; creation handlers return the new batch id as "batch_id".
+    """
+    planned = plan_operations(operations)
+    documents = [(idx, op) for idx, op in planned if not is_stock_operation(op)]
+
+    # Refs not created in this sync are looked up with one IN query per kind
+    created_here = {
+        (BATCH_CREATE_TYPES[op.operation_type], operation_payload(op)["idempotency_key"])
+        for _, op in documents if op.operation_type in BATCH_CREATE_TYPES
+    }
+    external_refs = {
+        (BATCH_REF_TYPES[op.operation_type], op.data["batch_ref"])
+        for _, op in documents
+        if op.operation_type in BATCH_REF_TYPES and op.data.get("batch_id") is None and op.data.get("batch_ref")
+    } - created_here
+    batch_ids = await run_in_threadpool(fetch_batch_refs, list(external_refs))
+    failed_refs = set()
+
+    # Results stored by earlier syncs of the same operations
+    keys = {idx: DOCUMENT_KEY_PREFIX + op.idempotency_key for idx, op in documents}
+    entries = await run_in_threadpool(fetch_stored_entries, list(set(keys.values())))
+
+    for stock, run in groupby(planned, key=lambda entry: is_stock_operation(entry[1])):
+        run = list(run)
+        if stock:
+            try:
+                results = await run_in_threadpool(post_stock, run)
+            except Exception as e:
+                # The run was rolled back as a whole
+                results = [(idx, sync_error(op, f"Операцію не записано: {e}")) for idx, op in run]
+            for idx, result in results:
+                yield idx, result
+            continue
+
+        for idx, op in run:
+            payload = operation_payload(op)
+            key = keys[idx]
+            fingerprint = request_fingerprint(f"sync_{op.operation_type}", payload)
+            if key in entries:
+                result = sync_replay(op, key, fingerprint, entries[key])
+                if op.operation_type in BATCH_CREATE_TYPES:
+                    ref = (BATCH_CREATE_TYPES[op.operation_type], payload["idempotency_key"])
+                    if result["status"] == "success":
+                        batch_ids[ref] = result["result"]["batch_id"]
+                    else:
+                        failed_refs.add(ref)
+                yield idx, result
+                continue
+
+            try:
+                batch_id = None
+                if op.operation_type in BATCH_REF_TYPES:
+                    batch_id = payload.get("batch_id")
+                    if batch_id is None:
+                        ref = (BATCH_REF_TYPES[op.operation_type], payload.get("batch_ref"))
+                        if ref[1] is None:
+                            raise SyncOperationError("Не вказано партію (batch_id або batch_ref)")
+                        if ref in failed_refs:
+                            raise SyncOperationError(f"Партію не створено: операція {ref[1]} завершилась з помилкою")
+                        if ref not in batch_ids:
+                            raise SyncOperationError(f"Партію не знайдено: {ref[1]}")
+                        batch_id = batch_ids[ref]
+
+                response = await handlers[op.operation_type](payload, batch_id)
+            except Exception as e:
+                if op.operation_type in BATCH_CREATE_TYPES:
+                    failed_refs.add((BATCH_CREATE_TYPES[op.operation_type], payload["idempotency_key"]))
+                if isinstance(e, HTTPException):
+                    message = str(e.detail)
+                else:
+                    message = str(e)
+                yield idx, sync_error(op, message)
+                continue
+
+            if op.operation_type in BATCH_CREATE_TYPES:
+                batch_ids[(BATCH_CREATE_TYPES[op.operation_type], payload["idempotency_key"])] = response["batch_id"]
+            result = {"status": "success", **response}
+            entry = await run_in_threadpool(save_document_result, key, f"sync_{op.operation_type}", fingerprint, result)
+            if entry is not None:
+                entries[key] = entry
+            yield idx, sync_success(op, result)
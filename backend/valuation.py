@@ -0,0 +1,144 @@
+"""
+Moving weighted-average cost
+stock_balances carries avg_cost (NULL until the first priced receipt) and
+stock_value (quantity x avg_cost). Balance writes go through
+post_balances: one MERGE changes quantity, average cost and value
+together, and writes the new state to stock_cost_history for as-of
+valuation. A priced receipt moves the average; withdrawals and unpriced
+receipts keep it and revalue the new quantity.
+"""
+from datetime import datetime
+from typing import Iterable, Optional
+
+from database import chunked
+
+# Four parameters per row in the MERGE (2100 parameters per statement at most)
+BALANCE_ROWS = 500
+
+# Quantity held at the current average (stock without a cost does not dilute it)
+HELD_SQL = "CASE WHEN sb.quantity > 0 AND sb.avg_cost IS NOT NULL THEN sb.quantity ELSE 0 END"
+
+def merge_sql(rows: int, absolute: bool) -> str:
+    new_quantity = "d.quantity" if absolute else "sb.quantity + d.quantity"
+    avg_cost = f"""CASE WHEN d.received > 0
+                THEN ({HELD_SQL} * COALESCE(sb.avg_cost, 0) + d.received_value) / ({HELD_SQL} + d.received)
+                ELSE sb.avg_cost END"""
+    return f"""
+        MERGE stock_balances WITH (HOLDLOCK) AS sb
+        USING (
+            SELECT nomenclature_id,
+                   CAST(quantity AS DECIMAL(18, 6)) AS quantity,
+                   CAST(received AS DECIMAL(18, 6)) AS received,
+                   CAST(received_value AS DECIMAL(18, 6)) AS received_value
+            FROM (VALUES {', '.join(['(?, ?, ?, ?)'] * rows)}) AS v(nomenclature_id, quantity, received, received_value)
+        ) AS d
+        ON sb.nomenclature_id = d.nomenclature_id
+        WHEN MATCHED THEN
+            UPDATE SET quantity = {new_quantity},
+                       avg_cost = {avg_cost},
+                       stock_value = CASE WHEN {new_quantity} > 0
+                                          THEN ({new_quantity}) * COALESCE({avg_cost}, 0)
+                                          ELSE 0 END,
+                       last_updated = GETUTCDATE()
+        WHEN NOT MATCHED THEN
+            INSERT (nomenclature_id, quantity, avg_cost, stock_value, last_updated)
+            VALUES (d.nomenclature_id, d.quantity,
+                    CASE WHEN d.received > 0 THEN d.received_value / d.received END,
+                    CASE WHEN d.quantity > 0 AND d.received > 0
+                         THEN d.quantity * d.received_value / d.received ELSE 0 END,
+                    GETUTCDATE())
+        OUTPUT INSERTED.nomenclature_id, INSERTED.quantity, INSERTED.avg_cost, INSERTED.stock_value, SYSUTCDATETIME()
+        INTO stock_cost_history (nomenclature_id, quantity, avg_cost, stock_value, changed_at);
+    """
+
+def post_balances(cursor, changes: Iterable[tuple], absolute: bool = False):
+    """
+    Apply balance changes with valuation
+    changes: (nomenclature_id, quantity, price_per_unit[, received_quantity])
+    quantity is the change, or the new balance with absolute=True.
+    received_quantity at price_per_unit moves the average cost; it defaults
+    to a positive change. Several changes of one item are applied as one,
+    priced receipts first.
+    """
+    merged = {}
+    for change in changes:
+        nomenclature_id, quantity, price_per_unit = change[:3]
+        received = change[3] if len(change) > 3 else (quantity if not absolute and quantity > 0 else 0)
+        row = merged.setdefault(nomenclature_id, [0.0, 0.0, 0.0])
+        row[0] = quantity if absolute else row[0] + quantity
+        if price_per_unit is not None and received > 0:
+            row[1] += received
+            row[2] += received * price_per_unit
+
+    rows = [(nomenclature_id, *values) for nomenclature_id, values in sorted(merged.items())]
+    for chunk in chunked(rows, BALANCE_ROWS):
+        cursor.execute(merge_sql(len(chunk), absolute), [value for row in chunk for value in row])
+
+def cost_row(row) -> dict:
+    """(id, name, category, unit, quantity, avg_cost, stock_value) row"""
+    return {
+        'nomenclature_id': row[0],
+        'name': row[1],
+        'category': row[2],
+        'unit': row[3],
+        'quantity': float(row[4]) if row[4] is not None else 0.0,
+        'avg_cost': round(float(row[5]), 6) if row[5] is not None else None,
+        'stock_value': round(float(row[6]), 2) if row[6] is not None else 0.0
+    }
+
+def stock_valuation(cursor, as_of: Optional[datetime] = None, category: Optional[str] = None,
+                    with_items: bool = False) -> dict:
+    """
+    Total and per-category stock value in one grouped query
+    Current values are read from stock_balances; as_of (UTC) reads the last
+    stock_cost_history state of each item at that moment.
+    """
+    if as_of is None:
+        source = """
+            SELECT n.id, n.name, n.category, n.unit, sb.quantity, sb.avg_cost, sb.stock_value
+            FROM nomenclature n
+            JOIN stock_balances sb ON n.id = sb.nomenclature_id
+        """
+        params = []
+    else:
+        source = """
+            SELECT n.id, n.name, n.category, n.unit, h.quantity, h.avg_cost, h.stock_value
+            FROM nomenclature n
+            CROSS APPLY (
+                SELECT TOP 1 quantity, avg_cost, stock_value
+                FROM stock_cost_history
+                WHERE nomenclature_id = n.id AND changed_at <= ?
+                ORDER BY changed_at DESC
+            ) h
+        """
+        params = [as_of]
+    if category:
+        source += " WHERE n.category = ?"
+        params.append(category)
+
+    cursor.execute(f"""
+        SELECT s.category, SUM(s.stock_value), COUNT(*),
+               SUM(CASE WHEN s.avg_cost IS NULL AND s.quantity > 0 THEN 1 ELSE 0 END)
+        FROM ({source}) s (id, name, category, unit, quantity, avg_cost, stock_value)
+        GROUP BY s.category
+        ORDER BY SUM(s.stock_value) DESC
+    """, params)
+    categories = [
+        {
+            'category': row[0],
+            'stock_value': round(float(row[1] or 0), 2),
+            'items': row[2],
+            'uncosted_items': row[3]
+        }
+        for row in cursor.fetchall()
+    ]
+
+    result = {
+        'as_of': as_of.isoformat() if as_of else None,
+        'total_value': round(sum(entry['stock_value'] for entry in categories), 2),
+        'categories': categories
+    }
+    if with_items:
+        cursor.execute(source + " ORDER BY n.category, n.name", params)
+        result['items'] = [cost_row(row) for row in cursor.fetchall()]
+    return result
@@ -0,0 +1,88 @@
+"""
+Data versions for conditional GET (ETag / If-None-Match) on catalog endpoints
+Each resource family has an in-process version: a stamp read once from the
+database (row count and highest rowversion of its tables, so unchanged data
+keeps its ETag across restarts and workers) plus a counter bumped by the
+API write paths. A 304 is answered without touching the DB; writes made
+outside the API (seed scripts) show up after a restart.
+"""
+import threading
+from typing import Optional
+
+from fastapi import Request, Response
+
+from database import get_db_connection
+
+# Resource families
+NOMENCLATURE = "nomenclature"
+RECIPES = "recipes"
+PACKAGING_RECIPES = "packaging_recipes"
+
+# Tables whose rows make up each family
+FAMILY_TABLES = {
+    NOMENCLATURE: ("nomenclature",),
+    RECIPES: ("recipes", "recipe_steps", "recipe_spices", "recipe_ingredients"),
+    PACKAGING_RECIPES: ("packaging_recipes", "packaging_recipe_materials"),
+}
+
+# Clients may keep the response but must revalidate it (a cheap 304)
+CACHE_CONTROL = "private, no-cache"
+
+# family -> [database stamp, writes since]
+_versions = {}
+_lock = threading.Lock()
+
+def version_sql(family: str) -> str:
+    parts = " UNION ALL ".join(
+        f"SELECT COUNT_BIG(*) AS row_count, MAX(row_version) AS row_version FROM {table}"
+        for table in FAMILY_TABLES[family]
+    )
+    return f"SELECT SUM(row_count), CAST(MAX(row_version) AS BIGINT) FROM ({parts}) v"
+
+def load_versions(cursor=None):
+    """Seed every family's version from the database (startup)"""
+    if cursor is None:
+        with get_db_connection() as conn:
+            return load_versions(conn.cursor())
+    stamps = {}
+    for family in FAMILY_TABLES:
+        cursor.execute(version_sql(family))
+        row_count, row_version = cursor.fetchone()
+        stamps[family] = f"{row_count or 0:x}-{row_version or 0:x}"
+    with _lock:
+        _versions.update({family: [stamp, 0] for family, stamp in stamps.items()})
+
+def get_version(family: str) -> str:
+    if family not in _versions:
+        # Startup could not reach the database
+        load_versions()
+    stamp, writes = _versions[family]
+    return f"{stamp}.{writes}"
+
+def bump_version(*families: str):
+    """Invalidate cached representations of the given families (call after commit)"""
+    with _lock:
+        for family in families:
+            if family in _versions:
+                _versions[family][1] += 1
+
+def etag_for(*families: str) -> str:
+    """Weak ETag built from the versions of every family the response depends on"""
+    return f'W/"{"/".join(get_version(family) for family in families)}"'
+
+def check_not_modified(request: Request, response: Response, *families: str) -> Optional[Response]:
+    """
+    Returns a 304 response if the client copy is current,
+    otherwise sets ETag/Cache-Control on the outgoing response and returns None
+    """
+    etag = etag_for(*families)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        client_tags = [tag.strip() for tag in if_none_match.split(",")]
+        if "*" in client_tags or etag in client_tags:
+            return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return None
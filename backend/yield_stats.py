@@ -0,0 +1,233 @@
+"""
+Yield statistics per recipe
+complete_batch adds the batch yield to the recipe's day and month buckets
+(yield_stats): count, weights, mean and M2 updated with Welford's step,
+min/max and out-of-range counts against the recipe's expected yield.
+Percentiles come from a fixed-width histogram kept per bucket
+(yield_histogram). Analytics read whole months and the days at the edges
+of the requested range and combine them, so the cost does not grow with
+the number of batches.
+"""
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Histogram buckets of yield percent: [0, 200) in 0.5% steps, outliers clamped
+BUCKET_WIDTH = 0.5
+BUCKETS = 400
+
+PERCENTILES = (('p10', 0.1), ('p50', 0.5), ('p90', 0.9))
+
+# Lower bound of the month buckets when the range has no start
+EPOCH = date(2000, 1, 1)
+
+# Current UTC day and month buckets of the completed batch
+PERIODS_SQL = """
+    SELECT period_type, period_start
+    FROM (VALUES ('D', CAST(GETUTCDATE() AS DATE)),
+                 ('M', DATEFROMPARTS(YEAR(GETUTCDATE()), MONTH(GETUTCDATE()), 1)))
+        AS p(period_type, period_start)
+"""
+
+def yield_bucket(yield_percent: float) -> int:
+    return min(max(int(yield_percent // BUCKET_WIDTH), 0), BUCKETS - 1)
+
+def record_yield(cursor, recipe_id: int, initial_weight: float, final_weight: float,
+                 expected_min: Optional[float], expected_max: Optional[float]) -> Optional[float]:
+    """Add a completed batch to the current day and month buckets; returns the yield percent"""
+    if not initial_weight or initial_weight <= 0 or final_weight is None:
+        return None
+    yield_percent = final_weight * 100.0 / initial_weight
+    below = 1 if expected_min is not None and yield_percent < float(expected_min) else 0
+    above = 1 if expected_max is not None and yield_percent > float(expected_max) else 0
+
+    cursor.execute(f"""
+        MERGE yield_stats WITH (HOLDLOCK) AS s
+        USING (
+            SELECT ? AS recipe_id, p.period_type, p.period_start,
+                   CAST(? AS FLOAT) AS input_weight, CAST(? AS FLOAT) AS output_weight,
+                   CAST(? AS FLOAT) AS yield_percent, ? AS below_range, ? AS above_range
+            FROM ({PERIODS_SQL}) p
+        ) AS d
+        ON s.recipe_id = d.recipe_id AND s.period_type = d.period_type AND s.period_start = d.period_start
+        WHEN MATCHED THEN
+            UPDATE SET batch_count = s.batch_count + 1,
+                       input_weight = s.input_weight + d.input_weight,
+                       output_weight = s.output_weight + d.output_weight,
+                       mean_yield = s.mean_yield + (d.yield_percent - s.mean_yield) / (s.batch_count + 1),
+                       m2_yield = s.m2_yield + SQUARE(d.yield_percent - s.mean_yield) * s.batch_count / (s.batch_count + 1),
+                       min_yield = CASE WHEN d.yield_percent < s.min_yield THEN d.yield_percent ELSE s.min_yield END,
+                       max_yield = CASE WHEN d.yield_percent > s.max_yield THEN d.yield_percent ELSE s.max_yield END,
+                       below_range = s.below_range + d.below_range,
+                       above_range = s.above_range + d.above_range,
+                       updated_at = GETUTCDATE()
+        WHEN NOT MATCHED THEN
+            INSERT (recipe_id, period_type, period_start, batch_count, input_weight, output_weight,
+                    mean_yield, m2_yield, min_yield, max_yield, below_range, above_range, updated_at)
+            VALUES (d.recipe_id, d.period_type, d.period_start, 1, d.input_weight, d.output_weight,
+                    d.yield_percent, 0, d.yield_percent, d.yield_percent, d.below_range, d.above_range,
+                    GETUTCDATE());
+
+        MERGE yield_histogram WITH (HOLDLOCK) AS h
+        USING (
+            SELECT ? AS recipe_id, p.period_type, p.period_start, ? AS bucket
+            FROM ({PERIODS_SQL}) p
+        ) AS d
+        ON h.recipe_id = d.recipe_id AND h.period_type = d.period_type
+           AND h.period_start = d.period_start AND h.bucket = d.bucket
+        WHEN MATCHED THEN
+            UPDATE SET batch_count = h.batch_count + 1
+        WHEN NOT MATCHED THEN
+            INSERT (recipe_id, period_type, period_start, bucket, batch_count)
+            VALUES (d.recipe_id, d.period_type, d.period_start, d.bucket, 1);
+    """, recipe_id, initial_weight, final_weight, yield_percent, below, above,
+        recipe_id, yield_bucket(yield_percent))
+    return yield_percent
+
+def parse_day(value: Optional[str]) -> Optional[date]:
+    """ISO date or datetime (a trailing Z is accepted) -> UTC day; naive values are taken as UTC"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc)
+    return parsed.date()
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+def next_month(day: date) -> date:
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def period_ranges(start: Optional[date], end: Optional[date],
+                  today: Optional[date] = None) -> List[Tuple[str, date, date]]:
+    """
+    Cover [start, end] (days, inclusive) with (period_type, from, to) ranges:
+    whole months as 'M' buckets, the partial months at the edges as 'D'
+    buckets. A month that has not ended yet is whole up to today.
+    """
+    today = today or datetime.utcnow().date()
+    end = min(end, today) if end else today
+    if start and start > end:
+        return []
+
+    if not start:
+        first = EPOCH
+    else:
+        first = start if start.day == 1 else next_month(start)
+    # The month of end is whole when end is its last day or nothing later exists yet
+    if end == today or next_month(end) - timedelta(days=1) == end:
+        last = month_start(end)
+    else:
+        last = month_start(month_start(end) - timedelta(days=1))
+    if first > last:
+        return [('D', start, end)]
+
+    ranges = [('M', first, last)]
+    if start and start < first:
+        ranges.append(('D', start, first - timedelta(days=1)))
+    if next_month(last) <= end:
+        ranges.append(('D', next_month(last), end))
+    return ranges
+
+def combine(parts: Iterable[tuple]) -> dict:
+    """
+    Combine (count, input, output, mean, m2, min, max, below, above) buckets
+    (Chan's parallel form of Welford's update)
+    """
+    count, input_weight, output_weight, mean, m2 = 0, 0.0, 0.0, 0.0, 0.0
+    low, high, below, above = None, None, 0, 0
+    for n, part_input, part_output, part_mean, part_m2, part_min, part_max, part_below, part_above in parts:
+        if not n:
+            continue
+        total = count + n
+        delta = part_mean - mean
+        mean += delta * n / total
+        m2 += part_m2 + delta * delta * count * n / total
+        count = total
+        input_weight += part_input
+        output_weight += part_output
+        low = part_min if low is None else min(low, part_min)
+        high = part_max if high is None else max(high, part_max)
+        below += part_below
+        above += part_above
+    return {
+        'count': count, 'input_weight': input_weight, 'output_weight': output_weight,
+        'mean': mean if count else None, 'variance': m2 / (count - 1) if count > 1 else None,
+        'min': low, 'max': high, 'below_range': below, 'above_range': above
+    }
+
+def percentile(histogram: Dict[int, int], q: float, low: Optional[float], high: Optional[float]) -> Optional[float]:
+    """Interpolated percentile of a bucket histogram, bounded by the observed min/max"""
+    total = sum(histogram.values())
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for bucket in sorted(histogram):
+        count = histogram[bucket]
+        if seen + count >= rank:
+            value = (bucket + (rank - seen) / count) * BUCKET_WIDTH
+            break
+        seen += count
+    if low is not None:
+        value = max(value, low)
+    if high is not None:
+        value = min(value, high)
+    return value
+
+def yield_summary(stats: dict, histogram: Dict[int, int]) -> dict:
+    """Stats of combine() and the matching histogram as response fields"""
+    count = stats['count']
+    result = {
+        'completed_count': count,
+        'total_input_weight': round(stats['input_weight'], 3),
+        'total_output_weight': round(stats['output_weight'], 3),
+        'avg_yield_percent': round(stats['mean'], 2) if stats['mean'] is not None else 0,
+        'yield_stddev': round(stats['variance'] ** 0.5, 2) if stats['variance'] is not None else None,
+        'min_yield_percent': round(stats['min'], 2) if stats['min'] is not None else None,
+        'max_yield_percent': round(stats['max'], 2) if stats['max'] is not None else None,
+        'below_range': stats['below_range'],
+        'above_range': stats['above_range'],
+        'out_of_range_rate': round((stats['below_range'] + stats['above_range']) / count, 4) if count else None
+    }
+    for name, q in PERCENTILES:
+        value = percentile(histogram, q, stats['min'], stats['max'])
+        result[f'{name}_yield_percent'] = round(value, 2) if value is not None else None
+    return result
+
+def load_yield_stats(cursor, start: Optional[date], end: Optional[date],
+                     recipe_id: Optional[int] = None) -> Tuple[Dict[int, list], Dict[int, Dict[int, int]]]:
+    """
+    Bucket rows covering [start, end] per recipe
+    ({recipe_id: [combine() parts]}, {recipe_id: {bucket: count}})
+    """
+    ranges = period_ranges(start, end)
+    if not ranges:
+        return {}, {}
+    where = " OR ".join(["(period_type = ? AND period_start BETWEEN ? AND ?)"] * len(ranges))
+    params = [value for period in ranges for value in period]
+    if recipe_id:
+        where = f"recipe_id = ? AND ({where})"
+        params = [recipe_id] + params
+
+    cursor.execute(f"""
+        SELECT recipe_id, batch_count, input_weight, output_weight, mean_yield, m2_yield,
+               min_yield, max_yield, below_range, above_range
+        FROM yield_stats
+        WHERE {where};
+
+        SELECT recipe_id, bucket, SUM(batch_count)
+        FROM yield_histogram
+        WHERE {where}
+        GROUP BY recipe_id, bucket
+    """, params + params)
+
+    parts = {}
+    for row in cursor.fetchall():
+        parts.setdefault(row[0], []).append(tuple(row[1:]))
+
+    cursor.nextset()
+    histograms = {}
+    for row in cursor.fetchall():
+        histograms.setdefault(row[0], {})[row[1]] = row[2]
+    return parts, histograms
@@ -233,13 +233,13 @@ export default function AnalyticsScreen() {
                   <Text style={[
                     styles.metricValue,
                     {
-                      color: recipe.avg_yield >= recipe.expected_yield_min && 
-                             recipe.avg_yield <= recipe.expected_yield_max 
+                      color: recipe.avg_yield_percent >= recipe.expected_yield_min && 
+                             recipe.avg_yield_percent <= recipe.expected_yield_max 
                         ? '#4CAF50' 
                         : '#FF9800'
                     }
                   ]}>
-                    {recipe.avg_yield.toFixed(1)}%
+                    {recipe.avg_yield_percent.toFixed(1)}%
                   </Text>
                 </View>
                 
@@ -250,6 +250,41 @@ export default function AnalyticsScreen() {
                   </Text>
                 </View>
               </View>
+              
+              {recipe.completed_count > 0 && (
+                <View style={styles.recipeMetrics}>
+                  <View style={styles.metric}>
+                    <Text style={styles.metricLabel}>P10-P90</Text>
+                    <Text style={styles.metricValue}>
+                      {recipe.p10_yield_percent?.toFixed(1)}-{recipe.p90_yield_percent?.toFixed(1)}%
+                    </Text>
+                  </View>
+                  
+                  <View style={styles.metric}>
+                    <Text style={styles.metricLabel}>Медіана</Text>
+                    <Text style={styles.metricValue}>
+                      {recipe.p50_yield_percent?.toFixed(1)}%
+                    </Text>
+                  </View>
+                  
+                  <View style={styles.metric}>
+                    <Text style={styles.metricLabel}>Відхилення</Text>
+                    <Text style={styles.metricValue}>
+                      {recipe.yield_stddev != null ? `±${recipe.yield_stddev.toFixed(1)}` : '-'}
+                    </Text>
+                  </View>
+                  
+                  <View style={styles.metric}>
+                    <Text style={styles.metricLabel}>Поза нормою</Text>
+                    <Text style={[
+                      styles.metricValue,
+                      { color: recipe.out_of_range_rate > 0 ? '#FF9800' : '#4CAF50' }
+                    ]}>
+                      {((recipe.out_of_range_rate || 0) * 100).toFixed(0)}%
+                    </Text>
+                  </View>
+                </View>
+              )}
             </View>
           ))}
           
@@ -45,34 +45,20 @@ export default function BatchDetailScreen() {
   const [finalWeight, setFinalWeight] = useState('');
   const [notes, setNotes] = useState('');
 
-  const { data: batch, isLoading, refetch } = useQuery({
+  // Batch, recipe with steps and operations in one request
+  const { data: details, isLoading, refetch } = useQuery({
     queryKey: ['batch', id],
     queryFn: async () => {
-      const response = await fetch(`${API_URL}/api/production/batches/${id}`);
+      const response = await fetch(
+        `${API_URL}/api/production/batches/${id}/full?fields=batch,recipe,operations`
+      );
       if (!response.ok) throw new Error('Failed to fetch batch');
       return response.json();
     },
   });
-
-  const { data: recipe } = useQuery({
-    queryKey: ['recipe', batch?.recipe_id],
-    queryFn: async () => {
-      if (!batch) return null;
-      const response = await fetch(`${API_URL}/api/production/recipes/${batch.recipe_id}`);
-      if (!response.ok) throw new Error('Failed to fetch recipe');
-      return response.json();
-    },
-    enabled: !!batch,
-  });
-
-  const { data: operations = [] } = useQuery({
-    queryKey: ['batch-operations', id],
-    queryFn: async () => {
-      const response = await fetch(`${API_URL}/api/production/batches/${id}/operations`);
-      if (!response.ok) return [];
-      return response.json();
-    },
-  });
+  const batch: Batch | undefined = details?.batch;
+  const recipe = details?.recipe;
+  const operations: any[] = details?.operations ?? [];
 
   const completeBatchMutation = useMutation({
     mutationFn: async (data: any) => {
@@ -476,7 +462,6 @@ export default function BatchDetailScreen() {
                           setWeightModalVisible(false);
                           setWeightInput('');
                           refetch();
-                          queryClient.invalidateQueries({ queryKey: ['batch-operations', id] });
                         })
                         .catch((err) => {
                           Alert.alert('Помилка', 'Не вдалося додати операцію');
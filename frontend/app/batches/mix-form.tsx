@@ -108,7 +108,6 @@ export default function MixFormScreen() {
     },
     onSuccess: () => {
       queryClient.invalidateQueries({ queryKey: ['batch', batchId] });
-      queryClient.invalidateQueries({ queryKey: ['batch-operations', batchId] });
       Alert.alert('Успіх', 'Мікс виготовлено', [
         { text: 'OK', onPress: () => router.back() }
       ]);
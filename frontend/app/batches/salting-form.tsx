@@ -60,7 +60,6 @@ export default function SaltingFormScreen() {
     },
     onSuccess: () => {
       queryClient.invalidateQueries({ queryKey: ['batch', batchId] });
-      queryClient.invalidateQueries({ queryKey: ['batch-operations', batchId] });
       Alert.alert('Успіх', 'Засолку виконано', [
         { text: 'OK', onPress: () => router.back() }
       ]);
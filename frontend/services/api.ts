@@ -126,12 +126,43 @@ export interface InventoryItem {
   actual_quantity: number;
 }
 
+export interface BootstrapBundle {
+  reference_version: string;
+  // Pass to /stock/balances/changes?since= for balance deltas
+  balances_token: string;
+  // null when the client already holds reference_version
+  reference: {
+    nomenclature: Nomenclature[];
+    recipes: any[];
+    packaging_recipes: any[];
+  } | null;
+  balances: StockBalance[];
+}
+
 // Offline queue management
 const QUEUE_KEY = 'offline_queue';
 
+export type QueuedOperationType =
+  | 'receipt'
+  | 'withdrawal'
+  | 'inventory'
+  | 'inventory_lines'
+  | 'batch_create'
+  | 'batch_operation'
+  | 'batch_mix'
+  | 'batch_salting'
+  | 'batch_sugar'
+  | 'batch_massage'
+  | 'batch_stuff'
+  | 'batch_complete'
+  | 'packaging_create'
+  | 'packaging_operation'
+  | 'packaging_complete';
+
 export interface QueuedOperation {
   id: string;
-  type: 'receipt' | 'withdrawal' | 'inventory';
+  type: QueuedOperationType;
+  // Batch steps carry batch_id, or batch_ref = idempotency_key of the queued batch_create
   data: any;
   timestamp: string;
 }
@@ -165,6 +196,14 @@ export async function clearOfflineQueue() {
 
 // API Functions
 export const apiService = {
+  // Cold start: reference data and balances in one request
+  async getBootstrap(referenceVersion?: string): Promise<BootstrapBundle> {
+    const response = await api.get('/bootstrap', {
+      params: referenceVersion ? { reference_version: referenceVersion } : {},
+    });
+    return response.data;
+  },
+
   // Nomenclature
   async getNomenclature(): Promise<Nomenclature[]> {
     const response = await api.get('/nomenclature');
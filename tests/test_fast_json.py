@@ -0,0 +1,129 @@
+"""
+Fast JSON path (backend/fast_json.py) against the pydantic response models
+Run as a script for a CPU-per-row benchmark:  python tests/test_fast_json.py
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip("pydantic")
+pytest.importorskip("fastapi")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from fast_json import RowEncoder  # noqa: E402
+from models import Batch, Nomenclature, PackagingBatch, StockBalance, StockMovement  # noqa: E402
+
+NOW = datetime(2025, 11, 13, 9, 30, 15, 123000)
+
+CASES = [
+    (
+        Nomenclature,
+        ("id", "name", "category", "unit", "precision_digits", "created_at", "updated_at"),
+        [(1, "Яловичина", "raw", "кг", 3, NOW, NOW), (2, "Сіль", "spice", "кг", 2, NOW, datetime(2025, 1, 1))]
+    ),
+    (
+        StockBalance,
+        ("nomenclature_id", "nomenclature_name", "category", "unit", "quantity", "last_updated"),
+        [(1, "Яловичина", "raw", "кг", Decimal("125.500"), NOW), (2, "Сіль", "spice", "кг", Decimal("0"), NOW)]
+    ),
+    (
+        StockMovement,
+        ("id", "nomenclature_id", "operation_type", "quantity", "balance_after",
+         "idempotency_key", "metadata", "operation_date", "created_at"),
+        [
+            (10, 1, "receipt", Decimal("12.345"), Decimal("137.845"), "k-1", None, NOW, NOW),
+            (11, 1, "withdrawal", Decimal("-2"), Decimal("135.845"), "k-2", '{"a": 1}', NOW, NOW)
+        ]
+    ),
+    (
+        Batch,
+        ("id", "batch_number", "recipe_id", "recipe_name", "status", "current_step",
+         "started_at", "completed_at", "initial_weight", "final_weight", "trim_waste",
+         "trim_returned", "operator_notes"),
+        [
+            (5, "B-20251113-001", 2, "Бастурма", "in_progress", 3, NOW, None,
+             Decimal("100.000"), None, Decimal("1.5"), False, None),
+            (6, "B-20251113-002", 2, None, "completed", 7, NOW, NOW,
+             Decimal("80"), Decimal("52.4"), None, None, "ok")
+        ]
+    ),
+    (
+        PackagingBatch,
+        ("id", "batch_number", "recipe_id", "source_product_id", "target_product_id",
+         "status", "planned_quantity", "source_weight_taken",
+         "actual_packed_quantity", "actual_source_used", "waste_quantity",
+         "started_at", "completed_at", "operator_notes",
+         "source_product_name", "target_product_name",
+         "packaging_type", "target_weight_grams"),
+        [
+            (3, "P-20251113-001", 4, 20, 31, "created", 100, Decimal("25.000"),
+             0, Decimal("0"), Decimal("0"), NOW, None, None, "Бастурма", "Бастурма 100г", "vacuum", 100),
+            # int fields read from DECIMAL columns
+            (4, "P-20251113-002", 4, 20, 31, "completed", Decimal("120"), Decimal("30.000"),
+             Decimal("118.000"), Decimal("29.5"), Decimal("0.5"), NOW, NOW, None, None, None, None, Decimal("250"))
+        ]
+    ),
+]
+
+def reference(model, columns, rows) -> list:
+    """What FastAPI renders for response_model=List[model]"""
+    return [model(**dict(zip(columns, row))).model_dump(mode="json") for row in rows]
+
+@pytest.mark.parametrize("model,columns,rows", CASES, ids=[case[0].__name__ for case in CASES])
+def test_matches_pydantic_output(model, columns, rows):
+    fast = json.loads(RowEncoder(model, columns).dumps(rows))
+    expected = reference(model, columns, rows)
+    assert fast == expected
+    assert [list(item) for item in fast] == [list(item) for item in expected]
+
+def test_unselected_fields_get_defaults():
+    columns = ("nomenclature_id", "nomenclature_name", "category", "unit", "quantity", "last_updated")
+    row = (1, "Сіль", "spice", "кг", Decimal("1"), NOW)
+    movement_columns = ("id", "nomenclature_id", "operation_type", "quantity", "balance_after",
+                        "idempotency_key", "operation_date", "created_at")
+    movement = RowEncoder(StockMovement, movement_columns).encode_rows([(1, 1, "receipt", 1, 1, "k", NOW, NOW)])[0]
+    assert movement["price_per_unit"] is None and movement["metadata"] is None
+    assert RowEncoder(StockBalance, columns).encode_rows([row])[0]["quantity"] == 1.0
+
+def test_int_fields_are_not_rendered_as_floats():
+    model, columns, rows = CASES[-1]
+    body = RowEncoder(model, columns).dumps(rows[1:])
+    assert b'"planned_quantity":120,' in body and b'"actual_packed_quantity":118,' in body
+    assert b'"target_weight_grams":250' in body
+
+def test_rejects_unknown_or_missing_fields():
+    with pytest.raises(ValueError):
+        RowEncoder(StockBalance, ("nomenclature_id", "nomenclature_name", "category", "unit", "qty", "last_updated"))
+    with pytest.raises(ValueError):
+        RowEncoder(StockBalance, ("nomenclature_id", "nomenclature_name", "category", "unit", "quantity"))
+
+def benchmark(rows_count: int = 20000):
+    """CPU per row: pydantic model + jsonable rendering vs compiled encoder"""
+    from fastapi.encoders import jsonable_encoder
+
+    model, columns, sample = CASES[1]
+    rows = [sample[i % len(sample)] for i in range(rows_count)]
+
+    start = time.process_time()
+    items = [model(**dict(zip(columns, row))) for row in rows]
+    json.dumps(jsonable_encoder(items), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    pydantic_seconds = time.process_time() - start
+
+    encoder = RowEncoder(model, columns)
+    start = time.process_time()
+    encoder.dumps(rows)
+    fast_seconds = time.process_time() - start
+
+    print(f"{model.__name__}, {rows_count} rows")
+    print(f"  pydantic: {pydantic_seconds / rows_count * 1e6:.2f} us/row")
+    print(f"  fast:     {fast_seconds / rows_count * 1e6:.2f} us/row")
+    print(f"  speedup:  {pydantic_seconds / max(fast_seconds, 1e-9):.1f}x")
+
+if __name__ == "__main__":
+    benchmark()
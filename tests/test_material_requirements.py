@@ -0,0 +1,92 @@
+"""
+Material requirements (backend/material_requirements.py): norms -> required quantities
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("pyodbc")
+pytest.importorskip("dotenv")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from material_requirements import compare_with_balances, compute_requirements  # noqa: E402
+
+MEAT, PEPPER, SALT, CASING = 1, 2, 3, 4
+
+NORMS = {
+    10: [
+        {'nomenclature_id': MEAT, 'kind': 'ingredient', 'per_100kg': 100.0},
+        {'nomenclature_id': PEPPER, 'kind': 'spice', 'per_100kg': 2.5},
+        {'nomenclature_id': SALT, 'kind': 'salt', 'per_100kg': 3.0},
+    ],
+    20: [
+        {'nomenclature_id': PEPPER, 'kind': 'spice', 'per_100kg': 1.0},
+        {'nomenclature_id': SALT, 'kind': 'spice', 'per_100kg': 0.5},
+        {'nomenclature_id': CASING, 'kind': 'casing', 'capacity_kg': 2.5},
+    ],
+    30: [],
+}
+
+class BalanceCursor:
+    """nomenclature/stock_balances join answered from a dict: id -> (name, unit, quantity)"""
+
+    def __init__(self, balances: dict):
+        self.balances = balances
+        self.rows = []
+
+    def execute(self, sql, params):
+        self.rows = [(nid, *self.balances[nid]) for nid in params if nid in self.balances]
+
+    def fetchall(self):
+        return self.rows
+
+def required(result: dict) -> dict:
+    return {nomenclature_id: line['required'] for nomenclature_id, line in result.items()}
+
+def test_scales_with_batch_size():
+    small = required(compute_requirements(NORMS, [(10, 40.0)]))
+    large = required(compute_requirements(NORMS, [(10, 80.0)]))
+    assert small == pytest.approx({MEAT: 40.0, PEPPER: 1.0, SALT: 1.2})
+    assert large == pytest.approx({nomenclature_id: 2 * quantity for nomenclature_id, quantity in small.items()})
+
+def test_merges_material_across_steps_and_batches():
+    result = compute_requirements(NORMS, [(10, 100.0), (20, 50.0), (10, 20.0)])
+    assert result[PEPPER]['required'] == pytest.approx(2.5 + 0.5 + 0.5)
+    assert result[SALT]['required'] == pytest.approx(3.0 + 0.25 + 0.6)
+    # Each kind is listed once, in order of first use
+    assert result[SALT]['kinds'] == ['salt', 'spice']
+    assert result[PEPPER]['kinds'] == ['spice']
+
+def test_kinds_filter():
+    result = compute_requirements(NORMS, [(10, 100.0), (20, 100.0)], kinds=('spice',))
+    assert set(result) == {PEPPER, SALT}
+    assert result[SALT]['required'] == pytest.approx(0.5)
+
+def test_casings_are_rounded_up_per_batch():
+    result = compute_requirements(NORMS, [(20, 11.0), (20, 2.5)])
+    # ceil(11 / 2.5) = 5 and exactly 1 for the second batch
+    assert result[CASING]['required'] == 6.0
+
+def test_lines_are_rounded_to_six_digits():
+    plan = [(10, 10.0)] * 3  # 3 x 0.3 kg salt accumulates float error
+    result = compute_requirements(NORMS, plan, kinds=('salt',))
+    assert result[SALT]['required'] != 0.9
+    lines = compare_with_balances(BalanceCursor({SALT: ('Сіль', 'кг', 0.3)}), result)
+    assert lines == [{
+        'nomenclature_id': SALT,
+        'name': 'Сіль',
+        'unit': 'кг',
+        'kinds': ['salt'],
+        'required': 0.9,
+        'available': 0.3,
+        'shortage': 0.6
+    }]
+
+def test_empty_recipe_and_plan():
+    assert compute_requirements(NORMS, [(30, 100.0)]) == {}
+    assert compute_requirements(NORMS, [(99, 100.0)]) == {}
+    assert compute_requirements(NORMS, []) == {}
+    assert compare_with_balances(BalanceCursor({}), {}) == []
@@ -0,0 +1,97 @@
+"""
+Production planning (backend/planning.py): norm matrix demand and run-out days
+"""
+import os
+import sys
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("fastapi")
+pytest.importorskip("pyodbc")
+pytest.importorskip("dotenv")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+import planning  # noqa: E402
+from planning import NormMatrix, build_plan  # noqa: E402
+
+MEAT, PEPPER, CASING = 1, 2, 3
+
+NORMS = {
+    1: [
+        {'nomenclature_id': MEAT, 'kind': 'ingredient', 'per_100kg': 100.0},
+        {'nomenclature_id': PEPPER, 'kind': 'spice', 'per_100kg': 2.0},
+        {'nomenclature_id': CASING, 'kind': 'casing', 'capacity_kg': 5.0},
+    ],
+    2: [
+        {'nomenclature_id': PEPPER, 'kind': 'spice', 'per_100kg': 1.0},
+    ],
+}
+
+class BalanceCursor:
+    """nomenclature/stock_balances join answered from a dict: id -> (name, unit, quantity)"""
+
+    def __init__(self, balances: dict):
+        self.balances = balances
+        self.rows = []
+
+    def execute(self, sql, params):
+        self.rows = [(nid, *self.balances[nid]) for nid in params if nid in self.balances]
+
+    def fetchall(self):
+        return self.rows
+
+def test_matrix_coefficients():
+    matrix = NormMatrix(NORMS)
+    assert matrix.recipe_ids == [1, 2]
+    assert matrix.material_ids == [MEAT, PEPPER, CASING]
+    np.testing.assert_allclose(matrix.linear, [[1.0, 0.0], [0.02, 0.01], [0.0, 0.0]])
+    np.testing.assert_allclose(matrix.capacity, [[0, 0], [0, 0], [5.0, 0]])
+
+def test_demand_per_material_and_day():
+    matrix = NormMatrix(NORMS)
+    # recipe 1: 50 kg on day 0 and 12 kg on day 2; recipe 2: 100 kg on day 1
+    demand = matrix.demand(
+        np.array([0, 1, 0]), np.array([0, 1, 2]), np.array([50.0, 100.0, 12.0]), days=3
+    )
+    np.testing.assert_allclose(demand, [
+        [50.0, 0.0, 12.0],   # meat
+        [1.0, 1.0, 0.24],    # pepper from both recipes
+        [10.0, 0.0, 3.0],    # casings: ceil(50 / 5), ceil(12 / 5)
+    ])
+
+def test_run_out_day_and_shortage(monkeypatch):
+    monkeypatch.setattr(planning, "load_norms", lambda cursor, recipe_ids: NORMS)
+    items = [
+        SimpleNamespace(recipe_id=1, initial_weight=50.0, batches=1, planned_date=date(2020, 1, 1)),
+        SimpleNamespace(recipe_id=2, initial_weight=100.0, batches=1, planned_date=date(2020, 1, 2)),
+        SimpleNamespace(recipe_id=1, initial_weight=12.0, batches=1, planned_date=date(2020, 1, 3)),
+    ]
+    cursor = BalanceCursor({
+        MEAT: ('Яловичина', 'кг', 60.0),
+        PEPPER: ('Перець', 'кг', 5.0),
+        CASING: ('Оболонка', 'шт', 10.0),
+    })
+
+    plan = build_plan(cursor, items)
+
+    assert plan['start_date'] == '2020-01-01'
+    assert plan['end_date'] == '2020-01-03'
+    assert plan['batches'] == 3
+    assert plan['feasible'] is False
+    materials = {material['nomenclature_id']: material for material in plan['materials']}
+    # 60 - 50 - 12: short on the third day
+    assert materials[MEAT]['runs_out_on'] == '2020-01-03'
+    assert materials[MEAT]['shortage'] == pytest.approx(2.0)
+    assert materials[MEAT]['projected_min'] == pytest.approx(-2.0)
+    # 10 casings cover day 0 exactly; 3 more are needed on day 2
+    assert materials[CASING]['runs_out_on'] == '2020-01-03'
+    assert materials[CASING]['shortage'] == pytest.approx(3.0)
+    assert materials[PEPPER]['runs_out_on'] is None
+    assert materials[PEPPER]['required'] == pytest.approx(2.24)
+    # Earliest run-out first, larger shortage first on the same day
+    assert [material['nomenclature_id'] for material in plan['materials']] == [CASING, MEAT, PEPPER]
+    assert [material['nomenclature_id'] for material in plan['shortages']] == [CASING, MEAT]
@@ -0,0 +1,140 @@
+"""
+Offline sync replay (backend/sync_engine.py): one timestamp order across stock and document operations
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("pyodbc")
+pytest.importorskip("dotenv")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+import sync_engine  # noqa: E402
+from idempotency_store import request_fingerprint, serialize_response  # noqa: E402
+from models import StockOperation, SyncOperation  # noqa: E402
+from sync_engine import iter_sync_operations, plan_operations, stock_replay  # noqa: E402
+
+START = datetime(2026, 10, 19, 8, 0)
+MEAT, SAUSAGE = 1, 2
+
+def operation(minute: int, operation_type: str, key: str, **data) -> SyncOperation:
+    return SyncOperation(
+        operation_type=operation_type, data=data, idempotency_key=key,
+        timestamp=START + timedelta(minutes=minute)
+    )
+
+class Warehouse:
+    """Stock runs and document handlers over one in-memory balance table"""
+
+    def __init__(self):
+        self.stock = {MEAT: 0.0, SAUSAGE: 0.0}
+        self.calls = []
+
+    def post_stock(self, run):
+        self.calls.append(("stock", [op.idempotency_key for _, op in run]))
+        results = []
+        for idx, op in run:
+            quantity = op.data["quantity"]
+            if op.operation_type == "withdrawal" and self.stock[op.data["nomenclature_id"]] < quantity:
+                results.append((idx, sync_engine.sync_error(op, "Недостатньо товару на складі")))
+                continue
+            self.stock[op.data["nomenclature_id"]] += quantity if op.operation_type == "receipt" else -quantity
+            results.append((idx, sync_engine.sync_success(op, {"status": "success"})))
+        return results
+
+    def handlers(self):
+        async def batch_create(payload, batch_id):
+            self.calls.append(("batch_create", payload["idempotency_key"]))
+            return {"batch_id": 7}
+
+        async def batch_complete(payload, batch_id):
+            self.calls.append(("batch_complete", batch_id))
+            self.stock[MEAT] -= payload["meat"]
+            self.stock[SAUSAGE] += payload["output_weight"]
+            return {"batch_id": batch_id}
+
+        return {"batch_create": batch_create, "batch_complete": batch_complete}
+
+@pytest.fixture(autouse=True)
+def no_database(monkeypatch):
+    monkeypatch.setattr(sync_engine, "fetch_batch_refs", lambda refs: {})
+    monkeypatch.setattr(sync_engine, "fetch_stored_entries", lambda keys: {})
+    monkeypatch.setattr(
+        sync_engine, "save_document_result",
+        lambda key, endpoint, fingerprint, result: None
+    )
+
+def replay(operations, warehouse, post_stock=None) -> list:
+    async def collect():
+        return [
+            item async for item in iter_sync_operations(
+                operations, warehouse.handlers(), post_stock or warehouse.post_stock
+            )
+        ]
+    return asyncio.run(collect())
+
+def test_mixed_sequence_follows_client_timestamps():
+    # Sent out of order: the product withdrawal needs the completion before it
+    operations = [
+        operation(4, "withdrawal", "w-sausage", nomenclature_id=SAUSAGE, quantity=8.0),
+        operation(3, "batch_complete", "complete", batch_ref="create", meat=10.0, output_weight=8.5),
+        operation(0, "receipt", "r-meat", nomenclature_id=MEAT, quantity=10.0),
+        operation(5, "withdrawal", "w-meat", nomenclature_id=MEAT, quantity=1.0),
+        operation(1, "batch_create", "create", recipe_id=1),
+    ]
+    warehouse = Warehouse()
+
+    results = dict(replay(operations, warehouse))
+
+    assert warehouse.calls == [
+        ("stock", ["r-meat"]),
+        ("batch_create", "create"),
+        ("batch_complete", 7),
+        ("stock", ["w-sausage", "w-meat"]),
+    ]
+    assert results[0]["status"] == "success"
+    assert results[1]["result"]["batch_id"] == 7
+    # All meat went into the batch
+    assert results[3]["status"] == "error"
+    assert warehouse.stock == {MEAT: 0.0, SAUSAGE: pytest.approx(0.5)}
+
+def test_step_waits_for_a_creation_with_a_later_timestamp():
+    operations = [
+        operation(0, "batch_complete", "complete", batch_ref="create", meat=0.0, output_weight=1.0),
+        operation(1, "receipt", "r-meat", nomenclature_id=MEAT, quantity=1.0),
+        operation(2, "batch_create", "create", recipe_id=1),
+    ]
+    assert [op.idempotency_key for _, op in plan_operations(operations)] == ["r-meat", "create", "complete"]
+
+def test_failed_stock_run_reports_each_operation():
+    def rolled_back(run):
+        raise RuntimeError("deadlock")
+
+    operations = [
+        operation(0, "receipt", "r-1", nomenclature_id=MEAT, quantity=1.0),
+        operation(1, "receipt", "r-2", nomenclature_id=MEAT, quantity=2.0),
+        operation(2, "batch_create", "create", recipe_id=1),
+    ]
+    results = dict(replay(operations, Warehouse(), post_stock=rolled_back))
+
+    assert [results[idx]["status"] for idx in range(3)] == ["error", "error", "success"]
+    assert "deadlock" in results[0]["message"]
+
+def test_stock_replay_uses_the_direct_endpoint_body():
+    op = operation(0, "receipt", "r-1", nomenclature_id=MEAT, quantity=1.0, idempotency_key="r-1")
+    stock_op = StockOperation(**op.data)
+    fingerprint = request_fingerprint(sync_engine.STOCK_ENDPOINTS["receipt"], stock_op)
+    body = serialize_response({"status": "success", "message": "Прихід оброблено успішно", "balance_after": 1.0})
+
+    result = stock_replay(op, stock_op, fingerprint, (fingerprint, 200, body))
+    assert result["result"] == {
+        "nomenclature_id": MEAT, "status": "success", "message": "Прихід оброблено успішно", "balance_after": 1.0
+    }
+
+    conflict = stock_replay(op, stock_op, "other request", (fingerprint, 200, body))
+    assert conflict["status"] == "error" and "r-1" in conflict["message"]
@@ -0,0 +1,149 @@
+"""
+Incrementally maintained yield statistics (backend/yield_stats.py) against exact recomputation
+"""
+import os
+import random
+import statistics
+import sys
+from datetime import date
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from yield_stats import (  # noqa: E402
+    BUCKET_WIDTH, BUCKETS, EPOCH, combine, next_month, parse_day, percentile, period_ranges,
+    yield_bucket, yield_summary
+)
+
+TODAY = date(2026, 10, 19)
+
+def welford_bucket(values, expected_min=80.0, expected_max=90.0) -> tuple:
+    """One bucket built the way record_yield's MERGE updates it, one batch at a time"""
+    count, mean, m2 = 0, 0.0, 0.0
+    for value in values:
+        # UPDATE SET evaluates every expression against the old row
+        mean, m2 = mean + (value - mean) / (count + 1), m2 + (value - mean) ** 2 * count / (count + 1)
+        count += 1
+    below = sum(1 for value in values if value < expected_min)
+    above = sum(1 for value in values if value > expected_max)
+    return (count, 100.0 * count, sum(values), mean, m2, min(values), max(values), below, above)
+
+def histogram_of(values) -> dict:
+    histogram = {}
+    for value in values:
+        histogram[yield_bucket(value)] = histogram.get(yield_bucket(value), 0) + 1
+    return histogram
+
+@pytest.mark.parametrize("value,expected", [
+    ("2026-10-01", date(2026, 10, 1)),
+    ("2026-10-01T23:30:00", date(2026, 10, 1)),
+    ("2026-09-30T21:00:00.000Z", date(2026, 9, 30)),
+    ("2026-10-01T00:30:00+03:00", date(2026, 9, 30)),
+    ("2026-09-30T22:00:00-05:00", date(2026, 10, 1)),
+    (None, None),
+    ("", None),
+])
+def test_parse_day_is_utc(value, expected):
+    assert parse_day(value) == expected
+
+def test_parse_day_rejects_garbage():
+    with pytest.raises(ValueError):
+        parse_day("yesterday")
+
+@pytest.mark.parametrize("start,end,expected", [
+    (None, None, [('M', EPOCH, date(2026, 10, 1))]),
+    (date(2026, 10, 1), None, [('M', date(2026, 10, 1), date(2026, 10, 1))]),
+    (date(2026, 10, 12), None, [('D', date(2026, 10, 12), date(2026, 10, 19))]),
+    (date(2026, 9, 12), None, [
+        ('M', date(2026, 10, 1), date(2026, 10, 1)),
+        ('D', date(2026, 9, 12), date(2026, 9, 30)),
+    ]),
+    (date(2025, 3, 5), date(2025, 6, 10), [
+        ('M', date(2025, 4, 1), date(2025, 5, 1)),
+        ('D', date(2025, 3, 5), date(2025, 3, 31)),
+        ('D', date(2025, 6, 1), date(2025, 6, 10)),
+    ]),
+    (date(2025, 3, 1), date(2025, 3, 31), [('M', date(2025, 3, 1), date(2025, 3, 1))]),
+    (date(2025, 3, 5), date(2025, 3, 20), [('D', date(2025, 3, 5), date(2025, 3, 20))]),
+    (None, date(2025, 6, 10), [
+        ('M', EPOCH, date(2025, 5, 1)),
+        ('D', date(2025, 6, 1), date(2025, 6, 10)),
+    ]),
+    (date(2026, 10, 1), date(2027, 1, 1), [('M', date(2026, 10, 1), date(2026, 10, 1))]),
+    (date(2026, 11, 1), None, []),
+])
+def test_period_ranges(start, end, expected):
+    assert period_ranges(start, end, TODAY) == expected
+
+def test_period_ranges_cover_every_day_once():
+    start, end = date(2024, 1, 17), date(2025, 2, 3)
+    covered = []
+    for period_type, first, last in period_ranges(start, end, TODAY):
+        if period_type == 'M':
+            month = first
+            while month <= last:
+                covered.extend(range(month.toordinal(), next_month(month).toordinal()))
+                month = next_month(month)
+        else:
+            covered.extend(range(first.toordinal(), last.toordinal() + 1))
+    assert sorted(covered) == list(range(start.toordinal(), end.toordinal() + 1))
+
+def test_welford_buckets_combine_to_exact_statistics():
+    rng = random.Random(7)
+    values = [rng.gauss(85.0, 4.0) for _ in range(1000)]
+    sizes = [1, 2, 137, 300, 60, 500]
+    buckets, offset = [], 0
+    for size in sizes:
+        buckets.append(welford_bucket(values[offset:offset + size]))
+        offset += size
+
+    stats = combine(buckets)
+    assert stats['count'] == 1000
+    assert stats['mean'] == pytest.approx(statistics.fmean(values), rel=1e-12)
+    assert stats['variance'] == pytest.approx(statistics.variance(values), rel=1e-9)
+    assert stats['min'] == min(values) and stats['max'] == max(values)
+    assert stats['output_weight'] == pytest.approx(sum(values))
+    assert stats['below_range'] == sum(1 for value in values if value < 80.0)
+    assert stats['above_range'] == sum(1 for value in values if value > 90.0)
+
+def test_combine_empty_and_single():
+    empty = combine([])
+    assert empty['count'] == 0 and empty['mean'] is None and empty['variance'] is None
+    single = combine([welford_bucket([82.0])])
+    assert single['mean'] == 82.0 and single['variance'] is None
+    assert combine([(0, 0, 0, 0, 0, None, None, 0, 0), welford_bucket([82.0])])['count'] == 1
+
+def test_yield_bucket_clamps_outliers():
+    assert yield_bucket(-5.0) == 0
+    assert yield_bucket(84.74) == 169
+    assert yield_bucket(250.0) == BUCKETS - 1
+
+def test_percentile_within_one_bucket_of_exact():
+    rng = random.Random(11)
+    values = [rng.uniform(70.0, 95.0) for _ in range(5000)]
+    histogram = histogram_of(values)
+    exact = statistics.quantiles(values, n=10, method='inclusive')
+    for q, expected in ((0.1, exact[0]), (0.5, exact[4]), (0.9, exact[8])):
+        assert percentile(histogram, q, min(values), max(values)) == pytest.approx(expected, abs=BUCKET_WIDTH)
+
+def test_percentile_bounded_by_observed_range():
+    histogram = histogram_of([84.9])
+    assert percentile(histogram, 0.0, 84.9, 84.9) == 84.9
+    assert percentile(histogram, 1.0, 84.9, 84.9) == 84.9
+    assert percentile({}, 0.5, None, None) is None
+
+def test_summary_out_of_range_rate():
+    values = [78.0, 85.0, 86.0, 92.0]
+    summary = yield_summary(combine([welford_bucket(values)]), histogram_of(values))
+    assert summary['completed_count'] == 4
+    assert summary['below_range'] == 1 and summary['above_range'] == 1
+    assert summary['out_of_range_rate'] == 0.5
+    assert summary['avg_yield_percent'] == 85.25
+    assert summary['min_yield_percent'] == 78.0 and summary['max_yield_percent'] == 92.0
+
+def test_summary_without_batches():
+    summary = yield_summary(combine([]), {})
+    assert summary['completed_count'] == 0
+    assert summary['out_of_range_rate'] is None
+    assert summary['p50_yield_percent'] is None